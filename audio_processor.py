@@ -2,23 +2,54 @@
 обработка аудио и создание спектрограмм
 """
 import numpy as np
-import librosa
-import sounddevice as sd
-import matplotlib.pyplot as plt
-from scipy import signal
-from typing import Tuple, List
+from typing import Iterable, Iterator, Tuple, List, Optional, Sequence
+from decoder import decode_audio, RESAMPLE_HIGH
+
+# Точность вычислений: 'float64' - запись с микрофона в float64, а спектрограмма
+# в типе входных данных (как было всегда); 'float32' - весь тракт в float32,
+# вдвое меньше памяти на сигнал и спектрограмму
+PRECISION_FLOAT64 = 'float64'
+PRECISION_FLOAT32 = 'float32'
+PRECISIONS = (PRECISION_FLOAT64, PRECISION_FLOAT32)
 
 class AudioProcessor:
     """Класс для обработки аудио сигналов"""
     
-    def __init__(self, sample_rate: int = 22050):
+    def __init__(self, sample_rate: int = 22050, nperseg: int = 1024, noverlap: int = 512,
+                 precision: str = PRECISION_FLOAT64):
         """
    
         args:
             sample_rate: Частота дискретизации (по умолчанию 22050 Гц)
+            nperseg: Размер окна STFT
+            noverlap: Перекрытие окон STFT
+            precision: Точность вычислений: 'float64' или 'float32'
         """
+        if precision not in PRECISIONS:
+            raise ValueError(f"Неизвестная точность: {precision}")
+        
         self.sample_rate = sample_rate
+        self.nperseg = nperseg
+        self.noverlap = noverlap
+        self.precision = precision
+        
+    @property
+    def hop_length(self) -> int:
+        """Шаг между соседними кадрами спектрограммы в отсчетах"""
+        return self.nperseg - self.noverlap
+    
+    def frames_to_seconds(self, frames):
+        """
+        Перевод смещения в кадрах спектрограммы в секунды
         
+        Args:
+            frames: Число кадров (скаляр или массив)
+            
+        Returns:
+            Смещение в секундах
+        """
+        return np.asarray(frames) * self.hop_length / self.sample_rate
+    
     def record_audio(self, duration: float = 10.0) -> np.ndarray:
         """
         Запись аудио с микрофона
@@ -29,29 +60,35 @@ class AudioProcessor:
         Returns:
             numpy array с аудио данными
         """
+        # sounddevice (PortAudio) нужен только для записи - импортируем здесь
+        import sounddevice as sd
+        
         print(f"Записываем аудио {duration} секунд...")
         audio_data = sd.rec(
             int(duration * self.sample_rate), 
             samplerate=self.sample_rate, 
             channels=1, 
-            dtype='float64'
+            dtype=self.precision
         )
         sd.wait()  # Ждем завершения записи
         print("Запись завершена!")
         return audio_data.flatten()
     
-    def load_audio_file(self, file_path: str) -> np.ndarray:
+    def load_audio_file(self, file_path: str, offset: float = 0.0, duration: Optional[float] = None,
+                        resample: str = RESAMPLE_HIGH) -> np.ndarray:
         """
         Загрузка аудио файла
         
         Args:
             file_path: Путь к аудио файлу
+            offset: С какой секунды читать
+            duration: Сколько секунд читать (None - до конца файла)
+            resample: Режим ресемплинга: 'high' (как librosa.load) или 'fast'
             
         Returns:
-            numpy array с аудио данными
+            numpy array с аудио данными (float32, моно)
         """
-        audio_data, _ = librosa.load(file_path, sr=self.sample_rate)
-        return audio_data
+        return decode_audio(file_path, self.sample_rate, offset, duration, resample)
     
     def create_spectrogram(self, audio_data: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         """
@@ -63,23 +100,142 @@ class AudioProcessor:
         Returns:
             Кортеж (frequencies, times, spectrogram)
         """
+        if self.precision == PRECISION_FLOAT32:
+            audio_data = np.asarray(audio_data, dtype=np.float32)
+        
+        # scipy.signal импортируется больше секунды - только когда нужна спектрограмма
+        from scipy import signal
+        
         # Используем STFT (Short-Time Fourier Transform)
         frequencies, times, spectrogram = signal.spectrogram(
             audio_data,
             fs=self.sample_rate,
-            nperseg=1024,  # Размер окна
-            noverlap=512,  # Перекрытие окон
+            nperseg=self.nperseg,  # Размер окна
+            noverlap=self.noverlap,  # Перекрытие окон
             window='hann'
         )
         
-        # Преобразуем в децибелы для лучшей визуализации
-        spectrogram_db = 10 * np.log10(spectrogram + 1e-10)
+        # Преобразуем в децибелы для лучшей визуализации: 10 * log10(S + 1e-10),
+        # на месте, без временных массивов размером со спектрограмму
+        spectrogram += 1e-10
+        np.log10(spectrogram, out=spectrogram)
+        spectrogram *= 10
+        
+        return frequencies, times, spectrogram
+    
+    def iter_spectrogram(self, chunks: Iterable[np.ndarray]) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        Спектрограмма по блокам аудио: в памяти только текущий блок
+        
+        Кадры совпадают с create_spectrogram для всего сигнала целиком.
+        
+        Args:
+            chunks: Блоки аудио данных любой длины
+            
+        Yields:
+            Кортежи (номер_первого_кадра, спектрограмма_блока)
+        """
+        stream = SpectrogramStream(self)
+        for chunk in chunks:
+            first_frame, spectrogram = stream.update(chunk)
+            if spectrogram is not None:
+                yield first_frame, spectrogram
+    
+    def find_peaks(self, spectrogram: np.ndarray, threshold: float = -40.0,
+                   neighborhood_size: Tuple[int, int] = (3, 3),
+                   footprint: str = 'cross',
+                   top_k: Optional[int] = None,
+                   band_edges: Optional[Sequence[int]] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Векторизованный поиск пиков в спектрограмме
+        
+        Точка считается пиком, если она строго больше всех соседей
+        в окрестности и превышает порог. С параметрами по умолчанию
+        результат совпадает с find_peaks_reference.
+        
+        Args:
+            spectrogram: Спектрограмма
+            threshold: Порог для определения пиков
+            neighborhood_size: Размер окрестности (по частоте, по времени), нечетные числа
+            footprint: Форма окрестности: 'cross' (крест) или 'box' (прямоугольник)
+            top_k: Если задано, оставляем не больше top_k самых сильных пиков
+                   в каждой полосе частот для каждого кадра
+            band_edges: Границы полос частот (в бинах) для top_k,
+                        по умолчанию весь диапазон - одна полоса
+            
+        Returns:
+            Кортеж массивов (frequency_bins, time_bins, amplitudes),
+            отсортированных по времени, затем по частоте
+        """
+        size_f, size_t = neighborhood_size
+        if size_f < 1 or size_t < 1 or size_f % 2 == 0 or size_t % 2 == 0:
+            raise ValueError(f"Размер окрестности должен быть нечетным: {neighborhood_size}")
+        radius_f, radius_t = size_f // 2, size_t // 2
+        
+        # Маска окрестности без центральной точки - так сравнение будет строгим
+        if footprint == 'cross':
+            mask = np.zeros((size_f, size_t), dtype=bool)
+            mask[radius_f, :] = True
+            mask[:, radius_t] = True
+        elif footprint == 'box':
+            mask = np.ones((size_f, size_t), dtype=bool)
+        else:
+            raise ValueError(f"Неизвестная форма окрестности: {footprint}")
+        mask[radius_f, radius_t] = False
+        
+        from scipy import ndimage
+        
+        neighbors_max = ndimage.maximum_filter(
+            spectrogram, footprint=mask, mode='constant', cval=-np.inf
+        )
+        is_peak = (spectrogram > threshold) & (spectrogram > neighbors_max)
+        
+        # Края спектрограммы не рассматриваем, как и в эталонной реализации
+        border_f, border_t = max(radius_f, 1), max(radius_t, 1)
+        is_peak[:border_f, :] = False
+        is_peak[-border_f:, :] = False
+        is_peak[:, :border_t] = False
+        is_peak[:, -border_t:] = False
+        
+        # Транспонируем, чтобы получить порядок "время, затем частота"
+        time_bins, freq_bins = np.nonzero(is_peak.T)
+        amplitudes = spectrogram[freq_bins, time_bins]
+        
+        if top_k is not None and len(freq_bins) > 0:
+            freq_bins, time_bins, amplitudes = self._select_top_k(
+                freq_bins, time_bins, amplitudes, top_k, band_edges
+            )
         
-        return frequencies, times, spectrogram_db
+        return freq_bins.astype(np.int32), time_bins.astype(np.int32), amplitudes
     
-    def find_peaks(self, spectrogram: np.ndarray, threshold: float = -40.0) -> List[Tuple[int, int, float]]:
+    @staticmethod
+    def _select_top_k(freq_bins: np.ndarray, time_bins: np.ndarray, amplitudes: np.ndarray,
+                      top_k: int, band_edges: Optional[Sequence[int]] = None
+                      ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Оставляет top_k самых сильных пиков в каждой паре (кадр, полоса)"""
+        if band_edges is None:
+            bands = np.zeros(len(freq_bins), dtype=np.int64)
+        else:
+            bands = np.searchsorted(np.asarray(band_edges), freq_bins, side='right')
+        n_bands = int(bands.max()) + 1
+        groups = time_bins.astype(np.int64) * n_bands + bands
+        
+        # Сортируем по группе, внутри группы - по убыванию амплитуды
+        order = np.lexsort((-amplitudes, groups))
+        sorted_groups = groups[order]
+        starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+        group_sizes = np.diff(np.r_[starts, len(sorted_groups)])
+        ranks = np.arange(len(sorted_groups)) - np.repeat(starts, group_sizes)
+        
+        # Возвращаем исходный порядок "время, затем частота"
+        keep = np.sort(order[ranks < top_k])
+        return freq_bins[keep], time_bins[keep], amplitudes[keep]
+    
+    def find_peaks_reference(self, spectrogram: np.ndarray, threshold: float = -40.0) -> List[Tuple[int, int, float]]:
         """
-        Поиск пиков в спектрограмме
+        Эталонный (медленный) поиск пиков в спектрограмме
+        
+        Используется для проверки векторизованной реализации find_peaks.
         
         Args:
             spectrogram: Спектрограмма
@@ -106,7 +262,8 @@ class AudioProcessor:
         return peaks
     
     def visualize_spectrogram(self, frequencies: np.ndarray, times: np.ndarray, 
-                            spectrogram: np.ndarray, peaks: List[Tuple[int, int, float]] = None):
+                            spectrogram: np.ndarray,
+                            peaks: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None):
         """
         Визуализация спектрограммы
         
@@ -114,8 +271,10 @@ class AudioProcessor:
             frequencies: Массив частот
             times: Массив времен
             spectrogram: Спектрограмма
-            peaks: Список пиков для отображения
+            peaks: Пики для отображения (результат find_peaks)
         """
+        import matplotlib.pyplot as plt
+        
         plt.figure(figsize=(12, 8))
         
         # Отображаем спектрограмму
@@ -123,9 +282,10 @@ class AudioProcessor:
         plt.colorbar(label='Амплитуда (дБ)')
         
         # Отмечаем пики, если они есть
-        if peaks:
-            peak_freqs = [frequencies[f] for f, t, _ in peaks]
-            peak_times = [times[t] for f, t, _ in peaks]
+        if peaks is not None and len(peaks[0]) > 0:
+            freq_bins, time_bins, _ = peaks
+            peak_freqs = frequencies[freq_bins]
+            peak_times = times[time_bins]
             plt.scatter(peak_times, peak_freqs, c='red', s=20, alpha=0.7, label='Пики')
             plt.legend()
         
@@ -135,6 +295,64 @@ class AudioProcessor:
         plt.yscale('log')
         plt.show()
 
+class SpectrogramStream:
+    """
+    Инкрементальный STFT: аудио поступает блоками, кадры считаются по мере готовности
+    
+    Хранит только хвост сигнала короче одного окна, поэтому память не зависит
+    от длины записи.
+    """
+    
+    def __init__(self, processor: AudioProcessor):
+        """
+        Args:
+            processor: Обработчик аудио (частота, окно и перекрытие STFT)
+        """
+        self.processor = processor
+        self._samples = None
+        self._samples_start = 0       # номер первого отсчета в буфере
+        self.next_frame = 0           # первый еще не посчитанный кадр
+        self.samples_seen = 0
+    
+    def update(self, chunk: np.ndarray) -> Tuple[int, Optional[np.ndarray]]:
+        """
+        Добавление блока аудио
+        
+        Args:
+            chunk: Блок аудио данных (моно)
+            
+        Returns:
+            Кортеж (номер_первого_кадра, спектрограмма_новых_кадров или None)
+        """
+        chunk = np.asarray(chunk).reshape(-1)
+        if self._samples is None or len(self._samples) == 0:
+            self._samples = chunk
+        else:
+            self._samples = np.concatenate([self._samples, chunk])
+        self.samples_seen += len(chunk)
+        
+        nperseg, hop = self.processor.nperseg, self.processor.hop_length
+        first_frame = self.next_frame
+        if self.samples_seen < nperseg:
+            return first_frame, None
+        
+        total_frames = (self.samples_seen - nperseg) // hop + 1
+        if total_frames <= first_frame:
+            return first_frame, None
+        
+        # Отсчеты, покрывающие кадры next_frame .. total_frames - 1
+        begin = first_frame * hop - self._samples_start
+        end = (total_frames - 1) * hop + nperseg - self._samples_start
+        _, _, spectrogram = self.processor.create_spectrogram(self._samples[begin:end])
+        
+        # Хвост сигнала нужен только начиная со следующего кадра
+        self.next_frame = total_frames
+        drop = self.next_frame * hop - self._samples_start
+        self._samples = self._samples[drop:]
+        self._samples_start += drop
+        
+        return first_frame, spectrogram
+
 # Пример использования
 if __name__ == "__main__":
     processor = AudioProcessor()
@@ -148,7 +366,7 @@ if __name__ == "__main__":
     # Находим пики
     peaks = processor.find_peaks(spec)
     
-    print(f"Найдено {len(peaks)} пиков")
+    print(f"Найдено {len(peaks[0])} пиков")
     
     # Визуализируем результат
     processor.visualize_spectrogram(freqs, times, spec, peaks)
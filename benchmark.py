@@ -0,0 +1,762 @@
+"""
+Замеры производительности MyShazam
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import numpy as np
+from typing import Callable, Dict, List, Optional, Tuple
+from decoder import decode_audio, RESAMPLE_FAST
+
+def _best_time(func: Callable[[], object], repeat: int) -> float:
+    """Лучшее время из repeat запусков в секундах"""
+    best = float('inf')
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+def _cold_time(statement: str) -> float:
+    """Время выполнения statement в новом интерпретаторе, включая импорты"""
+    code = f"import time; start = time.perf_counter(); {statement}; print(time.perf_counter() - start)"
+    output = subprocess.run([sys.executable, '-W', 'ignore', '-c', code], capture_output=True,
+                            text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(output.stdout.strip().splitlines()[-1])
+
+# Модули, которых не должно быть при запуске CLI: их импорт занимает секунды
+# (scipy.signal, matplotlib, librosa) или требует устройств (sounddevice, tkinter)
+HEAVY_MODULES = ('matplotlib', 'sounddevice', 'tkinter', 'scipy.signal', 'scipy.stats', 'librosa', 'numba')
+
+# Бюджет на импорты при запуске main.py в секундах
+STARTUP_IMPORT_BUDGET = 1.0
+
+def import_profile(args: List[str]) -> Tuple[Dict[str, float], Dict[str, float]]:
+    """
+    Импорты нового интерпретатора по -X importtime
+    
+    Args:
+        args: Аргументы интерпретатора после -X importtime (например, ['-c', 'import main'])
+    
+    Returns:
+        Кортеж словарей модуль -> время импорта вместе с вложенными в секундах:
+        все модули и только модули верхнего уровня (их сумма - время всех импортов)
+    """
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-W', 'ignore', *args],
+                            capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    profile, top_level = {}, {}
+    for line in output.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        seconds = int(cumulative) / 1e6
+        profile[name.strip()] = seconds
+        # Вложенность видна по отступу имени: у верхнего уровня - один пробел
+        if not name[1:].startswith(' '):
+            top_level[name.strip()] = seconds
+    return profile, top_level
+
+def heavy_imports(profile: Dict[str, float]) -> List[str]:
+    """Загруженные тяжелые модули (см. HEAVY_MODULES)"""
+    return [name for name in HEAVY_MODULES if name in profile]
+
+def benchmark_startup(repeat: int = 3) -> List[Dict[str, object]]:
+    """
+    Время запуска CLI: импорты по -X importtime и полное время команды
+    
+    Команды выполняются на пустой временной базе.
+    
+    Args:
+        repeat: Число запусков (берется лучшее время)
+    
+    Returns:
+        Список словарей: command, wall_sec, import_sec, heavy - загруженные
+        тяжелые модули, slowest - самые долгие импорты верхнего уровня
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_path = os.path.join(temp_dir, 'startup.db')
+        commands = [
+            ['-c', 'import main'],
+            ['main.py', '--help'],
+            ['main.py', '--list-songs', '--db-path', db_path],
+        ]
+        for command in commands:
+            run = lambda: subprocess.run([sys.executable, '-W', 'ignore', *command], capture_output=True,
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+            profile, top_level = import_profile(command)
+            slowest = sorted(top_level, key=top_level.get, reverse=True)[:3]
+            results.append({
+                'command': ' '.join(command[:2]),
+                'wall_sec': round(_best_time(run, repeat), 3),
+                'import_sec': round(sum(top_level.values()), 3),
+                'heavy': ','.join(heavy_imports(profile)) or '-',
+                'slowest': ','.join(slowest),
+            })
+    return results
+
+def _synthetic_files(directory: str, seconds: float = 60.0) -> List[str]:
+    """Тестовые файлы: стерео WAV 44.1 кГц, моно WAV 22.05 кГц и FLAC 44.1 кГц"""
+    import soundfile as sf
+    
+    rng = np.random.default_rng(0)
+    files = []
+    for name, rate, channels in (('stereo_44100.wav', 44100, 2), ('mono_22050.wav', 22050, 1),
+                                 ('stereo_44100.flac', 44100, 2)):
+        audio = 0.3 * rng.standard_normal((int(seconds * rate), channels))
+        path = os.path.join(directory, name)
+        sf.write(path, audio.astype(np.float32), rate, subtype='PCM_16')
+        files.append(path)
+    return files
+
+def benchmark_decode(files: List[str], sample_rate: int = 22050, clip_seconds: float = 10.0,
+                     repeat: int = 3) -> List[Dict[str, object]]:
+    """
+    Время декодирования на минуту аудио: librosa.load против decode_audio
+    
+    Args:
+        files: Аудио файлы
+        sample_rate: Целевая частота дискретизации
+        clip_seconds: Длительность окна для замера частичного чтения
+        repeat: Число повторов (берется лучшее время)
+    
+    Returns:
+        Список словарей с результатами по файлам, время - секунды на минуту аудио
+    """
+    import librosa
+    
+    results = []
+    for path in files:
+        duration = len(decode_audio(path, sample_rate)) / sample_rate
+        per_minute = 60.0 / duration
+        clip_offset = max(0.0, duration / 2 - clip_seconds / 2)
+        
+        timings = {
+            'librosa': _best_time(lambda: librosa.load(path, sr=sample_rate), repeat),
+            'decode_high': _best_time(lambda: decode_audio(path, sample_rate), repeat),
+            'decode_fast': _best_time(lambda: decode_audio(path, sample_rate, resample=RESAMPLE_FAST),
+                                      repeat),
+        }
+        results.append({
+            'file': os.path.basename(path),
+            'duration': round(duration, 2),
+            **{f"{name}_sec_per_min": round(seconds * per_minute, 4) for name, seconds in timings.items()},
+            # Частичное чтение: сколько стоит запрос длиной clip_seconds из середины файла
+            'clip_librosa_sec': round(_best_time(lambda: librosa.load(
+                path, sr=sample_rate, offset=clip_offset, duration=clip_seconds), repeat), 4),
+            'clip_decode_fast_sec': round(_best_time(lambda: decode_audio(
+                path, sample_rate, clip_offset, clip_seconds, RESAMPLE_FAST), repeat), 4),
+            # Первый запрос в новом процессе: импорт librosa тянет numba и весь scipy
+            'cold_clip_librosa_sec': round(_cold_time(
+                f"import librosa; librosa.load({path!r}, sr={sample_rate}, duration={clip_seconds})"), 4),
+            'cold_clip_decode_sec': round(_cold_time(
+                f"from decoder import decode_audio; decode_audio({path!r}, {sample_rate}, 0.0, {clip_seconds})"), 4),
+        })
+    return results
+
+def synthetic_audio(seconds: float, sample_rate: int = 22050, dtype=np.float32,
+                    seed: int = 0) -> np.ndarray:
+    """
+    Синтетический сигнал: смена случайных аккордов каждые 0.25 с плюс шум
+    
+    Генерируется блоками прямо в массив нужного типа, чтобы не занимать
+    лишнюю память под временные float64 массивы.
+    """
+    rng = np.random.default_rng(seed)
+    note_length = sample_rate // 4
+    audio = np.empty(int(seconds * sample_rate), dtype=dtype)
+    t = np.arange(note_length) / sample_rate
+    for start in range(0, len(audio), note_length):
+        length = min(note_length, len(audio) - start)
+        note = sum(np.sin(2 * np.pi * f * t[:length]) for f in rng.uniform(200, 4000, 3)) / 4
+        audio[start:start + length] = note + rng.normal(0, 0.05, length)
+    return audio
+
+def benchmark_memory(seconds: float = 600.0,
+                     modes=('float64', 'float32', 'float32-blocked')) -> List[Dict[str, object]]:
+    """
+    Пиковая память (RSS) при создании отпечатка длинной записи
+    
+    Каждый замер - в отдельном процессе, чтобы пик одного не влиял на другой.
+    Сигнал подается в типе, соответствующем точности (как с микрофона).
+    Режим с суффиксом -blocked создает отпечаток через iter_fingerprint.
+    
+    Args:
+        seconds: Длительность записи
+        modes: Режимы: точность AudioProcessor и, через дефис, blocked
+    
+    Returns:
+        Список словарей: mode, baseline_mb (после генерации сигнала),
+        peak_mb, delta_mb, hashes, seconds - время создания отпечатка
+    """
+    results = []
+    for mode in modes:
+        precision, _, blocked = mode.partition('-')
+        create = ("sum(len(part) for part in system.iter_fingerprint(audio))" if blocked
+                  else "len(system.create_fingerprint_array(audio))")
+        code = (
+            "import json, resource, time\n"
+            "from benchmark import synthetic_audio\n"
+            "from fingerprint import AudioFingerprint\n"
+            f"audio = synthetic_audio({seconds}, dtype={precision!r})\n"
+            f"system = AudioFingerprint(precision={precision!r})\n"
+            "baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n"
+            "start = time.perf_counter()\n"
+            f"hashes = {create}\n"
+            "elapsed = time.perf_counter() - start\n"
+            "peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n"
+            "print(json.dumps([baseline, peak, hashes, elapsed]))\n"
+        )
+        output = subprocess.run([sys.executable, '-W', 'ignore', '-c', code], capture_output=True,
+                                text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        baseline, peak, hashes, elapsed = json.loads(output.stdout.strip().splitlines()[-1])
+        # ru_maxrss в Linux - в килобайтах
+        results.append({
+            'mode': mode,
+            'baseline_mb': round(baseline / 1024, 1),
+            'peak_mb': round(peak / 1024, 1),
+            'delta_mb': round((peak - baseline) / 1024, 1),
+            'hashes': hashes,
+            'seconds': round(elapsed, 2),
+        })
+    return results
+
+def synthetic_catalog(songs: int, song_seconds: float, sample_rate: int = 22050,
+                      drone_level: float = 0.0) -> List[np.ndarray]:
+    """
+    Синтетический каталог песен (см. synthetic_audio)
+    
+    Args:
+        songs: Число песен
+        song_seconds: Длительность песни
+        sample_rate: Частота дискретизации
+        drone_level: Громкость общего для всех песен гула на нескольких частотах
+                     (как фон, тишина с шумом или одинаковые аккорды у реальных
+                     песен) - источник частых хешей
+    
+    Returns:
+        Аудио данные песен
+    """
+    t = np.arange(int(song_seconds * sample_rate)) / sample_rate
+    drone = drone_level * sum(np.sin(2 * np.pi * f * t) for f in (110.0, 220.0, 330.0)).astype(np.float32) / 3
+    return [synthetic_audio(song_seconds, sample_rate, seed=100 + i) + drone for i in range(songs)]
+
+def _query_clips(catalog: List[np.ndarray], queries: int, clip_length: int,
+                 noise: float = 0.1, seed: int = 0) -> Tuple[List[int], List[np.ndarray]]:
+    """Случайные фрагменты песен каталога с шумом: (номера песен, фрагменты)"""
+    rng = np.random.default_rng(seed)
+    song_numbers, clips = [], []
+    for _ in range(queries):
+        song = int(rng.integers(len(catalog)))
+        start = int(rng.integers(len(catalog[song]) - clip_length))
+        clip = catalog[song][start:start + clip_length]
+        song_numbers.append(song)
+        clips.append(clip + rng.normal(0, noise, len(clip)).astype(np.float32))
+    return song_numbers, clips
+
+def benchmark_stop_list(songs: int = 100, song_seconds: float = 20.0, queries: int = 50,
+                        fractions=(0.2, 0.05, 0.02), clip_seconds: float = 5.0,
+                        scoring: str = 'count') -> List[Dict[str, object]]:
+    """
+    Влияние стоп-листа частых хешей на размер индекса, число строк,
+    читаемых на запрос, точность и время поиска
+    
+    Args:
+        songs: Число песен синтетического каталога
+        song_seconds: Длительность песни
+        queries: Число запросов (фрагменты песен с шумом)
+        fractions: Значения max_song_fraction для build_stop_list
+        clip_seconds: Длительность запроса
+        scoring: Способ оценки для search_song (веса 'weight' действуют на 'count')
+    
+    Returns:
+        Список словарей: mode, fraction, limit, stop_hashes, index_rows_pct - доля
+        строк индекса с частыми хешами, rows_per_query, rows_drop_pct,
+        accuracy, ms_per_query. Последняя строка - удаление частых хешей из базы
+        (prune): размер файла базы до и после
+    """
+    from database import FingerprintDatabase, STOP_OFF, STOP_SKIP, STOP_WEIGHT
+    
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_path = os.path.join(temp_dir, 'stop_list.db')
+        database = FingerprintDatabase(db_path)
+        fingerprint_system = database.fingerprint_system
+        sample_rate = fingerprint_system.audio_processor.sample_rate
+        catalog = synthetic_catalog(songs, song_seconds, sample_rate, drone_level=0.1)
+        database.add_songs_batch([(f"Песня {i}", "Синтетика", None, song_seconds,
+                                   fingerprint_system.create_fingerprint_array(audio))
+                                  for i, audio in enumerate(catalog)])
+        
+        song_numbers, clips = _query_clips(catalog, queries, int(clip_seconds * sample_rate))
+        expected = [f"Песня {song}" for song in song_numbers]
+        fingerprints = [fingerprint_system.create_fingerprint_array(clip) for clip in clips]
+        
+        def measure(mode: str, fraction, stats) -> Dict[str, object]:
+            database.stop_mode = mode
+            rows = sum(len(database.lookup_hashes(np.unique(fingerprint['hash']))[0])
+                       for fingerprint in fingerprints)
+            start_time = time.perf_counter()
+            matches = [database.search_song(fingerprint, 0.05, scoring) for fingerprint in fingerprints]
+            elapsed = time.perf_counter() - start_time
+            correct = sum(1 for match, name in zip(matches, expected) if match and match[0][0] == name)
+            return {
+                'mode': mode,
+                'fraction': fraction,
+                'limit': stats['limit'] if stats else None,
+                'stop_hashes': stats['stop_hashes'] if stats else 0,
+                'index_rows_pct': round(100 * stats['stop_rows'] / stats['total_rows'], 1) if stats else 0.0,
+                'rows_per_query': round(rows / queries),
+                'rows_drop_pct': None,
+                'accuracy': round(correct / queries, 3),
+                'ms_per_query': round(1000 * elapsed / queries, 2),
+            }
+        
+        baseline = measure(STOP_OFF, None, None)
+        baseline['rows_drop_pct'] = 0.0
+        results.append(baseline)
+        for fraction in fractions:
+            stats = database.build_stop_list(max_song_fraction=fraction)
+            for mode in (STOP_SKIP, STOP_WEIGHT):
+                row = measure(mode, fraction, stats)
+                row['rows_drop_pct'] = round(100 * (1 - row['rows_per_query'] / baseline['rows_per_query']), 1)
+                results.append(row)
+        
+        # Удаление частых хешей из хранилища (последнее значение fraction)
+        size_before = os.path.getsize(db_path)
+        stats = database.build_stop_list(max_song_fraction=fractions[-1], prune=True)
+        database._connect().execute('VACUUM')
+        database._connect().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        row = measure(STOP_SKIP, fractions[-1], stats)
+        row['mode'] = 'skip+prune'
+        row['rows_drop_pct'] = round(100 * (1 - row['rows_per_query'] / baseline['rows_per_query']), 1)
+        row['db_mb_before'] = round(size_before / (1 << 20), 2)
+        row['db_mb_after'] = round(os.path.getsize(db_path) / (1 << 20), 2)
+        results.append(row)
+        database.close()
+    return results
+
+def benchmark_schema(songs: int = 200, song_seconds: float = 30.0, queries: int = 100,
+                     clip_seconds: float = 5.0, batch_size: int = 50) -> List[Dict[str, object]]:
+    """
+    Сравнение схем таблицы отпечатков: размер базы, время добавления
+    и задержка search_song
+    
+    Отпечатки каталога считаются один раз, в каждую схему добавляются одни
+    и те же строки. Последняя строка - перевод базы схемы 1 на схему 2
+    (upgrade_schema).
+    
+    Args:
+        songs: Число песен синтетического каталога
+        song_seconds: Длительность песни
+        queries: Число запросов
+        clip_seconds: Длительность запроса
+        batch_size: Сколько песен добавлять одной транзакцией
+    
+    Returns:
+        Список словарей: schema, rows, db_mb, bytes_per_row, ingest_sec,
+        rows_per_sec, search_ms_mean, search_ms_p95
+    """
+    from database import FingerprintDatabase, SCHEMA_V1, SCHEMA_V2
+    from fingerprint import AudioFingerprint
+    
+    fingerprint_system = AudioFingerprint()
+    sample_rate = fingerprint_system.audio_processor.sample_rate
+    catalog = synthetic_catalog(songs, song_seconds, sample_rate)
+    fingerprints = [fingerprint_system.create_fingerprint_array(audio) for audio in catalog]
+    _, clips = _query_clips(catalog, queries, int(clip_seconds * sample_rate))
+    query_fingerprints = [fingerprint_system.create_fingerprint_array(clip) for clip in clips]
+    
+    def search_latency(database) -> Dict[str, float]:
+        latencies = []
+        for fingerprint in query_fingerprints:
+            start_time = time.perf_counter()
+            database.search_song(fingerprint)
+            latencies.append(time.perf_counter() - start_time)
+        return {'search_ms_mean': round(1000 * float(np.mean(latencies)), 2),
+                'search_ms_p95': round(1000 * float(np.percentile(latencies, 95)), 2)}
+    
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for schema_version in (SCHEMA_V1, SCHEMA_V2):
+            db_path = os.path.join(temp_dir, f'schema_{schema_version}.db')
+            database = FingerprintDatabase(db_path, schema_version=schema_version)
+            
+            start_time = time.perf_counter()
+            for start in range(0, songs, batch_size):
+                database.add_songs_batch([(f"Песня {i}", "Синтетика", None, song_seconds, fingerprints[i])
+                                          for i in range(start, min(start + batch_size, songs))])
+            ingest_sec = time.perf_counter() - start_time
+            database._connect().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            
+            rows = database.get_fingerprint_count()
+            size = database._file_size()
+            results.append({
+                'schema': schema_version,
+                'rows': rows,
+                'db_mb': round(size / (1 << 20), 2),
+                'bytes_per_row': round(size / rows, 1),
+                'ingest_sec': round(ingest_sec, 2),
+                'rows_per_sec': round(rows / ingest_sec),
+                **search_latency(database),
+            })
+            database.close()
+        
+        database = FingerprintDatabase(os.path.join(temp_dir, f'schema_{SCHEMA_V1}.db'))
+        start_time = time.perf_counter()
+        stats = database.upgrade_schema()
+        upgrade_sec = time.perf_counter() - start_time
+        results.append({
+            'schema': '1->2',
+            'rows': stats['rows'],
+            'db_mb': round(stats['bytes_after'] / (1 << 20), 2),
+            'bytes_per_row': round(stats['bytes_after'] / stats['rows'], 1),
+            'ingest_sec': round(upgrade_sec, 2),
+            'rows_per_sec': round(stats['rows'] / upgrade_sec),
+            **search_latency(database),
+        })
+        database.close()
+    return results
+
+def _peak_mb(func: Callable[[], object]) -> float:
+    """Пик памяти, выделенной за вызов func, в МБ (tracemalloc видит и массивы numpy)"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / (1 << 20)
+    finally:
+        tracemalloc.stop()
+
+def _each(func: Callable[[object], object], items: List[object]):
+    """Вызов func для каждого элемента без накопления результатов (пик памяти - одного вызова)"""
+    for item in items:
+        func(item)
+
+def _environment() -> Dict[str, object]:
+    """Окружение замера: без него сравнивать прогоны с разных машин бессмысленно"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+def benchmark_stages(songs: int = 50, song_seconds: float = 30.0, queries: int = 50,
+                     clip_seconds: float = 5.0, repeat: int = 3,
+                     min_seconds: float = 1.0) -> Dict[str, object]:
+    """
+    Время, пропускная способность и пик памяти этапов отпечатка и поиска
+    
+    Каталог и запросы синтетические (synthetic_catalog, _query_clips) с
+    фиксированными зернами, поэтому прогоны на одной машине сравнимы.
+    Время этапа - лучшее из repeat прогонов (для быстрых этапов - из стольких,
+    чтобы набралось min_seconds), память - отдельный прогон
+    под tracemalloc (он замедляет выполнение и в замер времени не входит).
+    
+    Args:
+        songs: Число песен каталога
+        song_seconds: Длительность песни
+        queries: Число запросов
+        clip_seconds: Длительность запроса
+        repeat: Минимальное число повторов каждого этапа
+        min_seconds: Минимальное суммарное время повторов этапа
+    
+    Returns:
+        Словарь: params - параметры, environment - окружение (см. _environment),
+        stages - список словарей stage, seconds, ops, per_op_ms, throughput,
+        unit, peak_mb (и accuracy для поиска)
+    """
+    from database import FingerprintDatabase, BACKEND_MEMORY, SCORING_OFFSET
+    from fingerprint import AudioFingerprint
+    
+    fingerprint_system = AudioFingerprint()
+    processor = fingerprint_system.audio_processor
+    sample_rate = processor.sample_rate
+    catalog = synthetic_catalog(songs, song_seconds, sample_rate)
+    song_numbers, clips = _query_clips(catalog, queries, int(clip_seconds * sample_rate))
+    expected = [f"Песня {song}" for song in song_numbers]
+    audio_seconds = songs * song_seconds
+    
+    stages = []
+    
+    def measure(stage: str, func: Callable[[], object], ops: int, units: float, unit: str, **extra):
+        # Быстрые этапы повторяются, пока замер не займет около секунды: лучшее
+        # из трех прогонов по несколько миллисекунд слишком зависит от шума
+        seconds = _best_time(func, 1)
+        seconds = min(seconds, _best_time(func, max(repeat - 1, int(min_seconds / max(seconds, 1e-6)))))
+        stages.append({
+            'stage': stage,
+            'seconds': round(seconds, 4),
+            'ops': ops,
+            'per_op_ms': round(1000 * seconds / ops, 3),
+            'throughput': round(units / seconds, 1),
+            'unit': unit,
+            'peak_mb': round(_peak_mb(func), 1),
+            **extra,
+        })
+    
+    # Этапы отпечатка по всему каталогу: входы каждого этапа готовятся заранее
+    threshold = fingerprint_system.target_zone_threshold
+    measure('spectrogram', lambda: _each(processor.create_spectrogram, catalog),
+            songs, audio_seconds, 'audio_sec/s')
+    spectrograms = [processor.create_spectrogram(audio)[2] for audio in catalog]
+    measure('find_peaks', lambda: _each(lambda spectrogram: processor.find_peaks(spectrogram, threshold),
+                                        spectrograms),
+            songs, audio_seconds, 'audio_sec/s')
+    peaks = [processor.find_peaks(spectrogram, threshold)[:2] for spectrogram in spectrograms]
+    del spectrograms
+    measure('generate_pairs', lambda: _each(lambda song_peaks: fingerprint_system.generate_pairs(*song_peaks),
+                                            peaks),
+            songs, sum(len(freq_bins) for freq_bins, _ in peaks), 'peaks/s')
+    measure('create_fingerprint', lambda: _each(fingerprint_system.create_fingerprint_array, catalog),
+            songs, audio_seconds, 'audio_sec/s')
+    fingerprints = [fingerprint_system.generate_pairs(*song_peaks) for song_peaks in peaks]
+    rows = sum(len(fingerprint) for fingerprint in fingerprints)
+    query_fingerprints = [fingerprint_system.create_fingerprint_array(clip) for clip in clips]
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Запись каталога - каждый повтор в новую базу
+        runs = itertools.count()
+        
+        def ingest() -> FingerprintDatabase:
+            database = FingerprintDatabase(os.path.join(temp_dir, f'ingest_{next(runs)}.db'))
+            database.add_songs_batch([(f"Песня {i}", "Синтетика", None, song_seconds, fingerprint)
+                                      for i, fingerprint in enumerate(fingerprints)])
+            database.close()
+            return database
+        
+        measure('add_fingerprint', ingest, songs, rows, 'rows/s')
+        database = ingest()
+        database = FingerprintDatabase(database.db_path)
+        
+        def search(database, scoring):
+            answers = [database.search_song(fingerprint, 0.05, scoring) for fingerprint in query_fingerprints]
+            return sum(1 for matches, name in zip(answers, expected) if matches and matches[0][0] == name)
+        
+        def accuracy(correct: int) -> Dict[str, float]:
+            return {'accuracy': round(correct / queries, 3)}
+        
+        correct = search(database, 'count')
+        measure('search_sqlite', lambda: search(database, 'count'), queries, queries, 'queries/s',
+                **accuracy(correct))
+        database.close()
+        
+        database = FingerprintDatabase(database.db_path, backend=BACKEND_MEMORY)
+        correct = search(database, 'count')
+        measure('search_memory', lambda: search(database, 'count'), queries, queries, 'queries/s',
+                **accuracy(correct))
+        correct = search(database, SCORING_OFFSET)
+        measure('search_memory_offset', lambda: search(database, SCORING_OFFSET), queries, queries,
+                'queries/s', **accuracy(correct))
+        measure('search_batch_memory', lambda: database.search_songs_batch(query_fingerprints, 0.05),
+                queries, queries, 'queries/s')
+        database.close()
+    
+    return {
+        'params': {'songs': songs, 'song_seconds': song_seconds, 'queries': queries,
+                   'clip_seconds': clip_seconds, 'repeat': repeat, 'min_seconds': min_seconds},
+        'environment': _environment(),
+        'stages': stages,
+    }
+
+def compare_runs(base: Dict[str, object], new: Dict[str, object],
+                 tolerance: float = 0.15, memory_tolerance_mb: float = 1.0,
+                 min_delta_ms: float = 0.5) -> List[Dict[str, object]]:
+    """
+    Сравнение двух прогонов benchmark_stages
+    
+    Этап считается регрессией, если он стал медленнее больше чем на tolerance
+    (доля) и на min_delta_ms на операцию (быстрые этапы в пределах шума не
+    отмечаются), если его пик памяти вырос больше чем на tolerance и на
+    memory_tolerance_mb, или если упала точность поиска.
+    
+    Args:
+        base: Базовый прогон
+        new: Новый прогон
+        tolerance: Допустимое относительное ухудшение
+        memory_tolerance_mb: Рост памяти, который не считается регрессией
+        min_delta_ms: Замедление на операцию, которое не считается регрессией
+    
+    Returns:
+        Список словарей по этапам обоих прогонов: stage, base_ms, new_ms,
+        time_change, base_mb, new_mb, status ('ok', 'faster', 'regression',
+        'missing', 'new')
+    """
+    base_stages = {row['stage']: row for row in base['stages']}
+    new_stages = {row['stage']: row for row in new['stages']}
+    rows = []
+    for stage in list(dict.fromkeys([*base_stages, *new_stages])):
+        old, current = base_stages.get(stage), new_stages.get(stage)
+        if old is None or current is None:
+            rows.append({'stage': stage, 'status': 'new' if old is None else 'missing'})
+            continue
+        
+        change = current['per_op_ms'] / old['per_op_ms'] - 1 if old['per_op_ms'] else 0.0
+        significant = abs(current['per_op_ms'] - old['per_op_ms']) > min_delta_ms
+        memory_growth = current['peak_mb'] - old['peak_mb']
+        regression = ((change > tolerance and significant)
+                      or (memory_growth > memory_tolerance_mb and memory_growth > tolerance * old['peak_mb'])
+                      or current.get('accuracy', 1.0) < old.get('accuracy', 1.0))
+        rows.append({
+            'stage': stage,
+            'base_ms': old['per_op_ms'],
+            'new_ms': current['per_op_ms'],
+            'time_change': f"{change:+.1%}",
+            'base_mb': old['peak_mb'],
+            'new_mb': current['peak_mb'],
+            'status': ('regression' if regression
+                       else 'faster' if change < -tolerance and significant else 'ok'),
+        })
+    return rows
+
+def _print_table(results: List[Dict[str, object]]):
+    """Вывод результатов таблицей"""
+    if not results:
+        return
+    columns = list(dict.fromkeys(column for row in results for column in row))
+    widths = [max(len(column), *(len(str(row.get(column, ''))) for row in results)) for column in columns]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in results:
+        print('  '.join(str(row.get(column, '')).ljust(width) for column, width in zip(columns, widths)))
+
+def _run_decode(args) -> Tuple[object, List[Dict[str, object]], Optional[str]]:
+    """Подкоманда decode"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        files = args.files or _synthetic_files(temp_dir)
+        results = benchmark_decode(files, clip_seconds=args.clip, repeat=args.repeat)
+    return results, results, None
+
+def _run_memory(args) -> Tuple[object, List[Dict[str, object]], Optional[str]]:
+    """Подкоманда memory"""
+    results = benchmark_memory(args.duration)
+    return results, results, None
+
+def _run_stop_list(args) -> Tuple[object, List[Dict[str, object]], Optional[str]]:
+    """Подкоманда stoplist"""
+    results = benchmark_stop_list(args.songs, queries=args.queries, scoring=args.scoring)
+    return results, results, None
+
+def _run_schema(args) -> Tuple[object, List[Dict[str, object]], Optional[str]]:
+    """Подкоманда schema"""
+    results = benchmark_schema(args.songs, queries=args.queries)
+    return results, results, None
+
+def _run_startup(args) -> Tuple[object, List[Dict[str, object]], Optional[str]]:
+    """Подкоманда startup"""
+    results = benchmark_startup(args.repeat)
+    failed = [row['command'] for row in results
+              if row['heavy'] != '-' or row['import_sec'] > STARTUP_IMPORT_BUDGET]
+    error = f"Регрессия времени запуска: {', '.join(failed)}" if args.check and failed else None
+    return results, results, error
+
+def _run_stages(args) -> Tuple[object, List[Dict[str, object]], Optional[str]]:
+    """Подкоманда stages"""
+    results = benchmark_stages(args.songs, args.seconds, args.queries, repeat=args.repeat)
+    return results, results['stages'], None
+
+def _run_compare(args) -> Tuple[object, List[Dict[str, object]], Optional[str]]:
+    """Подкоманда compare"""
+    with open(args.base, encoding='utf-8') as file:
+        base = json.load(file)
+    with open(args.new, encoding='utf-8') as file:
+        new = json.load(file)
+    if base['params'] != new['params']:
+        print(f"Внимание: прогоны с разными параметрами: {base['params']} / {new['params']}", file=sys.stderr)
+    rows = compare_runs(base, new, args.tolerance, min_delta_ms=args.min_delta_ms)
+    regressions = [row['stage'] for row in rows if row['status'] == 'regression']
+    error = f"Регрессия этапов: {', '.join(regressions)}" if regressions else None
+    return rows, rows, error
+
+# Подкоманда -> функция, которая возвращает (результат для JSON, строки таблицы,
+# текст ошибки для кода возврата 1 или None)
+COMMANDS = {
+    'decode': _run_decode,
+    'memory': _run_memory,
+    'stoplist': _run_stop_list,
+    'schema': _run_schema,
+    'startup': _run_startup,
+    'stages': _run_stages,
+    'compare': _run_compare,
+}
+
+def main():
+    """Главная функция"""
+    parser = argparse.ArgumentParser(description="MyShazam - замеры производительности")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    decode_parser = subparsers.add_parser("decode", help="Скорость декодирования аудио файлов")
+    decode_parser.add_argument("files", nargs="*",
+                               help="Аудио файлы (по умолчанию - синтетические WAV/FLAC по минуте)")
+    decode_parser.add_argument("--repeat", type=int, default=3, help="Число повторов")
+    decode_parser.add_argument("--clip", type=float, default=10.0, help="Длительность окна запроса")
+    
+    memory_parser = subparsers.add_parser("memory", help="Пиковая память при создании отпечатка")
+    memory_parser.add_argument("--duration", type=float, default=600.0,
+                               help="Длительность синтетической записи в секундах")
+    
+    stop_parser = subparsers.add_parser("stoplist", help="Стоп-лист частых хешей: размер индекса и запросов")
+    stop_parser.add_argument("--songs", type=int, default=100, help="Число песен синтетического каталога")
+    stop_parser.add_argument("--queries", type=int, default=50, help="Число запросов")
+    stop_parser.add_argument("--scoring", choices=("count", "offset"), default="count",
+                             help="Способ оценки совпадений")
+    
+    schema_parser = subparsers.add_parser("schema", help="Схемы таблицы отпечатков: размер, добавление, поиск")
+    schema_parser.add_argument("--songs", type=int, default=200, help="Число песен синтетического каталога")
+    schema_parser.add_argument("--queries", type=int, default=100, help="Число запросов")
+    
+    startup_parser = subparsers.add_parser("startup", help="Время запуска CLI и тяжелые импорты")
+    startup_parser.add_argument("--repeat", type=int, default=3, help="Число повторов")
+    startup_parser.add_argument("--check", action="store_true",
+                                help="Код возврата 1, если загружены тяжелые модули или превышен бюджет импортов")
+    
+    stages_parser = subparsers.add_parser("stages", help="Этапы отпечатка и поиска: время, пропускная способность, память")
+    stages_parser.add_argument("--songs", type=int, default=50, help="Число песен синтетического каталога")
+    stages_parser.add_argument("--seconds", type=float, default=30.0, help="Длительность песни")
+    stages_parser.add_argument("--queries", type=int, default=50, help="Число запросов")
+    stages_parser.add_argument("--repeat", type=int, default=3, help="Число повторов")
+    
+    compare_parser = subparsers.add_parser("compare", help="Сравнить два прогона stages (код возврата 1 при регрессии)")
+    compare_parser.add_argument("base", help="JSON базового прогона")
+    compare_parser.add_argument("new", help="JSON нового прогона")
+    compare_parser.add_argument("--tolerance", type=float, default=0.15,
+                                help="Допустимое замедление (доля, по умолчанию 0.15)")
+    compare_parser.add_argument("--min-delta-ms", type=float, default=0.5,
+                                help="Замедление на операцию в мс, которое не считается регрессией")
+    
+    for subparser in subparsers.choices.values():
+        subparser.add_argument("--json", action="store_true", help="Вывести результат в JSON")
+        subparser.add_argument("--output", type=str, help="Сохранить результат в JSON файл")
+    
+    args = parser.parse_args()
+    results, rows, error = COMMANDS[args.command](args)
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        _print_table(rows)
+    
+    if error:
+        print(error, file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
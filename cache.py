@@ -0,0 +1,237 @@
+"""
+Кеши: результаты распознавания в памяти (LRU с ограничением размера и времени
+жизни) и промежуточные данные отпечатков аудио файлов на диске
+"""
+import os
+import time
+import zipfile
+import hashlib
+import tempfile
+import threading
+import collections
+import numpy as np
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+class LRUCache:
+    """
+    Словарь с вытеснением давно не использованных записей
+    
+    Записей не больше max_size, каждая живет не дольше ttl секунд.
+    Безопасен для использования из нескольких потоков.
+    """
+    
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None):
+        """
+        Args:
+            max_size: Максимальное число записей (0 - кеш выключен)
+            ttl: Время жизни записи в секундах (None - без ограничения)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # ключ -> (время записи, значение)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Значение по ключу (запись становится самой свежей)
+        
+        Args:
+            key: Ключ
+            default: Что вернуть, если записи нет или она устарела
+        
+        Returns:
+            Значение или default
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            
+            if entry is None:
+                self.misses += 1
+                return default
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, key: Hashable, value: Any):
+        """
+        Запись значения, при переполнении вытесняется самая старая запись
+        
+        Args:
+            key: Ключ
+            value: Значение
+        """
+        if self.max_size <= 0:
+            return
+        
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def clear(self):
+        """Удаление всех записей (счетчики сохраняются)"""
+        with self._lock:
+            self._entries.clear()
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def stats(self) -> Dict[str, float]:
+        """
+        Статистика кеша
+        
+        Returns:
+            Словарь: size, max_size, hits, misses, hit_rate, evictions, expirations
+        """
+        requests = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+def audio_digest(audio_data: np.ndarray) -> bytes:
+    """Дайджест отсчетов аудио (с учетом типа данных)"""
+    audio_data = np.ascontiguousarray(audio_data)
+    digest = hashlib.blake2b(audio_data.dtype.str.encode(), digest_size=16)
+    digest.update(audio_data.view(np.uint8).reshape(-1))
+    return digest.digest()
+
+def query_digest(fingerprint: np.ndarray, with_offsets: bool) -> bytes:
+    """
+    Дайджест хешей запроса
+    
+    Для оценки по числу совпадений важно только множество хешей, для оценки
+    по сдвигам - еще и время опорных пиков.
+    
+    Args:
+        fingerprint: Отпечаток (структурированный массив)
+        with_offsets: Учитывать время опорных пиков
+    
+    Returns:
+        Дайджест (16 байт)
+    """
+    if with_offsets:
+        digest = hashlib.blake2b(b'offsets', digest_size=16)
+        digest.update(np.ascontiguousarray(fingerprint['hash']).tobytes())
+        digest.update(np.ascontiguousarray(fingerprint['anchor_time']).tobytes())
+    else:
+        digest = hashlib.blake2b(b'set', digest_size=16)
+        digest.update(np.unique(fingerprint['hash']).tobytes())
+    return digest.digest()
+
+class FingerprintCache:
+    """
+    Кеш промежуточных данных отпечатков аудио файлов на диске
+    
+    Ключ - хеш содержимого файла и параметры этапа, поэтому переименование
+    файла кеш не сбрасывает, а изменение файла - сбрасывает. Хранятся:
+    - декодированный сигнал (.npy, float32) - ключ: частота дискретизации;
+    - пики спектрограммы (.npz) - ключ: частота, параметры STFT и порог пиков.
+    Пересборка базы с другими параметрами пар (target_zone_size и др.)
+    повторяет только генерацию пар, с другим порогом пиков - еще STFT,
+    но без декодирования.
+    """
+    
+    def __init__(self, cache_dir: str, store_audio: bool = True):
+        """
+        Args:
+            cache_dir: Директория кеша (создается при необходимости)
+            store_audio: Сохранять ли декодированный сигнал (занимает больше
+                         всего места: около 5 МБ на минуту при 22050 Гц)
+        """
+        self.cache_dir = cache_dir
+        self.store_audio = store_audio
+        os.makedirs(cache_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def file_digest(file_path: str) -> str:
+        """Хеш содержимого файла (hex)"""
+        digest = hashlib.blake2b(digest_size=16)
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    def _path(self, digest: str, kind: str, params: tuple, extension: str) -> str:
+        """Путь к файлу кеша для этапа kind с параметрами params"""
+        params_digest = hashlib.blake2b(repr(params).encode(), digest_size=8).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.{kind}.{params_digest}{extension}")
+    
+    def _load(self, path: str, load: Callable[[str], Any]) -> Any:
+        """Чтение файла кеша, None - если его нет или он поврежден"""
+        try:
+            value = load(path)
+        except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+    
+    def _save(self, path: str, save: Callable[[Any], None]):
+        """Атомарная запись: параллельные воркеры не увидят недописанный файл"""
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                save(file)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    
+    def load_audio(self, digest: str, params: tuple) -> Optional[np.ndarray]:
+        """Декодированный сигнал или None"""
+        if not self.store_audio:
+            return None
+        return self._load(self._path(digest, 'audio', params, '.npy'), np.load)
+    
+    def save_audio(self, digest: str, params: tuple, audio_data: np.ndarray):
+        """Сохранение декодированного сигнала"""
+        if self.store_audio:
+            self._save(self._path(digest, 'audio', params, '.npy'),
+                       lambda file: np.save(file, audio_data.astype(np.float32, copy=False)))
+    
+    def load_peaks(self, digest: str, params: tuple) -> Optional[Tuple[np.ndarray, np.ndarray, int]]:
+        """Пики (частотные бины, временные бины) и число отсчетов сигнала или None"""
+        def load(path):
+            with np.load(path) as data:
+                return (data['freq_bins'].astype(np.int64), data['time_bins'].astype(np.int64),
+                        int(data['samples']))
+        return self._load(self._path(digest, 'peaks', params, '.npz'), load)
+    
+    def save_peaks(self, digest: str, params: tuple, freq_bins: np.ndarray,
+                   time_bins: np.ndarray, samples: int):
+        """Сохранение пиков в компактных типах (uint16 для частот, int32 для времени)"""
+        self._save(self._path(digest, 'peaks', params, '.npz'),
+                   lambda file: np.savez(file, freq_bins=np.asarray(freq_bins, dtype=np.uint16),
+                                         time_bins=np.asarray(time_bins, dtype=np.int32),
+                                         samples=np.int64(samples)))
+    
+    def stats(self) -> Dict[str, float]:
+        """
+        Статистика кеша
+        
+        Returns:
+            Словарь: hits, misses, files, size_mb
+        """
+        sizes = [entry.stat().st_size for entry in os.scandir(self.cache_dir)
+                 if entry.is_file() and not entry.name.endswith('.tmp')]
+        return {'hits': self.hits, 'misses': self.misses, 'files': len(sizes),
+                'size_mb': sum(sizes) / (1 << 20)}
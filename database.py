@@ -4,27 +4,347 @@
 import sqlite3
 import json
 import os
+import itertools
+import threading
+import time
 import numpy as np
-from typing import Dict, List, Tuple, Optional
-from fingerprint import AudioFingerprint
+from typing import Any, Dict, List, Tuple, Optional, Union, Iterable
+from fingerprint import AudioFingerprint, Fingerprint, HASH_MODE_PACKED, HASH_MODE_MD5, HASH_MODES
+from index import InMemoryIndex, MemmapIndex, write_index_file
+import metrics
+
+# Режимы оценки совпадений в search_song
+SCORING_COUNT = 'count'    # доля совпавших хешей
+SCORING_OFFSET = 'offset'  # пик гистограммы временных сдвигов
+SCORING_MODES = (SCORING_COUNT, SCORING_OFFSET)
+
+# Способы поиска по хешам: SQL запросы, индекс в памяти или файл индекса
+BACKEND_SQLITE = 'sqlite'
+BACKEND_MEMORY = 'memory'
+BACKEND_MMAP = 'mmap'
+BACKENDS = (BACKEND_SQLITE, BACKEND_MEMORY, BACKEND_MMAP)
+
+# Схема таблицы отпечатков: 1 - строка с AUTOINCREMENT id и индексами по хешу
+# и песне, 2 - таблица WITHOUT ROWID, упорядоченная по (хеш, песня, время), и
+# индекс по песне для удаления и догрузки песен (только для целочисленных хешей)
+SCHEMA_V1 = 1
+SCHEMA_V2 = 2
+SCHEMA_VERSIONS = (SCHEMA_V1, SCHEMA_V2)
+
+# Что делать при поиске с частыми хешами из стоп-листа (см. build_stop_list)
+STOP_OFF = 'off'        # не учитывать стоп-лист
+STOP_SKIP = 'skip'      # не искать такие хеши в базе и не учитывать в запросе
+STOP_WEIGHT = 'weight'  # искать, но с весом limit / число_песен
+STOP_MODES = (STOP_OFF, STOP_SKIP, STOP_WEIGHT)
+
+# Максимальное число параметров в одном SQL запросе (лимит старых SQLite)
+SQL_PARAMS_LIMIT = 999
+
+# Сколько строк читать из SQLite за один раз при выгрузке отпечатков
+FETCH_CHUNK_ROWS = 500_000
+
+# Настройки соединений по умолчанию
+DEFAULT_CACHE_SIZE_KB = 64 * 1024       # кеш страниц на соединение
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024   # отображение файла базы в память
+STATEMENT_CACHE_SIZE = 256              # кеш подготовленных запросов
+
+def score_offset_alignment(query_hashes: np.ndarray, query_offsets: np.ndarray,
+                           match_hashes: np.ndarray, match_song_ids: np.ndarray,
+                           match_offsets: np.ndarray, bin_size: int = 1,
+                           match_weights: Optional[np.ndarray] = None
+                           ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Оценка песен по гистограмме временных сдвигов
+    
+    Для каждой пары (строка базы, хеш запроса с тем же значением) считается
+    сдвиг db_offset - query_offset. У совпадающей песни большинство пар дают
+    один и тот же сдвиг, а случайные совпадения размазываются по гистограмме.
+    
+    Args:
+        query_hashes: Хеши запроса
+        query_offsets: Время опорных пиков запроса (в кадрах)
+        match_hashes: Хеши найденных в базе строк
+        match_song_ids: ID песен найденных строк
+        match_offsets: Время опорных пиков найденных строк (в кадрах)
+        bin_size: Ширина бина гистограммы в кадрах
+        match_weights: Веса найденных строк (None - у всех 1), см. stop_weights
+        
+    Returns:
+        Кортеж массивов (song_ids, scores, offsets): для каждой песни высота
+        пикового бина и соответствующий сдвиг в кадрах
+    """
+    empty = np.array([], dtype=np.int64)
+    if len(query_hashes) == 0 or len(match_hashes) == 0:
+        return empty, empty, empty
+    
+    row_idx, pair_offsets = _match_pairs(query_hashes, query_offsets, match_hashes)
+    song_ids = np.asarray(match_song_ids, dtype=np.int64)[row_idx]
+    deltas = np.asarray(match_offsets, dtype=np.int64)[row_idx] - pair_offsets
+    weights = None if match_weights is None else np.asarray(match_weights)[row_idx]
+    return best_offsets(song_ids, deltas, bin_size, weights)
+
+def offset_matches(query_hashes: np.ndarray, query_offsets: np.ndarray,
+                   match_hashes: np.ndarray, match_song_ids: np.ndarray,
+                   match_offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Все пары (строка базы, хеш запроса с тем же значением)
+    
+    Args:
+        query_hashes: Хеши запроса
+        query_offsets: Время опорных пиков запроса (в кадрах)
+        match_hashes: Хеши найденных в базе строк
+        match_song_ids: ID песен найденных строк
+        match_offsets: Время опорных пиков найденных строк (в кадрах)
+        
+    Returns:
+        Кортеж массивов (song_ids, deltas, query_offsets) по парам:
+        песня, сдвиг db_offset - query_offset и время опорного пика запроса
+    """
+    empty = np.array([], dtype=np.int64)
+    if len(query_hashes) == 0 or len(match_hashes) == 0:
+        return empty, empty, empty
+    
+    row_idx, pair_offsets = _match_pairs(query_hashes, query_offsets, match_hashes)
+    song_ids = np.asarray(match_song_ids, dtype=np.int64)[row_idx]
+    deltas = np.asarray(match_offsets, dtype=np.int64)[row_idx] - pair_offsets
+    return song_ids, deltas, pair_offsets
+
+def _match_pairs(query_hashes: np.ndarray, query_offsets: np.ndarray,
+                 match_hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Пары с одинаковым хешем: индекс строки базы и время опорного пика запроса"""
+    # Для каждой строки базы находим диапазон одинаковых хешей в запросе
+    order = np.argsort(query_hashes, kind='stable')
+    sorted_hashes = query_hashes[order]
+    sorted_offsets = np.asarray(query_offsets, dtype=np.int64)[order]
+    left = np.searchsorted(sorted_hashes, match_hashes, side='left')
+    counts = np.searchsorted(sorted_hashes, match_hashes, side='right') - left
+    
+    # Разворачиваем пары (строка базы, позиция запроса)
+    row_idx = np.repeat(np.arange(len(match_hashes)), counts)
+    starts = np.repeat(left - np.cumsum(counts) + counts, counts)
+    query_idx = np.arange(len(row_idx)) + starts
+    return row_idx, sorted_offsets[query_idx]
+
+def best_offsets(song_ids: np.ndarray, deltas: np.ndarray, bin_size: int = 1,
+                 weights: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Пиковый бин гистограммы сдвигов для каждой песни
+    
+    Args:
+        song_ids: ID песен пар (см. offset_matches)
+        deltas: Сдвиги пар в кадрах
+        bin_size: Ширина бина гистограммы в кадрах
+        weights: Веса пар (None - каждая пара дает 1 голос)
+        
+    Returns:
+        Кортеж массивов (song_ids, scores, offsets), как у score_offset_alignment
+    """
+    empty = np.array([], dtype=np.int64)
+    if len(song_ids) == 0:
+        return empty, empty, empty
+    
+    deltas = np.floor_divide(deltas, bin_size)
+    
+    # Один ключ на пару (песня, бин сдвига)
+    delta_min = deltas.min()
+    span = int(deltas.max() - delta_min) + 1
+    if weights is None:
+        keys, key_counts = np.unique(song_ids * span + (deltas - delta_min), return_counts=True)
+    else:
+        keys, key_index = np.unique(song_ids * span + (deltas - delta_min), return_inverse=True)
+        key_counts = np.bincount(key_index, weights=weights, minlength=len(keys))
+    key_songs = keys // span
+    
+    # Для каждой песни берем самый высокий бин
+    best = np.lexsort((key_counts, key_songs))
+    last_of_song = np.r_[key_songs[best][1:] != key_songs[best][:-1], True]
+    best = best[last_of_song]
+    
+    best_deltas = (keys[best] % span + delta_min) * bin_size
+    return key_songs[best], key_counts[best], best_deltas
 
 class FingerprintDatabase:
     """Класс для работы с базой данных отпечатков"""
     
-    def __init__(self, db_path: str = "fingerprints.db"):
+    def __init__(self, db_path: str = "fingerprints.db", hash_mode: str = HASH_MODE_PACKED,
+                 cache_size_kb: int = DEFAULT_CACHE_SIZE_KB, mmap_size: int = DEFAULT_MMAP_SIZE,
+                 synchronous: str = 'NORMAL', backend: str = BACKEND_SQLITE,
+                 refresh_interval: Optional[float] = None, index_path: Optional[str] = None,
+                 stop_mode: str = STOP_SKIP, schema_version: int = SCHEMA_V2,
+                 fingerprint_system: Optional[AudioFingerprint] = None):
         """
         Инициализация базы данных
         
+        Соединения с базой долгоживущие: у каждого потока свое соединение,
+        которое открывается при первом обращении и живет до close().
+        База работает в режиме WAL, поэтому чтение не блокируется записью.
+        
         Args:
             db_path: Путь к файлу базы данных
+            hash_mode: Режим хеширования для новой базы ('packed' или 'md5').
+                       Для существующей базы используется ее собственный режим
+            cache_size_kb: Размер кеша страниц SQLite на соединение (КБ)
+            mmap_size: Размер отображения файла базы в память (байт), 0 - выключено
+            synchronous: Режим PRAGMA synchronous ('OFF', 'NORMAL', 'FULL')
+            backend: Поиск по хешам: 'sqlite' - SQL запросами, 'memory' - по
+                     инвертированному индексу, загруженному из базы в память,
+                     'mmap' - по файлу индекса (см. export_index), отображенному в память
+            refresh_interval: Как часто (в секундах) обновлять индекс при поиске:
+                              для 'memory' - догружать новые песни, для 'mmap' -
+                              переоткрывать файл. None - только через refresh_index()
+            index_path: Путь к файлу индекса для backend='mmap'
+            stop_mode: Как учитывать при поиске стоп-лист частых хешей:
+                       'skip', 'weight' или 'off' (пока стоп-лист не построен,
+                       ни на что не влияет)
+            schema_version: Схема таблицы отпечатков для новой базы (1 или 2).
+                            Для MD5-хешей всегда 1, существующая база сохраняет
+                            свою схему (см. upgrade_schema)
+            fingerprint_system: Система отпечатков, с которой строилась база
+                                (параметры STFT нужны для перевода сдвигов в секунды
+                                и воркерам bulk_ingest). По умолчанию - стандартная
+                                в режиме хешей базы
         """
+        if hash_mode not in HASH_MODES:
+            raise ValueError(f"Неизвестный режим хеширования: {hash_mode}")
+        if backend not in BACKENDS:
+            raise ValueError(f"Неизвестный способ поиска: {backend}")
+        if stop_mode not in STOP_MODES:
+            raise ValueError(f"Неизвестный режим стоп-листа: {stop_mode}")
+        if schema_version not in SCHEMA_VERSIONS:
+            raise ValueError(f"Неизвестная схема таблицы отпечатков: {schema_version}")
+        
         self.db_path = db_path
-        self.fingerprint_system = AudioFingerprint()
+        self.hash_mode = hash_mode
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.synchronous = synchronous
+        self.stop_mode = stop_mode
+        self.schema_version = schema_version
+        
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        # Счетчик изменений каталога через этот объект и отдельное соединение,
+        # по PRAGMA data_version которого видны изменения от других соединений
+        self._catalog_changes = 0
+        self._watch_conn = None
+        self._watch_lock = threading.Lock()
+        
         self.init_database()
+        if fingerprint_system is None:
+            fingerprint_system = AudioFingerprint(hash_mode=self.hash_mode)
+        elif fingerprint_system.hash_mode != self.hash_mode:
+            raise ValueError(f"Режим хешей {fingerprint_system.hash_mode} не совпадает "
+                             f"с режимом базы {self.hash_mode}")
+        self.fingerprint_system = fingerprint_system
+        self._load_stop_list()
+        
+        self.backend = backend
+        self.refresh_interval = refresh_interval
+        self.index = None
+        if backend == BACKEND_MEMORY:
+            self.index = InMemoryIndex.load(self)
+        elif backend == BACKEND_MMAP:
+            if index_path is None:
+                raise ValueError("Для backend='mmap' нужно указать index_path")
+            self.index = MemmapIndex(index_path)
+        self._index_refreshed_at = time.monotonic()
+    
+    def refresh_index(self, blocking: bool = True) -> int:
+        """
+        Обновление индекса: догрузка новых песен ('memory') или
+        переоткрытие файла индекса ('mmap')
+        
+        Args:
+            blocking: Ждать, пока закончится обновление, начатое другим потоком
+                      (False - сразу вернуть 0 и искать по текущему индексу)
+        
+        Returns:
+            Число добавленных строк (0 для backend='sqlite')
+        """
+        if self.index is None:
+            return 0
+        
+        self._index_refreshed_at = time.monotonic()
+        added = self.index.refresh(self, blocking)
+        self._index_refreshed_at = time.monotonic()
+        return added
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Соединение текущего потока (создается при первом обращении)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # check_same_thread=False нужен только для закрытия из close(),
+            # работает с соединением по-прежнему только его поток
+            conn = sqlite3.connect(self.db_path, timeout=30.0, check_same_thread=False,
+                                   cached_statements=STATEMENT_CACHE_SIZE)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'PRAGMA synchronous={self.synchronous}')
+            conn.execute(f'PRAGMA cache_size=-{int(self.cache_size_kb)}')
+            conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+    
+    def close(self):
+        """Закрытие всех соединений с базой данных"""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+        with self._watch_lock:
+            if self._watch_conn is not None:
+                self._watch_conn.close()
+                self._watch_conn = None
+    
+    @property
+    def catalog_version(self) -> Tuple[int, int]:
+        """
+        Версия каталога: меняется при любом изменении песен или отпечатков
+        
+        Первая часть - число изменений через этот объект (add_song, delete_song,
+        clear_database...), вторая - PRAGMA data_version отдельного соединения,
+        которая меняется после записи в базу любым другим соединением,
+        в том числе из другого процесса.
+        """
+        with self._watch_lock:
+            if self._watch_conn is None:
+                self._watch_conn = sqlite3.connect(self.db_path, timeout=30.0, check_same_thread=False)
+            data_version = self._watch_conn.execute('PRAGMA data_version').fetchone()[0]
+        return self._catalog_changes, data_version
+    
+    def _catalog_changed(self):
+        """Отметка об изменении каталога (после фиксации транзакции)"""
+        self._catalog_changes += 1
+    
+    def __enter__(self) -> 'FingerprintDatabase':
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    @staticmethod
+    def _in_chunks(values: list) -> Iterable[Tuple[str, list]]:
+        """
+        Разбиение значений для IN (...) на порции
+        
+        Размер порции округляется вверх до степени двойки повтором первого
+        значения: текстов SQL получается немного, и подготовленные запросы
+        переиспользуются из кеша sqlite3.
+        """
+        for start in range(0, len(values), SQL_PARAMS_LIMIT):
+            chunk = values[start:start + SQL_PARAMS_LIMIT]
+            size = min(SQL_PARAMS_LIMIT, 1 << (len(chunk) - 1).bit_length())
+            chunk = chunk + chunk[:1] * (size - len(chunk))
+            yield ','.join('?' * size), chunk
     
     def init_database(self):
         """Инициализация структуры базы данных"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         # Создаем таблицу для песен
@@ -35,16 +355,108 @@ class FingerprintDatabase:
                 artist TEXT,
                 file_path TEXT,
                 duration REAL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                fingerprint_count INTEGER NOT NULL DEFAULT 0
             )
         ''')
         
-        # Создаем таблицу для отпечатков
+        # Служебные параметры базы (режим хеширования и т.п.)
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS fingerprints (
+            CREATE TABLE IF NOT EXISTS metadata (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        
+        column_type = self._get_hash_column_type(cursor)
+        cursor.execute("SELECT value FROM metadata WHERE key = 'hash_mode'")
+        row = cursor.fetchone()
+        if row is not None:
+            self.hash_mode = row[0]
+        else:
+            # Старые базы без metadata хранят MD5-хеши в колонке TEXT
+            if column_type is not None:
+                self.hash_mode = HASH_MODE_PACKED if column_type == 'INTEGER' else HASH_MODE_MD5
+            cursor.execute("INSERT INTO metadata (key, value) VALUES ('hash_mode', ?)",
+                           (self.hash_mode,))
+        
+        cursor.execute("SELECT value FROM metadata WHERE key = 'schema_version'")
+        row = cursor.fetchone()
+        if row is not None:
+            self.schema_version = int(row[0])
+        else:
+            # Базы без schema_version, где уже есть отпечатки, созданы по схеме 1
+            if column_type is not None or self.hash_mode != HASH_MODE_PACKED:
+                self.schema_version = SCHEMA_V1
+            cursor.execute("INSERT INTO metadata (key, value) VALUES ('schema_version', ?)",
+                           (str(self.schema_version),))
+        
+        self._create_fingerprints_table(cursor, 'fingerprints', self.hash_mode, self.schema_version)
+        self._create_stop_table(cursor, self.hash_mode)
+        cursor.execute('PRAGMA table_info(fingerprints)')
+        self._store_frequency = 'frequency_bin' in [column[1] for column in cursor.fetchall()]
+        
+        # Старые базы: добавляем счетчик отпечатков песни и заполняем его
+        cursor.execute('PRAGMA table_info(songs)')
+        if 'fingerprint_count' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE songs ADD COLUMN fingerprint_count INTEGER NOT NULL DEFAULT 0')
+            self._refresh_fingerprint_counts(cursor)
+        
+        conn.commit()
+    
+    @staticmethod
+    def _get_hash_column_type(cursor: sqlite3.Cursor) -> Optional[str]:
+        """Тип колонки hash_value или None, если таблицы отпечатков еще нет"""
+        cursor.execute('PRAGMA table_info(fingerprints)')
+        for _, column_name, column_type, *_ in cursor.fetchall():
+            if column_name == 'hash_value':
+                return column_type.upper()
+        return None
+    
+    @staticmethod
+    def _refresh_fingerprint_counts(cursor: sqlite3.Cursor):
+        """Пересчет songs.fingerprint_count по таблице отпечатков"""
+        # Один проход GROUP BY вместо подзапроса на каждую песню
+        cursor.execute('SELECT song_id, COUNT(*) FROM fingerprints GROUP BY song_id')
+        counts = cursor.fetchall()
+        cursor.execute('UPDATE songs SET fingerprint_count = 0')
+        cursor.executemany('UPDATE songs SET fingerprint_count = ? WHERE id = ?',
+                           [(count, song_id) for song_id, count in counts])
+    
+    @staticmethod
+    def _create_fingerprints_table(cursor: sqlite3.Cursor, table: str, hash_mode: str,
+                                   schema_version: int = SCHEMA_V1, indexes: bool = True):
+        """
+        Создание таблицы отпечатков и индексов к ней
+        
+        indexes=False - без индекса по песне: при заполнении таблицы целиком
+        его быстрее построить после вставки (_create_song_index)
+        """
+        hash_type = 'INTEGER' if hash_mode == HASH_MODE_PACKED else 'TEXT'
+        
+        if schema_version == SCHEMA_V2:
+            # Строки хранятся в порядке хеша: поиск по хешу читает соседние
+            # страницы, без перехода по rowid. Индекс по песне нужен удалению
+            # песни и догрузке новых песен, иначе оба читали бы всю таблицу.
+            # Частота опорного пика не хранится - она есть в хеше (unpack_hashes)
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    hash_value INTEGER NOT NULL,
+                    song_id INTEGER NOT NULL,
+                    time_offset INTEGER NOT NULL,
+                    PRIMARY KEY (hash_value, song_id, time_offset)
+                ) WITHOUT ROWID
+            ''')
+            if indexes:
+                FingerprintDatabase._create_song_index(cursor, table)
+            return
+        
+        # Создаем таблицу для отпечатков
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 song_id INTEGER,
-                hash_value TEXT NOT NULL,
+                hash_value {hash_type} NOT NULL,
                 time_offset INTEGER,
                 frequency_bin INTEGER,
                 FOREIGN KEY (song_id) REFERENCES songs (id)
@@ -52,11 +464,41 @@ class FingerprintDatabase:
         ''')
         
         # Создаем индексы для быстрого поиска
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_hash ON fingerprints (hash_value)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_song_id ON fingerprints (song_id)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_hash ON {table} (hash_value)')
+        FingerprintDatabase._create_song_index(cursor, table)
+    
+    @staticmethod
+    def _create_song_index(cursor: sqlite3.Cursor, table: str = 'fingerprints'):
+        """Индекс отпечатков по песне (имя общее для схем 1 и 2)"""
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_song_id ON {table} (song_id)')
+    
+    @staticmethod
+    def _create_stop_table(cursor: sqlite3.Cursor, hash_mode: str):
+        """Создание таблицы стоп-листа: частые хеши и число песен, в которых они есть"""
+        hash_type = 'INTEGER' if hash_mode == HASH_MODE_PACKED else 'TEXT'
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS stop_hashes (
+                hash_value {hash_type} PRIMARY KEY,
+                song_count INTEGER NOT NULL
+            )
+        ''')
+    
+    def _load_stop_list(self):
+        """Чтение стоп-листа и его параметров из базы"""
+        cursor = self._connect().cursor()
+        cursor.execute('SELECT hash_value, song_count FROM stop_hashes')
+        rows = cursor.fetchall()
+        hash_type = np.int64 if self.hash_mode == HASH_MODE_PACKED else 'U32'
+        hashes = np.array([hash_value for hash_value, _ in rows], dtype=hash_type)
+        song_counts = np.array([song_count for _, song_count in rows], dtype=np.int64)
+        # Отсортированный массив - для searchsorted в stop_weights
+        order = np.argsort(hashes)
+        self.stop_hashes, self.stop_song_counts = hashes[order], song_counts[order]
         
-        conn.commit()
-        conn.close()
+        cursor.execute("SELECT key, value FROM metadata WHERE key IN ('stop_limit', 'stop_prune')")
+        settings = dict(cursor.fetchall())
+        self.stop_limit = int(settings.get('stop_limit', 0))
+        self.stop_prune = settings.get('stop_prune') == '1'
     
     def add_song(self, name: str, artist: str = None, file_path: str = None, 
                  duration: float = None) -> int:
@@ -72,45 +514,137 @@ class FingerprintDatabase:
         Returns:
             ID добавленной песни
         """
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
+        song_id = self._insert_song(cursor, name, artist, file_path, duration)
+        conn.commit()
+        self._catalog_changed()
+        
+        return song_id
+    
+    @staticmethod
+    def _insert_song(cursor: sqlite3.Cursor, name: str, artist: Optional[str],
+                     file_path: Optional[str], duration: Optional[float]) -> int:
+        """Вставка строки песни без фиксации транзакции"""
         cursor.execute('''
             INSERT INTO songs (name, artist, file_path, duration)
             VALUES (?, ?, ?, ?)
         ''', (name, artist, file_path, duration))
+        return cursor.lastrowid
+    
+    @staticmethod
+    def _fingerprint_rows(song_id: int, fingerprint: Union[Fingerprint, np.ndarray],
+                          with_frequency: bool = True) -> Iterable[tuple]:
+        """
+        Строки (song_id, hash_value, time_offset[, frequency_bin]) для вставки:
+        время и частотный бин опорного пика
         
-        song_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        Структурированный массив отдается по колонкам, без промежуточного
+        списка кортежей.
+        """
+        if isinstance(fingerprint, np.ndarray):
+            columns = [itertools.repeat(song_id), fingerprint['hash'].tolist(),
+                       fingerprint['anchor_time'].tolist()]
+            if with_frequency:
+                columns.append(fingerprint['anchor_freq'].tolist())
+            return zip(*columns)
         
-        return song_id
+        if with_frequency:
+            return ((song_id, hash_value, time_offset, frequency_bin)
+                    for hash_value, positions in fingerprint.items()
+                    for time_offset, frequency_bin in positions)
+        return ((song_id, hash_value, time_offset)
+                for hash_value, positions in fingerprint.items()
+                for time_offset, _ in positions)
     
-    def add_fingerprint(self, song_id: int, fingerprint: Dict[str, List[Tuple[int, int]]]):
+    def add_fingerprint(self, song_id: int, fingerprint: Union[Fingerprint, np.ndarray]):
         """
         Добавление отпечатка в базу данных
         
         Args:
             song_id: ID песни
-            fingerprint: Отпечаток песни
+            fingerprint: Отпечаток песни (словарь или структурированный массив)
         """
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
-        # Подготавливаем данные для вставки
-        fingerprint_data = []
-        for hash_value, positions in fingerprint.items():
-            for time_offset, frequency_bin in positions:
-                fingerprint_data.append((song_id, hash_value, time_offset, frequency_bin))
+        self._insert_fingerprint(cursor, song_id, fingerprint)
         
-        # Вставляем данные пакетами
-        cursor.executemany('''
-            INSERT INTO fingerprints (song_id, hash_value, time_offset, frequency_bin)
-            VALUES (?, ?, ?, ?)
-        ''', fingerprint_data)
+        conn.commit()
+        self._catalog_changed()
+    
+    def _insert_fingerprint(self, cursor: sqlite3.Cursor, song_id: int,
+                            fingerprint: Union[Fingerprint, np.ndarray]):
+        """Вставка отпечатка песни без фиксации транзакции"""
+        if self.stop_prune and len(self.stop_hashes):
+            fingerprint = self._without_stop_hashes(fingerprint)
+        
+        # Вставляем данные пакетами (в схеме 2 повтор ключа (хеш, песня, время)
+        # не ошибка: такая строка уже есть)
+        if self._store_frequency:
+            columns, values = 'song_id, hash_value, time_offset, frequency_bin', '?, ?, ?, ?'
+        else:
+            columns, values = 'song_id, hash_value, time_offset', '?, ?, ?'
+        cursor.executemany(f'''
+            INSERT {self._insert_verb} INTO fingerprints ({columns})
+            VALUES ({values})
+        ''', self._fingerprint_rows(song_id, fingerprint, self._store_frequency))
+        
+        # Поддерживаем счетчик отпечатков песни в той же транзакции
+        cursor.execute('UPDATE songs SET fingerprint_count = fingerprint_count + ? WHERE id = ?',
+                       (cursor.rowcount, song_id))
+    
+    @property
+    def _insert_verb(self) -> str:
+        """Вставка строк отпечатков: в схеме 2 - с пропуском повторов"""
+        return 'OR IGNORE' if self.schema_version == SCHEMA_V2 else ''
+    
+    def _without_stop_hashes(self, fingerprint: Union[Fingerprint, np.ndarray]) -> Union[Fingerprint, np.ndarray]:
+        """Отпечаток без хешей из стоп-листа"""
+        if isinstance(fingerprint, np.ndarray):
+            return fingerprint[~self._stop_mask(fingerprint['hash'])[0]]
+        
+        stop = set(self.stop_hashes.tolist())
+        return {hash_value: positions for hash_value, positions in fingerprint.items()
+                if hash_value not in stop}
+    
+    def add_songs_batch(self, songs: List[Tuple[str, Optional[str], Optional[str], Optional[float],
+                                               Union[Fingerprint, np.ndarray]]]) -> List[int]:
+        """
+        Добавление нескольких песен с отпечатками одной транзакцией
+        
+        Если вставка прервется, в базе не останется ни одной песни из пакета.
+        
+        Args:
+            songs: Список кортежей (название, исполнитель, путь_к_файлу, длительность, отпечаток)
+            
+        Returns:
+            Список ID добавленных песен
+        """
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        song_ids = []
+        try:
+            for name, artist, file_path, duration, fingerprint in songs:
+                song_id = self._insert_song(cursor, name, artist, file_path, duration)
+                self._insert_fingerprint(cursor, song_id, fingerprint)
+                song_ids.append(song_id)
+        except Exception:
+            conn.rollback()
+            raise
         
         conn.commit()
-        conn.close()
+        self._catalog_changed()
+        return song_ids
+    
+    def get_song_paths(self) -> set:
+        """Множество путей к файлам уже добавленных песен"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT file_path FROM songs WHERE file_path IS NOT NULL')
+        return {file_path for (file_path,) in cursor.fetchall()}
     
     def add_song_with_fingerprint(self, name: str, audio_data: np.ndarray, 
                                  artist: str = None, file_path: str = None) -> int:
@@ -127,7 +661,7 @@ class FingerprintDatabase:
             ID добавленной песни
         """
         # Создаем отпечаток
-        fingerprint = self.fingerprint_system.create_fingerprint(audio_data)
+        fingerprint = self.fingerprint_system.create_fingerprint_array(audio_data)
         
         # Добавляем песню
         song_id = self.add_song(name, artist, file_path)
@@ -155,76 +689,489 @@ class FingerprintDatabase:
         if name is None:
             name = os.path.splitext(os.path.basename(file_path))[0]
         
-        # Загружаем аудио
-        audio_data = self.fingerprint_system.audio_processor.load_audio_file(file_path)
+        # Создаем отпечаток (через кеш файлов, если он задан у системы отпечатков)
+        fingerprint = self.fingerprint_system.create_fingerprint_array_from_file(file_path)
         
-        return self.add_song_with_fingerprint(name, audio_data, artist, file_path)
+        song_id = self.add_song(name, artist, file_path)
+        self.add_fingerprint(song_id, fingerprint)
+        return song_id
+    
+    @staticmethod
+    def _query_arrays(query_fingerprint: Union[Fingerprint, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """Хеши и время опорных пиков запроса в виде массивов"""
+        if isinstance(query_fingerprint, np.ndarray):
+            return query_fingerprint['hash'], query_fingerprint['anchor_time']
+        
+        hashes, offsets = [], []
+        for hash_value, positions in query_fingerprint.items():
+            for anchor_time, _ in positions:
+                hashes.append(hash_value)
+                offsets.append(anchor_time)
+        return np.array(hashes), np.array(offsets, dtype=np.int64)
     
-    def search_song(self, query_fingerprint: Dict[str, List[Tuple[int, int]]], 
-                   threshold: float = 0.1) -> List[Tuple[str, str, float]]:
+    def lookup_hashes(self, hashes: Iterable) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         """
-        Поиск песни по отпечатку
+        Поиск строк отпечатков по набору хешей
         
         Args:
-            query_fingerprint: Отпечаток запроса
-            threshold: Минимальный порог схожести
+            hashes: Уникальные хеши
             
         Returns:
-            Список кортежей (название, исполнитель, коэффициент_схожести)
+            Кортеж массивов (hash_values, song_ids, time_offsets) найденных строк
         """
-        conn = sqlite3.connect(self.db_path)
+        if self.stop_mode == STOP_SKIP and len(self.stop_hashes):
+            hashes = self.filter_stop_hashes(hashes)
+        
+        if self.index is not None:
+            if (self.refresh_interval is not None and
+                    time.monotonic() - self._index_refreshed_at >= self.refresh_interval):
+                # Обновляет один поток, остальные ищут по текущему индексу
+                self.refresh_index(blocking=False)
+            return self.index.lookup(hashes)
+        
+        hashes = list(hashes)
+        if self.hash_mode == HASH_MODE_PACKED:
+            # sqlite3 не умеет связывать numpy.int64, приводим к int
+            hashes = [int(hash_value) for hash_value in hashes]
+        
+        conn = self._connect()
         cursor = conn.cursor()
         
-        # Получаем все хеши из запроса
-        query_hashes = set(query_fingerprint.keys())
+        rows = []
+        for placeholders, chunk in self._in_chunks(hashes):
+            cursor.execute(f'''
+                SELECT hash_value, song_id, time_offset
+                FROM fingerprints
+                WHERE hash_value IN ({placeholders})
+            ''', chunk)
+            rows.extend(cursor.fetchall())
         
-        if not query_hashes:
-            return []
+        return self._rows_to_arrays(rows)
+    
+    def filter_stop_hashes(self, hashes: Iterable) -> np.ndarray:
+        """
+        Хеши без тех, что входят в стоп-лист
+        
+        Args:
+            hashes: Хеши
+            
+        Returns:
+            Массив оставшихся хешей (в исходном порядке)
+        """
+        hashes = np.asarray(hashes if isinstance(hashes, np.ndarray) else list(hashes))
+        if len(self.stop_hashes) == 0 or len(hashes) == 0:
+            return hashes
+        return hashes[~self._stop_mask(hashes)[0]]
+    
+    def stop_weights(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        Веса хешей для режима 'weight': 1 для обычных, stop_limit / число_песен
+        для хешей из стоп-листа (чем чаще хеш, тем меньше вес)
         
-        # Создаем плейсхолдеры для SQL запроса
-        placeholders = ','.join(['?' for _ in query_hashes])
+        Args:
+            hashes: Хеши
+            
+        Returns:
+            Массив весов (float64)
+        """
+        weights = np.ones(len(hashes))
+        if len(self.stop_hashes) == 0 or len(hashes) == 0:
+            return weights
+        found, position = self._stop_mask(hashes)
+        weights[found] = self.stop_limit / self.stop_song_counts[position[found]]
+        return weights
+    
+    def _stop_mask(self, hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Какие хеши входят в стоп-лист: маска и позиции в stop_hashes
         
-        # Ищем совпадающие хеши
-        cursor.execute(f'''
-            SELECT DISTINCT s.id, s.name, s.artist, f.hash_value, f.time_offset
-            FROM songs s
-            JOIN fingerprints f ON s.id = f.song_id
-            WHERE f.hash_value IN ({placeholders})
-        ''', list(query_hashes))
-        
-        results = cursor.fetchall()
-        conn.close()
-        
-        # Группируем результаты по песням
-        song_matches = {}
-        for song_id, name, artist, hash_value, time_offset in results:
-            if song_id not in song_matches:
-                song_matches[song_id] = {
-                    'name': name,
-                    'artist': artist,
-                    'matches': 0,
-                    'total_hashes': 0
-                }
+        Стоп-лист отсортирован, поэтому двоичный поиск по нему дешевле np.isin,
+        который на каждый запрос сортирует весь стоп-лист заново.
+        """
+        position = np.minimum(np.searchsorted(self.stop_hashes, hashes), len(self.stop_hashes) - 1)
+        return self.stop_hashes[position] == hashes, position
+    
+    def build_stop_list(self, max_song_fraction: float = 0.01, min_songs: int = 2,
+                        prune: bool = False) -> Dict[str, object]:
+        """
+        Построение стоп-листа частых хешей
+        
+        Для каждого хеша считается число песен каталога, в которых он встречается.
+        Хеши, которые есть больше чем в limit = max(min_songs, max_song_fraction *
+        число_песен) песнях (тишина, гул, распространенные аккорды), попадают
+        в стоп-лист: при поиске они пропускаются или получают меньший вес
+        (см. stop_mode), а с prune=True еще и удаляются из базы, в том числе
+        из отпечатков песен, добавленных позже.
+        
+        После удаления строк индекс backend='memory' перезагружается,
+        файл индекса для 'mmap' нужно выгрузить заново (export_index).
+        
+        Args:
+            max_song_fraction: Доля песен каталога, начиная с которой хеш считается частым
+            min_songs: Минимальный порог по числу песен (для маленьких каталогов)
+            prune: Удалить строки частых хешей из таблицы отпечатков
+            
+        Returns:
+            Словарь со статистикой: songs, limit, stop_hashes - размер стоп-листа,
+            stop_rows - строк отпечатков с этими хешами, total_rows - всего строк,
+            pruned_rows - удалено строк
+        """
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT COUNT(*) FROM songs')
+        song_count = cursor.fetchone()[0]
+        limit = max(min_songs, int(max_song_fraction * song_count))
+        
+        # Удаленные раньше хеши в таблице отпечатков уже не встречаются,
+        # поэтому при включенном удалении старый стоп-лист дополняется, а не заменяется
+        if not self.stop_prune:
+            cursor.execute('DELETE FROM stop_hashes')
+        cursor.execute('''
+            INSERT OR REPLACE INTO stop_hashes (hash_value, song_count)
+            SELECT hash_value, COUNT(DISTINCT song_id) FROM fingerprints
+            GROUP BY hash_value HAVING COUNT(DISTINCT song_id) > ?
+        ''', (limit,))
+        
+        cursor.execute('SELECT COUNT(*) FROM fingerprints')
+        total_rows = cursor.fetchone()[0]
+        cursor.execute('''
+            SELECT COUNT(*) FROM fingerprints
+            WHERE hash_value IN (SELECT hash_value FROM stop_hashes)
+        ''')
+        stop_rows = cursor.fetchone()[0]
+        
+        pruned_rows = 0
+        if prune:
+            cursor.execute('''
+                DELETE FROM fingerprints WHERE hash_value IN (SELECT hash_value FROM stop_hashes)
+            ''')
+            pruned_rows = cursor.rowcount
+            self._refresh_fingerprint_counts(cursor)
+        
+        cursor.executemany('INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)',
+                           [('stop_limit', str(limit)),
+                            ('stop_prune', '1' if prune or self.stop_prune else '0')])
+        conn.commit()
+        self._catalog_changed()
+        
+        self._load_stop_list()
+        if pruned_rows and self.backend == BACKEND_MEMORY:
+            self.index = InMemoryIndex.load(self)
+            self._index_refreshed_at = time.monotonic()
+        
+        cursor.execute('SELECT COUNT(*) FROM stop_hashes')
+        return {'songs': song_count, 'limit': limit, 'stop_hashes': cursor.fetchone()[0],
+                'stop_rows': stop_rows, 'total_rows': total_rows, 'pruned_rows': pruned_rows}
+    
+    def _rows_to_arrays(self, rows: List[tuple]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Строки (hash_value, song_id, time_offset) в виде трех массивов"""
+        hash_type = np.int64 if self.hash_mode == HASH_MODE_PACKED else 'U32'
+        if not rows:
+            return (np.array([], dtype=hash_type), np.array([], dtype=np.int64),
+                    np.array([], dtype=np.int64))
+        
+        hash_values, song_ids, time_offsets = zip(*rows)
+        return (np.array(hash_values, dtype=hash_type),
+                np.array(song_ids, dtype=np.int64),
+                np.array(time_offsets, dtype=np.int64))
+    
+    def fetch_fingerprint_rows(self, min_song_id: int = 0,
+                               song_ids: Optional[Iterable[int]] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Выгрузка отпечатков песен с ID больше min_song_id
+        
+        Args:
+            min_song_id: Выгружать только песни с большим ID (0 - все)
+            song_ids: Выгружать только эти песни (по индексу по песне)
+            
+        Returns:
+            Кортеж массивов (hash_values, song_ids, time_offsets)
+        """
+        cursor = self._connect().cursor()
+        if song_ids is None:
+            queries = [('WHERE song_id > ?', [min_song_id])]
+        else:
+            # Строки одной песни читаются одним запросом, то есть из одного снимка базы
+            queries = [(f'WHERE song_id IN ({placeholders}) AND song_id > ?', chunk + [min_song_id])
+                       for placeholders, chunk in self._in_chunks([int(song_id) for song_id in song_ids])]
+        
+        # Читаем порциями, чтобы не держать в памяти все строки как кортежи
+        chunks = []
+        for condition, params in queries:
+            cursor.execute(f'SELECT hash_value, song_id, time_offset FROM fingerprints {condition}', params)
+            while True:
+                rows = cursor.fetchmany(FETCH_CHUNK_ROWS)
+                if not rows:
+                    break
+                chunks.append(self._rows_to_arrays(rows))
+        
+        if not chunks:
+            return self._rows_to_arrays([])
+        return tuple(np.concatenate(column) for column in zip(*chunks))
+    
+    def export_index(self, path: str) -> Dict[str, int]:
+        """
+        Экспорт отпечатков в файл индекса для backend='mmap'
+        
+        Args:
+            path: Путь к файлу индекса
             
-            song_matches[song_id]['matches'] += 1
+        Returns:
+            Словарь со статистикой: keys, rows, bytes
+        """
+        if self.hash_mode != HASH_MODE_PACKED:
+            raise ValueError("Экспорт индекса поддерживается только для целочисленных хешей, "
+                             "сначала выполните migrate_to_packed_hashes()")
+        
+        if self.backend == BACKEND_MEMORY:
+            # Догружаем песни, добавленные другими процессами после последнего обновления,
+            # и вырезаем строки удаленных, чтобы они не попали в файл
+            index = self.index
+            self.refresh_index()
+            index.compact()
+        else:
+            index = InMemoryIndex.load(self)
+        write_index_file(index, path)
+        return {'keys': len(index.keys), 'rows': len(index), 'bytes': os.path.getsize(path)}
+    
+    def get_fingerprint_counts(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Число отпечатков каждой песни (songs.fingerprint_count)
+        
+        Счетчик меняется в одной транзакции со строками отпечатков, поэтому
+        он всегда равен числу строк песни, видимых читателю.
+        
+        Returns:
+            Кортеж массивов (song_ids по возрастанию, fingerprint_counts)
+        """
+        cursor = self._connect().cursor()
+        cursor.execute('SELECT id, fingerprint_count FROM songs ORDER BY id')
+        rows = cursor.fetchall()
+        if not rows:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        song_ids, counts = zip(*rows)
+        return np.array(song_ids, dtype=np.int64), np.array(counts, dtype=np.int64)
+    
+    def get_song_ids(self) -> List[int]:
+        """Список ID всех песен"""
+        cursor = self._connect().cursor()
+        cursor.execute('SELECT id FROM songs')
+        return [song_id for (song_id,) in cursor.fetchall()]
+    
+    def get_songs_info(self, song_ids: List[int]) -> Dict[int, Tuple[str, str, int]]:
+        """
+        Названия, исполнители и число отпечатков для набора песен одним запросом
         
-        # Подсчитываем общее количество хешей для каждой песни
-        conn = sqlite3.connect(self.db_path)
+        Args:
+            song_ids: ID песен
+            
+        Returns:
+            Словарь {song_id: (название, исполнитель, число_отпечатков)}
+        """
+        info = {}
+        conn = self._connect()
         cursor = conn.cursor()
+        for placeholders, chunk in self._in_chunks([int(song_id) for song_id in song_ids]):
+            cursor.execute(f'''
+                SELECT id, name, artist, fingerprint_count FROM songs WHERE id IN ({placeholders})
+            ''', chunk)
+            for song_id, name, artist, fingerprint_count in cursor.fetchall():
+                info[song_id] = (name, artist, fingerprint_count)
+        return info
+    
+    @staticmethod
+    def _similarity(matches, query_count: int, song_count, normalize: bool):
+        """
+        Коэффициент схожести
         
-        for song_id in song_matches.keys():
-            cursor.execute('SELECT COUNT(*) FROM fingerprints WHERE song_id = ?', (song_id,))
-            total_hashes = cursor.fetchone()[0]
-            song_matches[song_id]['total_hashes'] = total_hashes
+        Без нормализации - доля хешей запроса, совпавших с песней. С нормализацией
+        совпадения делятся на sqrt(хешей_запроса * хешей_песни), чтобы длинные песни
+        не выигрывали только за счет большого числа случайных совпадений.
+        """
+        if normalize:
+            return matches / np.sqrt(query_count * np.maximum(song_count, 1))
+        return matches / query_count
+    
+    def search_song(self, query_fingerprint: Union[Fingerprint, np.ndarray], 
+                   threshold: float = 0.1, scoring: str = SCORING_COUNT,
+                   normalize: bool = False) -> List[tuple]:
+        """
+        Поиск песни по отпечатку
         
-        conn.close()
+        Args:
+            query_fingerprint: Отпечаток запроса (словарь или структурированный массив,
+                               хеши в режиме базы: int или str)
+            threshold: Минимальный порог схожести
+            scoring: Способ оценки: 'count' - доля совпавших хешей,
+                     'offset' - доля хешей в пике гистограммы временных сдвигов
+            normalize: Нормализовать оценку с учетом числа отпечатков песни
+                       (значения получаются меньше, порог нужно подбирать отдельно)
+            
+        Returns:
+            Список кортежей (название, исполнитель, коэффициент_схожести),
+            для scoring='offset' - (название, исполнитель, коэффициент_схожести,
+            смещение_запроса_в_песне_в_секундах)
+        """
+        if scoring not in SCORING_MODES:
+            raise ValueError(f"Неизвестный способ оценки: {scoring}")
+        
+        query_hashes, query_offsets = self._apply_stop_list(*self._query_arrays(query_fingerprint))
+        if len(query_hashes) == 0:
+            return []
+        
+        with metrics.span('lookup'):
+            rows = self.lookup_hashes(np.unique(query_hashes))
+        metrics.count('rows_fetched', len(rows[0]))
+        with metrics.span('score'):
+            return self._score_matches(query_hashes, query_offsets, rows, threshold, scoring, normalize)
+    
+    def search_songs_batch(self, query_fingerprints: List[Union[Fingerprint, np.ndarray]],
+                           threshold: float = 0.1, scoring: str = SCORING_COUNT,
+                           normalize: bool = False,
+                           timings: Optional[Dict[str, Any]] = None) -> List[List[tuple]]:
+        """
+        Поиск сразу для нескольких отпечатков
+        
+        Хеши всех запросов объединяются, и база (или индекс) опрашивается один
+        раз на весь пакет, а не на каждый запрос. Затем найденные строки
+        раскладываются по запросам и оцениваются так же, как в search_song.
+        
+        Args:
+            query_fingerprints: Отпечатки запросов
+            threshold: Минимальный порог схожести
+            scoring: Способ оценки ('count' или 'offset')
+            normalize: Нормализовать оценку с учетом числа отпечатков песни
+            timings: Словарь, куда записывается время в секундах: lookup - общий
+                     поиск по базе, score - список времени оценки каждого запроса
+            
+        Returns:
+            Список результатов search_song для каждого запроса (в том же порядке)
+        """
+        if scoring not in SCORING_MODES:
+            raise ValueError(f"Неизвестный способ оценки: {scoring}")
+        
+        if timings is None:
+            timings = {}
+        timings['lookup'], timings['score'] = 0.0, [0.0] * len(query_fingerprints)
+        
+        queries = [self._apply_stop_list(*self._query_arrays(query_fingerprint))
+                   for query_fingerprint in query_fingerprints]
+        unique_hashes = [np.unique(query_hashes) for query_hashes, _ in queries]
+        non_empty = [hashes for hashes in unique_hashes if len(hashes)]
+        if not non_empty:
+            return [[] for _ in queries]
+        
+        start_time = time.perf_counter()
+        match_hashes, match_song_ids, match_offsets = self.lookup_hashes(
+            np.unique(np.concatenate(non_empty)))
+        timings['lookup'] = time.perf_counter() - start_time
+        
+        results = []
+        for i, ((query_hashes, query_offsets), hashes) in enumerate(zip(queries, unique_hashes)):
+            if len(query_hashes) == 0:
+                results.append([])
+                continue
+            start_time = time.perf_counter()
+            mask = np.isin(match_hashes, hashes)
+            rows = (match_hashes[mask], match_song_ids[mask], match_offsets[mask])
+            results.append(self._score_matches(query_hashes, query_offsets, rows,
+                                               threshold, scoring, normalize))
+            timings['score'][i] = time.perf_counter() - start_time
+        return results
+    
+    def _apply_stop_list(self, query_hashes: np.ndarray,
+                         query_offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Удаление хешей стоп-листа из запроса (режим 'skip')"""
+        if self.stop_mode != STOP_SKIP or len(self.stop_hashes) == 0 or len(query_hashes) == 0:
+            return query_hashes, query_offsets
+        keep = ~self._stop_mask(query_hashes)[0]
+        return query_hashes[keep], np.asarray(query_offsets)[keep]
+    
+    def _score_matches(self, query_hashes: np.ndarray, query_offsets: np.ndarray,
+                       rows: Tuple[np.ndarray, np.ndarray, np.ndarray], threshold: float,
+                       scoring: str, normalize: bool) -> List[tuple]:
+        """Оценка найденных строк (hash_values, song_ids, time_offsets) для одного запроса"""
+        if scoring == SCORING_OFFSET:
+            return self._score_by_offset(query_hashes, query_offsets, rows, threshold, normalize)
+        
+        # Каждый хеш запроса считаем один раз
+        query_count = len(np.unique(query_hashes))
+        
+        # Считаем совпадения по песням
+        match_hashes, match_song_ids, _ = rows
+        song_ids, match_counts = np.unique(match_song_ids, return_counts=True)
+        metrics.count('candidates', len(song_ids))
+        
+        # Частые хеши стоп-листа вносят меньший вклад и в совпадения, и в размер запроса
+        if self.stop_mode == STOP_WEIGHT and len(self.stop_hashes):
+            query_count = float(self.stop_weights(np.unique(query_hashes)).sum())
+            _, song_index = np.unique(match_song_ids, return_inverse=True)
+            match_counts = np.bincount(song_index, weights=self.stop_weights(match_hashes),
+                                       minlength=len(song_ids))
+        
+        # Названия и число отпечатков песен - одним запросом
+        info = self.get_songs_info(song_ids.tolist())
         
         # Вычисляем коэффициенты схожести
         matches = []
-        for song_id, data in song_matches.items():
-            similarity = data['matches'] / len(query_hashes)
+        for song_id, count in zip(song_ids.tolist(), match_counts.tolist()):
+            if song_id not in info:
+                continue
+            name, artist, total_hashes = info[song_id]
+            similarity = float(self._similarity(count, query_count, total_hashes, normalize))
             if similarity >= threshold:
-                matches.append((data['name'], data['artist'], similarity))
+                matches.append((name, artist, similarity))
+        
+        # Сортируем по убыванию схожести
+        matches.sort(key=lambda x: x[2], reverse=True)
+        
+        return matches
+    
+    def _offset_weights(self, query_hashes: np.ndarray,
+                        match_hashes: np.ndarray) -> Tuple[float, Optional[np.ndarray]]:
+        """
+        Размер запроса и веса найденных строк для оценки по сдвигам
+        
+        В режиме 'weight' частые хеши стоп-листа дают меньший голос в
+        гистограмме и меньший вклад в размер запроса (как в оценке 'count')
+        
+        Returns:
+            Кортеж (размер_запроса, веса_строк или None - у всех 1)
+        """
+        if self.stop_mode == STOP_WEIGHT and len(self.stop_hashes):
+            return float(self.stop_weights(query_hashes).sum()), self.stop_weights(match_hashes)
+        return len(query_hashes), None
+    
+    def _score_by_offset(self, query_hashes: np.ndarray, query_offsets: np.ndarray,
+                         rows: Tuple[np.ndarray, np.ndarray, np.ndarray], threshold: float,
+                         normalize: bool = False) -> List[Tuple[str, str, float, float]]:
+        """Оценка по гистограмме временных сдвигов"""
+        match_hashes, match_song_ids, match_offsets = rows
+        query_count, match_weights = self._offset_weights(query_hashes, match_hashes)
+        song_ids, scores, deltas = score_offset_alignment(
+            query_hashes, query_offsets, match_hashes, match_song_ids, match_offsets,
+            match_weights=match_weights
+        )
+        metrics.count('candidates', len(song_ids))
+        
+        if normalize:
+            info = self.get_songs_info(song_ids.tolist())
+            song_counts = np.array([info.get(song_id, (None, None, 0))[2] for song_id in song_ids.tolist()])
+        else:
+            song_counts = None
+        
+        similarities = self._similarity(scores, query_count, song_counts, normalize)
+        keep = similarities >= threshold
+        song_ids, similarities, deltas = song_ids[keep], similarities[keep], deltas[keep]
+        offsets = self.fingerprint_system.audio_processor.frames_to_seconds(deltas)
+        
+        if not normalize:
+            info = self.get_songs_info(song_ids.tolist())
+        matches = [(*info[song_id][:2], similarity, offset)
+                   for song_id, similarity, offset in zip(song_ids.tolist(), similarities.tolist(),
+                                                          offsets.tolist())
+                   if song_id in info]
         
         # Сортируем по убыванию схожести
         matches.sort(key=lambda x: x[2], reverse=True)
@@ -233,20 +1180,19 @@ class FingerprintDatabase:
     
     def get_song_count(self) -> int:
         """Получение количества песен в базе данных"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute('SELECT COUNT(*) FROM songs')
         count = cursor.fetchone()[0]
-        conn.close()
         return count
     
     def get_fingerprint_count(self) -> int:
         """Получение количества отпечатков в базе данных"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM fingerprints')
+        # Счетчики песен поддерживаются при вставке, поэтому не сканируем всю таблицу
+        cursor.execute('SELECT COALESCE(SUM(fingerprint_count), 0) FROM songs')
         count = cursor.fetchone()[0]
-        conn.close()
         return count
     
     def list_songs(self) -> List[Tuple[int, str, str, str, float]]:
@@ -256,11 +1202,10 @@ class FingerprintDatabase:
         Returns:
             Список кортежей (id, название, исполнитель, путь_к_файлу, длительность)
         """
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute('SELECT id, name, artist, file_path, duration FROM songs ORDER BY name')
         songs = cursor.fetchall()
-        conn.close()
         return songs
     
     def delete_song(self, song_id: int):
@@ -270,7 +1215,7 @@ class FingerprintDatabase:
         Args:
             song_id: ID песни для удаления
         """
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         # Удаляем отпечатки
@@ -280,18 +1225,149 @@ class FingerprintDatabase:
         cursor.execute('DELETE FROM songs WHERE id = ?', (song_id,))
         
         conn.commit()
-        conn.close()
+        self._catalog_changed()
+    
+    def migrate_to_packed_hashes(self, skip_missing: bool = False) -> Dict[str, object]:
+        """
+        Перевод старой базы с MD5-хешами на целочисленные хеши
+        
+        MD5 необратим, поэтому отпечатки пересчитываются из исходных файлов
+        песен (songs.file_path). После миграции база сжимается (VACUUM).
+        
+        Args:
+            skip_missing: Пропускать песни, чьи файлы недоступны (их отпечатки
+                          будут удалены), вместо ошибки
+            
+        Returns:
+            Словарь со статистикой: migrated - число песен, skipped - ID пропущенных
+        """
+        if self.hash_mode == HASH_MODE_PACKED:
+            return {'migrated': 0, 'skipped': []}
+        
+        songs = self.list_songs()
+        missing = [song_id for song_id, _, _, file_path, _ in songs
+                   if not file_path or not os.path.exists(file_path)]
+        if missing and not skip_missing:
+            raise FileNotFoundError(f"Не найдены файлы песен с ID: {missing}")
+        
+        packed_system = AudioFingerprint(**{**self.fingerprint_system.params(), 'hash_mode': HASH_MODE_PACKED})
+        
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute('DROP TABLE IF EXISTS fingerprints_packed')
+        self._create_fingerprints_table(cursor, 'fingerprints_packed', HASH_MODE_PACKED, SCHEMA_V2,
+                                        indexes=False)
+        
+        migrated = 0
+        for song_id, name, artist, file_path, duration in songs:
+            if song_id in missing:
+                continue
+            
+            audio_data = packed_system.audio_processor.load_audio_file(file_path)
+            fingerprint = packed_system.create_fingerprint_array(audio_data)
+            cursor.executemany('''
+                INSERT OR IGNORE INTO fingerprints_packed (song_id, hash_value, time_offset)
+                VALUES (?, ?, ?)
+            ''', self._fingerprint_rows(song_id, fingerprint, with_frequency=False))
+            migrated += 1
+        
+        # Подменяем таблицу целиком (новая таблица - сразу в схеме 2)
+        cursor.execute('DROP TABLE fingerprints')
+        cursor.execute('ALTER TABLE fingerprints_packed RENAME TO fingerprints')
+        self._create_song_index(cursor)
+        self._refresh_fingerprint_counts(cursor)
+        cursor.execute("UPDATE metadata SET value = ? WHERE key = 'hash_mode'", (HASH_MODE_PACKED,))
+        cursor.execute("UPDATE metadata SET value = ? WHERE key = 'schema_version'", (str(SCHEMA_V2),))
+        
+        # Стоп-лист был посчитан для MD5-хешей - его нужно строить заново
+        cursor.execute('DROP TABLE stop_hashes')
+        self._create_stop_table(cursor, HASH_MODE_PACKED)
+        cursor.execute("DELETE FROM metadata WHERE key IN ('stop_limit', 'stop_prune')")
+        conn.commit()
+        self._catalog_changed()
+        
+        conn.execute('VACUUM')
+        
+        self.hash_mode = HASH_MODE_PACKED
+        self.schema_version = SCHEMA_V2
+        self._store_frequency = False
+        self.fingerprint_system = packed_system
+        self._load_stop_list()
+        
+        return {'migrated': migrated, 'skipped': missing}
+    
+    def upgrade_schema(self) -> Dict[str, object]:
+        """
+        Перевод таблицы отпечатков на схему 2
+        
+        Строки копируются в таблицу WITHOUT ROWID в порядке хеша, старая таблица
+        с индексами удаляется, база сжимается (VACUUM). Отпечатки не пересчитываются.
+        Колонка frequency_bin не переносится: частота опорного пика есть в хеше,
+        а в старых строках там было время целевого пика.
+        
+        Returns:
+            Словарь со статистикой: rows - число строк, duplicates - удаленные
+            повторы (хеш, песня, время), bytes_before и bytes_after - размер файла базы
+        """
+        if self.schema_version == SCHEMA_V2:
+            return {'rows': self.get_fingerprint_count(), 'duplicates': 0,
+                    'bytes_before': self._file_size(), 'bytes_after': self._file_size()}
+        if self.hash_mode != HASH_MODE_PACKED:
+            raise ValueError("Схема 2 поддерживается только для целочисленных хешей, "
+                             "сначала выполните migrate_to_packed_hashes()")
+        
+        conn = self._connect()
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        bytes_before = self._file_size()
+        
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM fingerprints')
+        rows_before = cursor.fetchone()[0]
+        
+        cursor.execute('DROP TABLE IF EXISTS fingerprints_v2')
+        self._create_fingerprints_table(cursor, 'fingerprints_v2', HASH_MODE_PACKED, SCHEMA_V2,
+                                        indexes=False)
+        cursor.execute('''
+            INSERT OR IGNORE INTO fingerprints_v2 (hash_value, song_id, time_offset)
+            SELECT hash_value, song_id, time_offset FROM fingerprints
+            ORDER BY hash_value, song_id, time_offset
+        ''')
+        rows = cursor.rowcount
+        
+        cursor.execute('DROP TABLE fingerprints')
+        cursor.execute('ALTER TABLE fingerprints_v2 RENAME TO fingerprints')
+        self._create_song_index(cursor)
+        self._refresh_fingerprint_counts(cursor)
+        cursor.execute("UPDATE metadata SET value = ? WHERE key = 'schema_version'", (str(SCHEMA_V2),))
+        conn.commit()
+        self.schema_version = SCHEMA_V2
+        self._store_frequency = False
+        self._catalog_changed()
+        
+        conn.execute('VACUUM')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        
+        return {'rows': rows, 'duplicates': rows_before - rows,
+                'bytes_before': bytes_before, 'bytes_after': self._file_size()}
+    
+    def _file_size(self) -> int:
+        """Размер файла базы вместе с журналом WAL (байт)"""
+        return sum(os.path.getsize(path) for path in (self.db_path, self.db_path + '-wal')
+                   if os.path.exists(path))
     
     def clear_database(self):
         """Очистка всей базы данных"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         cursor.execute('DELETE FROM fingerprints')
         cursor.execute('DELETE FROM songs')
+        cursor.execute('DELETE FROM stop_hashes')
+        cursor.execute("DELETE FROM metadata WHERE key IN ('stop_limit', 'stop_prune')")
         
         conn.commit()
-        conn.close()
+        self._catalog_changed()
+        self._load_stop_list()
 
 # Пример использования
 if __name__ == "__main__":
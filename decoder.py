@@ -0,0 +1,208 @@
+"""
+Декодирование аудио файлов: окно по времени, моно float32, выбор качества ресемплинга
+"""
+import os
+import wave
+import numpy as np
+from math import gcd
+from typing import Iterator, Optional, Tuple
+
+try:
+    import soundfile as sf
+except ImportError:  # libsndfile не установлен - остаются wave и librosa
+    sf = None
+
+try:
+    import soxr
+except ImportError:
+    soxr = None
+
+# Режимы ресемплинга: 'high' - как librosa.load по умолчанию (soxr_hq),
+# 'fast' - soxr_qq (без soxr - полифазный фильтр scipy), качества хватает для запросов
+RESAMPLE_HIGH = 'high'
+RESAMPLE_FAST = 'fast'
+RESAMPLE_MODES = (RESAMPLE_HIGH, RESAMPLE_FAST)
+
+# Соответствие режимов качеству soxr и параметру res_type у librosa
+SOXR_QUALITIES = {RESAMPLE_HIGH: 'HQ', RESAMPLE_FAST: 'QQ'}
+LIBROSA_RES_TYPES = {RESAMPLE_HIGH: 'soxr_hq', RESAMPLE_FAST: 'soxr_qq'}
+
+def decode_audio(file_path: str, sample_rate: int, offset: float = 0.0,
+                 duration: Optional[float] = None, resample: str = RESAMPLE_HIGH) -> np.ndarray:
+    """
+    Чтение аудио файла в моно float32 с нужной частотой дискретизации
+    
+    Сначала пробуем soundfile (WAV, FLAC, OGG, MP3 и др.), без soundfile -
+    стандартный модуль wave для PCM WAV. Читается только окно [offset, offset + duration),
+    и если частота файла уже равна sample_rate, ресемплинг не выполняется.
+    Остальные форматы (m4a, aac...) декодирует librosa, она импортируется только здесь.
+    
+    Args:
+        file_path: Путь к аудио файлу
+        sample_rate: Нужная частота дискретизации
+        offset: Начало окна в секундах
+        duration: Длительность окна в секундах (None - до конца файла)
+        resample: Режим ресемплинга: 'high' или 'fast'
+    
+    Returns:
+        Аудио данные (float32, моно)
+    """
+    if resample not in RESAMPLE_MODES:
+        raise ValueError(f"Неизвестный режим ресемплинга: {resample}")
+    
+    decoded = _read_soundfile(file_path, offset, duration)
+    if decoded is None and file_path.lower().endswith('.wav'):
+        decoded = _read_wave(file_path, offset, duration)
+    if decoded is None:
+        return _read_librosa(file_path, sample_rate, offset, duration, resample)
+    
+    audio_data, native_rate = decoded
+    return resample_audio(audio_data, native_rate, sample_rate, resample)
+
+def iter_decode_blocks(file_path: str, sample_rate: int, block_seconds: float = 30.0,
+                       resample: str = RESAMPLE_HIGH) -> Iterator[np.ndarray]:
+    """
+    Чтение аудио файла блоками (моно float32) для длинных записей
+    
+    Через soundfile файл читается по block_seconds секунд, ресемплинг идет
+    потоково (soxr.ResampleStream), так что в памяти только текущий блок.
+    Если частота файла совпадает с sample_rate, блоки в сумме совпадают
+    с decode_audio. Без прямого пути файл декодируется целиком и режется на блоки.
+    
+    Args:
+        file_path: Путь к аудио файлу
+        sample_rate: Нужная частота дискретизации
+        block_seconds: Длительность блока в секундах
+        resample: Режим ресемплинга: 'high' или 'fast'
+    
+    Yields:
+        Блоки аудио данных
+    """
+    if resample not in RESAMPLE_MODES:
+        raise ValueError(f"Неизвестный режим ресемплинга: {resample}")
+    
+    native_rate = None
+    if sf is not None:
+        try:
+            native_rate = sf.info(file_path).samplerate
+        except sf.SoundFileRuntimeError:
+            native_rate = None
+    
+    if native_rate is None or (native_rate != sample_rate and soxr is None):
+        audio_data = decode_audio(file_path, sample_rate, resample=resample)
+        block_size = max(1, int(block_seconds * sample_rate))
+        for start in range(0, len(audio_data), block_size):
+            yield audio_data[start:start + block_size]
+        return
+    
+    stream = None
+    if native_rate != sample_rate:
+        stream = soxr.ResampleStream(native_rate, sample_rate, 1, dtype='float32',
+                                     quality=SOXR_QUALITIES[resample])
+    
+    block_size = max(1, int(block_seconds * native_rate))
+    for block in sf.blocks(file_path, blocksize=block_size, dtype='float32', always_2d=True):
+        block = _to_mono(block)
+        yield block if stream is None else stream.resample_chunk(block)
+    if stream is not None:
+        yield stream.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+
+def resample_audio(audio_data: np.ndarray, orig_rate: int, target_rate: int,
+                   resample: str = RESAMPLE_HIGH) -> np.ndarray:
+    """
+    Изменение частоты дискретизации
+    
+    Args:
+        audio_data: Аудио данные (моно)
+        orig_rate: Исходная частота
+        target_rate: Нужная частота
+        resample: Режим ресемплинга: 'high' или 'fast'
+    
+    Returns:
+        Аудио данные (float32)
+    """
+    if orig_rate == target_rate:
+        return audio_data.astype(np.float32, copy=False)
+    
+    if soxr is not None:
+        resampled = soxr.resample(audio_data, orig_rate, target_rate, quality=SOXR_QUALITIES[resample])
+    elif resample == RESAMPLE_FAST:
+        from scipy import signal
+        divisor = gcd(int(orig_rate), int(target_rate))
+        resampled = signal.resample_poly(audio_data, target_rate // divisor, orig_rate // divisor)
+    else:
+        import librosa
+        resampled = librosa.resample(audio_data, orig_sr=orig_rate, target_sr=target_rate,
+                                     res_type=LIBROSA_RES_TYPES[resample])
+    return resampled.astype(np.float32, copy=False)
+
+def _window(native_rate: int, total_frames: int, offset: float,
+            duration: Optional[float]) -> Tuple[int, int]:
+    """Первый отсчет и число отсчетов окна (округление как у librosa.load)"""
+    start = min(int(offset * native_rate), total_frames)
+    frames = total_frames - start
+    if duration is not None:
+        frames = min(frames, int(duration * native_rate))
+    return start, frames
+
+def _read_soundfile(file_path: str, offset: float,
+                    duration: Optional[float]) -> Optional[Tuple[np.ndarray, int]]:
+    """Чтение окна через soundfile, None - если формат не поддерживается"""
+    if sf is None:
+        return None
+    try:
+        with sf.SoundFile(file_path) as sound_file:
+            native_rate = sound_file.samplerate
+            start, frames = _window(native_rate, sound_file.frames, offset, duration)
+            if start:
+                sound_file.seek(start)
+            audio_data = sound_file.read(frames, dtype='float32', always_2d=True)
+    except sf.SoundFileRuntimeError:
+        return None
+    return _to_mono(audio_data), native_rate
+
+def _read_wave(file_path: str, offset: float,
+               duration: Optional[float]) -> Optional[Tuple[np.ndarray, int]]:
+    """Чтение окна PCM WAV стандартным модулем wave, None - если это не PCM"""
+    try:
+        with wave.open(file_path, 'rb') as wave_file:
+            native_rate = wave_file.getframerate()
+            channels = wave_file.getnchannels()
+            sample_width = wave_file.getsampwidth()
+            start, frames = _window(native_rate, wave_file.getnframes(), offset, duration)
+            wave_file.setpos(start)
+            raw = wave_file.readframes(frames)
+    except (wave.Error, EOFError):
+        return None
+    
+    if sample_width == 1:
+        audio_data = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width == 3:
+        # 24 бита: дописываем младший нулевой байт и читаем как int32
+        padded = np.zeros((len(raw) // 3, 4), dtype=np.uint8)
+        padded[:, 1:] = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)
+        audio_data = padded.view('<i4').reshape(-1).astype(np.float32) / 2 ** 31
+    elif sample_width in (2, 4):
+        dtype = '<i2' if sample_width == 2 else '<i4'
+        audio_data = np.frombuffer(raw, dtype=dtype).astype(np.float32) / 2 ** (8 * sample_width - 1)
+    else:
+        return None
+    
+    return _to_mono(audio_data.reshape(-1, channels)), native_rate
+
+def _read_librosa(file_path: str, sample_rate: int, offset: float,
+                  duration: Optional[float], resample: str) -> np.ndarray:
+    """Декодирование через librosa/audioread для форматов без прямого пути"""
+    import librosa
+    
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"Файл не найден: {file_path}")
+    audio_data, _ = librosa.load(file_path, sr=sample_rate, offset=offset, duration=duration,
+                                 res_type=LIBROSA_RES_TYPES[resample])
+    return audio_data
+
+def _to_mono(audio_data: np.ndarray) -> np.ndarray:
+    """Сведение каналов (отсчеты x каналы) в моно"""
+    if audio_data.shape[1] == 1:
+        return audio_data[:, 0]
+    return audio_data.mean(axis=1, dtype=np.float32)
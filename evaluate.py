@@ -0,0 +1,377 @@
+"""
+Оценка точности и стоимости распознавания для сетки параметров отпечатков
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import tempfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional
+from decoder import decode_audio, resample_audio, RESAMPLE_FAST
+from ingest import iter_audio_files
+
+# Параметры, которые можно перебирать, и их типы (noverlap по умолчанию - nperseg // 2)
+GRID_PARAMS = {
+    'target_zone_size': int,
+    'target_zone_threshold': float,
+    'nperseg': int,
+    'noverlap': int,
+}
+DEFAULT_PARAMS = {'target_zone_size': 10, 'target_zone_threshold': -40.0, 'nperseg': 1024, 'noverlap': None}
+DEFAULT_GRID = {'target_zone_size': [5, 10, 20]}
+
+class Degradation(NamedTuple):
+    """Искажение запроса: пересэмплирование, шум и усиление (именно в таком порядке)"""
+    name: str
+    snr_db: Optional[float] = None          # белый шум с таким отношением сигнал/шум
+    gain_db: float = 0.0                    # усиление (с обрезкой до [-1, 1])
+    resample_rate: Optional[int] = None     # частота, через которую проходит сигнал
+
+class Query(NamedTuple):
+    """Запрос оценки: фрагмент песни с искажением"""
+    song: int           # номер песни в списке подготовленного каталога
+    start: int          # первый отсчет фрагмента
+    degradation: int    # номер искажения
+    seed: int           # зерно шума
+
+def degradations(snrs=(20.0, 10.0, 0.0), gains=(-12.0, 6.0),
+                 resample_rates=(8000,)) -> List[Degradation]:
+    """
+    Набор искажений: чистый запрос и каждое искажение по отдельности
+    
+    Args:
+        snrs: Отношения сигнал/шум в дБ
+        gains: Усиления в дБ
+        resample_rates: Частоты дискретизации, через которые проходит сигнал
+                        (телефонная линия, сжатие)
+    
+    Returns:
+        Список искажений
+    """
+    result = [Degradation('clean')]
+    result += [Degradation(f'snr={snr:g}', snr_db=snr) for snr in snrs]
+    result += [Degradation(f'gain={gain:+g}', gain_db=gain) for gain in gains]
+    result += [Degradation(f'resample={rate}', resample_rate=rate) for rate in resample_rates]
+    return result
+
+def degrade(clip: np.ndarray, sample_rate: int, degradation: Degradation,
+            rng: np.random.Generator) -> np.ndarray:
+    """
+    Искажение фрагмента
+    
+    Args:
+        clip: Аудио данные фрагмента
+        sample_rate: Частота дискретизации
+        degradation: Искажение
+        rng: Генератор случайных чисел для шума
+    
+    Returns:
+        Искаженный фрагмент (float32)
+    """
+    clip = np.asarray(clip, dtype=np.float32)
+    if degradation.resample_rate is not None:
+        low = resample_audio(clip, sample_rate, degradation.resample_rate, RESAMPLE_FAST)
+        clip = resample_audio(low, degradation.resample_rate, sample_rate, RESAMPLE_FAST)[:len(clip)]
+    if degradation.snr_db is not None:
+        power = float(np.mean(clip.astype(np.float64) ** 2))
+        noise_std = np.sqrt(power / 10 ** (degradation.snr_db / 10))
+        clip = clip + rng.normal(0, noise_std, len(clip)).astype(np.float32)
+    if degradation.gain_db:
+        clip = np.clip(clip * np.float32(10 ** (degradation.gain_db / 20)), -1.0, 1.0)
+    return clip
+
+def parameter_grid(grid: Dict[str, List]) -> List[Dict[str, object]]:
+    """
+    Точки сетки параметров (недостающие параметры - по умолчанию)
+    
+    Args:
+        grid: Параметр -> список значений (см. GRID_PARAMS)
+    
+    Returns:
+        Список словарей параметров
+    """
+    unknown = set(grid) - set(GRID_PARAMS)
+    if unknown:
+        raise ValueError(f"Неизвестные параметры сетки: {', '.join(sorted(unknown))}")
+    
+    keys = list(grid)
+    points = []
+    for values in itertools.product(*(grid[key] for key in keys)):
+        point = {**DEFAULT_PARAMS, **dict(zip(keys, values))}
+        if point['noverlap'] is None:
+            point['noverlap'] = point['nperseg'] // 2
+        points.append(point)
+    return points
+
+def prepare_catalog(directory: str, source: Optional[str] = None, sample_rate: int = 22050,
+                    songs: int = 20, song_seconds: float = 30.0, holdout: float = 0.2,
+                    seed: int = 0) -> List[Dict[str, object]]:
+    """
+    Декодирование каталога в .npy файлы, которые воркеры открывают через mmap
+    
+    Файлы декодируются один раз на всю сетку, а страницы сигнала делятся
+    между процессами через кеш ОС. Часть песен (holdout) в базу не добавляется:
+    запросы по ним проверяют, что распознаватель не находит чужую песню.
+    
+    Args:
+        directory: Директория для .npy файлов
+        source: Директория с аудио или манифест (см. iter_audio_files),
+                None - синтетический каталог
+        sample_rate: Частота дискретизации
+        songs: Число песен синтетического каталога
+        song_seconds: Длительность песни синтетического каталога
+        holdout: Доля песен, которые не добавляются в базу
+        seed: Зерно выбора песен holdout
+    
+    Returns:
+        Список словарей: name, path, samples, in_catalog
+    """
+    if source is None:
+        from benchmark import synthetic_catalog
+        items = [(f"Песня {i}", audio) for i, audio in
+                 enumerate(synthetic_catalog(songs, song_seconds, sample_rate))]
+    else:
+        base_dir = source if os.path.isdir(source) else os.path.dirname(os.path.abspath(source))
+        items = ((name or os.path.relpath(file_path, base_dir), file_path)
+                 for file_path, name, _ in iter_audio_files(source))
+    
+    catalog = []
+    for i, (name, audio) in enumerate(items):
+        if isinstance(audio, str):
+            audio = decode_audio(audio, sample_rate)
+        path = os.path.join(directory, f'{i}.npy')
+        np.save(path, np.asarray(audio, dtype=np.float32))
+        catalog.append({'name': name, 'path': path, 'samples': len(audio), 'in_catalog': True})
+    
+    if holdout > 0 and len(catalog) > 1:
+        count = min(len(catalog) - 1, max(1, int(round(holdout * len(catalog)))))
+        for index in np.random.default_rng(seed).permutation(len(catalog))[:count]:
+            catalog[int(index)]['in_catalog'] = False
+    return catalog
+
+def make_queries(catalog: List[Dict[str, object]], degradation_count: int, queries_per_song: int,
+                 clip_length: int, seed: int = 0) -> List[Query]:
+    """
+    Запросы оценки: случайные фрагменты каждой песни с каждым искажением
+    
+    Одни и те же запросы используются во всех точках сетки.
+    
+    Args:
+        catalog: Подготовленный каталог (см. prepare_catalog)
+        degradation_count: Число искажений
+        queries_per_song: Число фрагментов каждой песни
+        clip_length: Длина фрагмента в отсчетах
+        seed: Зерно случайных сдвигов и шума
+    
+    Returns:
+        Список запросов
+    """
+    rng = np.random.default_rng(seed)
+    queries = []
+    for song, entry in enumerate(catalog):
+        for _ in range(queries_per_song):
+            start = int(rng.integers(max(1, entry['samples'] - clip_length)))
+            for degradation in range(degradation_count):
+                queries.append(Query(song, start, degradation, int(rng.integers(1 << 31))))
+    return queries
+
+def _evaluate_point(params: Dict[str, object], catalog: List[Dict[str, object]],
+                    queries: List[Query], degradation_list: List[Degradation], clip_length: int,
+                    threshold: float, scoring: str) -> List[Dict[str, object]]:
+    """
+    Оценка одной точки сетки (в процессе-воркере)
+    
+    Returns:
+        Строки результата по искажениям и итоговая строка 'all'
+    """
+    from fingerprint import AudioFingerprint
+    from database import FingerprintDatabase
+    from music_recognizer import MusicRecognizer
+    
+    try:
+        fingerprint_system = AudioFingerprint(**params)
+    except ValueError as e:
+        return [{**params, 'condition': 'all', 'error': str(e)}]
+    sample_rate = fingerprint_system.audio_processor.sample_rate
+    songs = [np.load(entry['path'], mmap_mode='r') for entry in catalog]
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_path = os.path.join(temp_dir, 'evaluate.db')
+        database = FingerprintDatabase(db_path, fingerprint_system=fingerprint_system)
+        
+        # Стоимость индексации: скорость создания хешей и место в базе
+        start_time = time.perf_counter()
+        fingerprints = [(entry['name'], fingerprint_system.create_fingerprint_array(np.asarray(audio)))
+                        for entry, audio in zip(catalog, songs) if entry['in_catalog']]
+        fingerprint_seconds = time.perf_counter() - start_time
+        database.add_songs_batch([(name, None, None, None, fingerprint) for name, fingerprint in fingerprints])
+        database._connect().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        hashes = sum(len(fingerprint) for _, fingerprint in fingerprints)
+        index_cost = {
+            'hashes_per_song': round(hashes / len(fingerprints)),
+            'hashes_per_sec': round(hashes / fingerprint_seconds),
+            'db_bytes_per_song': round(os.path.getsize(db_path) / len(fingerprints)),
+        }
+        database.close()
+        del fingerprints
+        
+        recognizer = MusicRecognizer(db_path, scoring=scoring, cache_size=0,
+                                     fingerprint_system=fingerprint_system)
+        outcomes = []  # (искажение, в каталоге, ответ, верный ответ, секунды, строк)
+        for query in queries:
+            entry = catalog[query.song]
+            clip = degrade(songs[query.song][query.start:query.start + clip_length], sample_rate,
+                           degradation_list[query.degradation], np.random.default_rng(query.seed))
+            
+            start_time = time.perf_counter()
+            result = recognizer.recognize_from_audio_data(clip, threshold)
+            elapsed = time.perf_counter() - start_time
+            
+            # Число строк индекса на запрос считается отдельно, вне замера времени
+            fingerprint = fingerprint_system.create_fingerprint_array(clip)
+            rows = len(recognizer.database.lookup_hashes(np.unique(fingerprint['hash']))[0])
+            outcomes.append((query.degradation, entry['in_catalog'], result is not None,
+                             result is not None and result[0] == entry['name'], elapsed, rows))
+        recognizer.database.close()
+    
+    def summary(condition: str, selected: List[tuple]) -> Dict[str, object]:
+        answered = sum(1 for outcome in selected if outcome[2])
+        correct = sum(1 for outcome in selected if outcome[3])
+        positives = sum(1 for outcome in selected if outcome[1])
+        return {
+            **params,
+            'condition': condition,
+            'queries': len(selected),
+            'precision': round(correct / answered, 3) if answered else None,
+            'recall': round(correct / positives, 3) if positives else None,
+            'ms_to_answer': round(1000 * float(np.mean([outcome[4] for outcome in selected])), 2),
+            'rows_per_query': round(float(np.mean([outcome[5] for outcome in selected]))),
+            **index_cost,
+        }
+    
+    rows = [summary(degradation.name, [outcome for outcome in outcomes if outcome[0] == number])
+            for number, degradation in enumerate(degradation_list)]
+    rows.append(summary('all', outcomes))
+    return rows
+
+def evaluate(grid: Dict[str, List], source: Optional[str] = None,
+             degradation_list: Optional[List[Degradation]] = None, queries_per_song: int = 2,
+             clip_seconds: float = 5.0, holdout: float = 0.2, threshold: float = 0.1,
+             scoring: str = 'count', workers: Optional[int] = None, songs: int = 20,
+             song_seconds: float = 30.0, seed: int = 0) -> List[Dict[str, object]]:
+    """
+    Точность и стоимость распознавания для каждой точки сетки параметров
+    
+    Каталог декодируется один раз, точки сетки оцениваются параллельно
+    в пуле процессов. Для каждой точки строится своя база, запросы (одни и те же
+    для всех точек) проходят через MusicRecognizer без кеша результатов.
+    Время ответа измеряется при параллельной работе воркеров - для точных
+    задержек нужен workers=1.
+    
+    Args:
+        grid: Параметр -> список значений (см. GRID_PARAMS)
+        source: Директория с аудио или манифест, None - синтетический каталог
+        degradation_list: Искажения запросов (по умолчанию - degradations())
+        queries_per_song: Число фрагментов каждой песни
+        clip_seconds: Длительность фрагмента
+        holdout: Доля песен, которые не добавляются в базу (ложные ответы)
+        threshold: Порог схожести распознавания
+        scoring: Способ оценки совпадений ('count' или 'offset')
+        workers: Число процессов (по умолчанию - число ядер)
+        songs: Число песен синтетического каталога
+        song_seconds: Длительность песни синтетического каталога
+        seed: Зерно случайных фрагментов и шума
+    
+    Returns:
+        Список словарей по точкам сетки и искажениям: параметры, condition,
+        queries, precision, recall, ms_to_answer, rows_per_query,
+        hashes_per_song, hashes_per_sec, db_bytes_per_song
+        (или error, если параметры недопустимы)
+    """
+    points = parameter_grid(grid)
+    degradation_list = degradation_list or degradations()
+    workers = max(1, min(workers or os.cpu_count() or 1, len(points)))
+    sample_rate = 22050
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        catalog = prepare_catalog(temp_dir, source, sample_rate, songs, song_seconds, holdout, seed)
+        if not any(entry['in_catalog'] for entry in catalog):
+            raise ValueError("Каталог для оценки пуст")
+        clip_length = int(clip_seconds * sample_rate)
+        queries = make_queries(catalog, len(degradation_list), queries_per_song, clip_length, seed)
+        args = (catalog, queries, degradation_list, clip_length, threshold, scoring)
+        
+        if workers == 1:
+            parts = [_evaluate_point(point, *args) for point in points]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_evaluate_point, point, *args) for point in points]
+                parts = [future.result() for future in futures]
+    return [row for part in parts for row in part]
+
+def _parse_grid(values: List[str]) -> Dict[str, List]:
+    """Разбор аргументов вида параметр=значение1,значение2"""
+    grid = {}
+    for value in values:
+        key, _, items = value.partition('=')
+        key = key.strip().replace('-', '_')
+        if key not in GRID_PARAMS or not items:
+            raise argparse.ArgumentTypeError(f"Ожидается параметр=значения, параметры: {', '.join(GRID_PARAMS)}")
+        grid[key] = [GRID_PARAMS[key](item) for item in items.split(',')]
+    return grid
+
+def main():
+    """Главная функция"""
+    from benchmark import _print_table
+    
+    parser = argparse.ArgumentParser(description="MyShazam - точность и стоимость распознавания для сетки параметров")
+    parser.add_argument("source", nargs="?",
+                        help="Директория с аудио или манифест (по умолчанию - синтетический каталог)")
+    parser.add_argument("--grid", action="append", default=[], metavar="ПАРАМЕТР=ЗНАЧЕНИЯ",
+                        help=f"Значения параметра через запятую: {', '.join(GRID_PARAMS)} "
+                             f"(по умолчанию target_zone_size=5,10,20)")
+    parser.add_argument("--snr", type=float, nargs="*", default=[20.0, 10.0, 0.0],
+                        help="Отношения сигнал/шум запросов в дБ")
+    parser.add_argument("--gain", type=float, nargs="*", default=[-12.0, 6.0], help="Усиления запросов в дБ")
+    parser.add_argument("--resample", type=int, nargs="*", default=[8000],
+                        help="Частоты, через которые проходит сигнал запроса")
+    parser.add_argument("--queries-per-song", type=int, default=2, help="Число фрагментов каждой песни")
+    parser.add_argument("--clip", type=float, default=5.0, help="Длительность фрагмента в секундах")
+    parser.add_argument("--holdout", type=float, default=0.2, help="Доля песен, которых нет в базе")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Порог схожести")
+    parser.add_argument("--scoring", choices=("count", "offset"), default="count",
+                        help="Способ оценки совпадений")
+    parser.add_argument("--workers", type=int, help="Число процессов (по умолчанию - все ядра)")
+    parser.add_argument("--songs", type=int, default=20, help="Число песен синтетического каталога")
+    parser.add_argument("--seed", type=int, default=0, help="Зерно случайных фрагментов и шума")
+    parser.add_argument("--all-conditions", action="store_true",
+                        help="Показать строки по каждому искажению, а не только итог")
+    parser.add_argument("--output", type=str, help="Сохранить результат в JSON файл")
+    parser.add_argument("--json", action="store_true", help="Вывести результат в JSON")
+    
+    args = parser.parse_args()
+    try:
+        grid = _parse_grid(args.grid) if args.grid else DEFAULT_GRID
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    
+    results = evaluate(grid, args.source, degradations(args.snr, args.gain, args.resample),
+                       queries_per_song=args.queries_per_song, clip_seconds=args.clip,
+                       holdout=args.holdout, threshold=args.threshold, scoring=args.scoring,
+                       workers=args.workers, songs=args.songs, seed=args.seed)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        _print_table(results if args.all_conditions else
+                     [row for row in results if row['condition'] == 'all'])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
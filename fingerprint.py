@@ -3,107 +3,415 @@ fingerprinting
 """
 import numpy as np
 import hashlib
-from typing import List, Tuple, Dict, Set
-from audio_processor import AudioProcessor
+import collections
+from typing import Any, Iterable, Iterator, List, Tuple, Dict, Set, Union, Optional
+from audio_processor import AudioProcessor, SpectrogramStream, PRECISION_FLOAT64
+from decoder import iter_decode_blocks
+from cache import FingerprintCache
+import metrics
+
+# Режимы хеширования: упакованное целое число или (устаревший) MD5
+HASH_MODE_PACKED = 'packed'
+HASH_MODE_MD5 = 'md5'
+HASH_MODES = (HASH_MODE_PACKED, HASH_MODE_MD5)
+
+# Раскладка битов упакованного хеша: [f1:10][f2:10][dt:12] = 32 бита
+FREQ_BITS = 10
+DELTA_BITS = 12
+
+HashValue = Union[str, int]
+# Хеш -> позиции (время опорного пика в кадрах, частотный бин опорного пика)
+Fingerprint = Dict[HashValue, List[Tuple[int, int]]]
+
+def fingerprint_dtype(hash_mode: str = HASH_MODE_PACKED) -> np.dtype:
+    """
+    Тип структурированного массива отпечатка (одна строка - одна пара пиков)
+    
+    Хранится только опорный пик: время нужно для выравнивания по сдвигу,
+    частота - для проверки и отладки. Целевой пик восстанавливается из хеша
+    (в режиме 'packed': f2 и dt, см. unpack_hashes).
+    
+    Args:
+        hash_mode: Режим хеширования
+    
+    Returns:
+        numpy dtype с полями hash, anchor_time, anchor_freq
+    """
+    hash_type = np.int64 if hash_mode == HASH_MODE_PACKED else 'U32'
+    return np.dtype([('hash', hash_type), ('anchor_time', np.int32), ('anchor_freq', np.int16)])
+
+def fingerprint_to_dict(fingerprint: np.ndarray) -> Fingerprint:
+    """
+    Преобразование структурированного массива отпечатка в словарь
+    
+    Args:
+        fingerprint: Массив пар (hash, anchor_time, anchor_freq)
+    
+    Returns:
+        Словарь: хеш -> список (время, частота) опорных пиков
+    """
+    fingerprints = {}
+    for hash_value, anchor_time, anchor_freq in zip(fingerprint['hash'].tolist(),
+                                                    fingerprint['anchor_time'].tolist(),
+                                                    fingerprint['anchor_freq'].tolist()):
+        if hash_value not in fingerprints:
+            fingerprints[hash_value] = []
+        
+        fingerprints[hash_value].append((anchor_time, anchor_freq))
+    
+    return fingerprints
+
+def pack_hashes(f1: np.ndarray, f2: np.ndarray, dt: np.ndarray) -> np.ndarray:
+    """
+    Упаковка (f1, f2, dt) в целочисленные хеши для всех пар сразу
+    
+    Args:
+        f1: Частотные бины опорных пиков
+        f2: Частотные бины целевых пиков
+        dt: Разница во времени между пиками (в кадрах)
+    
+    Returns:
+        Массив int64 с хешами
+    """
+    f1 = np.asarray(f1, dtype=np.int64)
+    f2 = np.asarray(f2, dtype=np.int64)
+    dt = np.asarray(dt, dtype=np.int64)
+    
+    if f1.size and (f1.max() >= 1 << FREQ_BITS or f2.max() >= 1 << FREQ_BITS):
+        raise ValueError(f"Частотный бин не помещается в {FREQ_BITS} бит")
+    if dt.size and (dt.min() < 0 or dt.max() >= 1 << DELTA_BITS):
+        raise ValueError(f"Разница во времени не помещается в {DELTA_BITS} бит")
+    
+    return (f1 << (FREQ_BITS + DELTA_BITS)) | (f2 << DELTA_BITS) | dt
+
+def unpack_hashes(hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Распаковка целочисленных хешей обратно в (f1, f2, dt)
+    
+    Args:
+        hashes: Массив упакованных хешей
+    
+    Returns:
+        Кортеж массивов (f1, f2, dt)
+    """
+    hashes = np.asarray(hashes, dtype=np.int64)
+    freq_mask = (1 << FREQ_BITS) - 1
+    f1 = (hashes >> (FREQ_BITS + DELTA_BITS)) & freq_mask
+    f2 = (hashes >> DELTA_BITS) & freq_mask
+    dt = hashes & ((1 << DELTA_BITS) - 1)
+    return f1, f2, dt
+
+def md5_hash(f1: int, f2: int, dt: int) -> str:
+    """Устаревший MD5-хеш пары пиков (для совместимости со старыми базами)"""
+    return hashlib.md5(f"{f1}:{f2}:{dt}".encode()).hexdigest()
 
 class AudioFingerprint:
     """Класс для создания и работы с аудио-отпечатками"""
     
-    def __init__(self, target_zone_size: int = 10, target_zone_threshold: float = -40.0):
+    def __init__(self, target_zone_size: int = 10, target_zone_threshold: float = -40.0,
+                 hash_mode: str = HASH_MODE_PACKED, target_zone_freq: Optional[int] = None,
+                 precision: str = PRECISION_FLOAT64, cache_dir: Optional[str] = None,
+                 nperseg: int = 1024, noverlap: int = 512, sample_rate: int = 22050):
         """
         Инициализация системы создания отпечатков
         
         Args:
             target_zone_size: Размер целевой зоны для поиска пиков
             target_zone_threshold: Порог для определения значимых пиков
+            hash_mode: Режим хеширования: 'packed' (целые числа) или 'md5'
+            target_zone_freq: Ширина целевой зоны по частоте (в бинах),
+                              None - без ограничения
+            precision: Точность обработки сигнала: 'float64' или 'float32'
+                       (см. AudioProcessor)
+            cache_dir: Директория кеша декодированного сигнала и пиков файлов
+                       (см. FingerprintCache), None - без кеша
+            nperseg: Размер окна STFT
+            noverlap: Перекрытие окон STFT
+            sample_rate: Частота дискретизации сигнала
         """
+        if hash_mode not in HASH_MODES:
+            raise ValueError(f"Неизвестный режим хеширования: {hash_mode}")
+        if hash_mode == HASH_MODE_PACKED and nperseg // 2 + 1 > 1 << FREQ_BITS:
+            raise ValueError(f"При nperseg={nperseg} частотный бин не помещается в {FREQ_BITS} бит")
+        
         self.target_zone_size = target_zone_size
         self.target_zone_threshold = target_zone_threshold
-        self.audio_processor = AudioProcessor()
+        self.hash_mode = hash_mode
+        self.target_zone_freq = target_zone_freq
+        self.audio_processor = AudioProcessor(sample_rate=sample_rate, nperseg=nperseg,
+                                              noverlap=noverlap, precision=precision)
+        self.file_cache = FingerprintCache(cache_dir) if cache_dir else None
+    
+    def params(self) -> Dict[str, Any]:
+        """
+        Параметры конструктора, с которыми создана система
+        
+        AudioFingerprint(**system.params()) дает те же хеши, поэтому по этому
+        словарю системы отпечатков создаются в процессах-воркерах.
+        
+        Returns:
+            Словарь аргументов AudioFingerprint
+        """
+        processor = self.audio_processor
+        return {
+            'target_zone_size': self.target_zone_size,
+            'target_zone_threshold': self.target_zone_threshold,
+            'hash_mode': self.hash_mode,
+            'target_zone_freq': self.target_zone_freq,
+            'precision': processor.precision,
+            'cache_dir': self.file_cache.cache_dir if self.file_cache is not None else None,
+            'nperseg': processor.nperseg,
+            'noverlap': processor.noverlap,
+            'sample_rate': processor.sample_rate,
+        }
     
-    def create_fingerprint(self, audio_data: np.ndarray) -> Dict[str, List[Tuple[int, int]]]:
+    def create_fingerprint(self, audio_data: np.ndarray) -> Fingerprint:
         """
         Создание отпечатка из аудио данных
         
         Args:
             audio_data: Аудио данные
-            
+        
         Returns:
             Словарь с хешами и их временными позициями
         """
+        return fingerprint_to_dict(self.create_fingerprint_array(audio_data))
+    
+    def create_fingerprint_array(self, audio_data: np.ndarray) -> np.ndarray:
+        """
+        Создание отпечатка в виде структурированного массива
+        
+        В отличие от create_fingerprint не создает Python-объектов на каждую
+        пару пиков, поэтому такой отпечаток можно сразу передавать в базу данных.
+        
+        Args:
+            audio_data: Аудио данные
+        
+        Returns:
+            Массив с полями (hash, anchor_time, anchor_freq), см. fingerprint_dtype
+        """
         # Создаем спектрограмму
-        frequencies, times, spectrogram = self.audio_processor.create_spectrogram(audio_data)
+        with metrics.span('spectrogram'):
+            frequencies, times, spectrogram = self.audio_processor.create_spectrogram(audio_data)
         
-        # Находим пики
-        peaks = self.audio_processor.find_peaks(spectrogram, self.target_zone_threshold)
+        # Находим пики (уже отсортированы по времени)
+        with metrics.span('peaks'):
+            freq_bins, time_bins, amplitudes = self.audio_processor.find_peaks(
+                spectrogram, self.target_zone_threshold
+            )
+        metrics.count('peaks', len(freq_bins))
         
-        # Сортируем пики по времени
-        peaks.sort(key=lambda x: x[1])  # Сортируем по time_bin
+        with metrics.span('hashing'):
+            pairs = self.generate_pairs(freq_bins, time_bins)
+        metrics.count('hashes', len(pairs))
+        return pairs
+    
+    def generate_pairs(self, freq_bins: np.ndarray, time_bins: np.ndarray) -> np.ndarray:
+        """
+        Векторизованная генерация пар "опорный пик - пик целевой зоны"
         
-        # Создаем отпечатки
-        fingerprints = {}
+        Каждый пик объединяется с не более чем target_zone_size следующими
+        пиками, отстоящими от него не дальше target_zone_size кадров
+        (и не дальше target_zone_freq бинов по частоте, если задано).
         
-        for i, (f1, t1, amp1) in enumerate(peaks):
-            # Ищем пики в целевой зоне
-            target_peaks = []
-            
-            for j in range(i + 1, min(i + self.target_zone_size + 1, len(peaks))):
-                f2, t2, amp2 = peaks[j]
-                
-                # Проверяем, что пик находится в целевой зоне
-                if t2 - t1 <= self.target_zone_size:
-                    target_peaks.append((f2, t2, amp2))
-            
-            # Создаем хеш для каждого пика в целевой зоне
-            for f2, t2, amp2 in target_peaks:
-                # Создаем хеш на основе частот и времени
-                hash_input = f"{f1}:{f2}:{t2-t1}"
-                hash_value = hashlib.md5(hash_input.encode()).hexdigest()
-                
-                if hash_value not in fingerprints:
-                    fingerprints[hash_value] = []
-                
-                fingerprints[hash_value].append((t1, t2))
+        Args:
+            freq_bins: Частотные бины пиков, отсортированных по времени
+            time_bins: Временные бины пиков
+        
+        Returns:
+            Массив с полями (hash, anchor_time, anchor_freq), упорядоченный
+            по опорному пику
+        """
+        freq_bins = np.asarray(freq_bins, dtype=np.int64)
+        time_bins = np.asarray(time_bins, dtype=np.int64)
+        n_peaks = len(freq_bins)
+        fan_out = self.target_zone_size
+        
+        # Матрица кандидатов: строка - опорный пик, столбец - сдвиг k = 1..fan_out
+        anchors = np.arange(n_peaks)[:, None]
+        targets = anchors + np.arange(1, fan_out + 1)[None, :]
+        valid = targets < n_peaks
+        targets = np.where(valid, targets, 0)
+        
+        dt = time_bins[targets] - time_bins[anchors]
+        valid &= dt <= self.target_zone_size
+        if self.target_zone_freq is not None:
+            valid &= np.abs(freq_bins[targets] - freq_bins[anchors]) <= self.target_zone_freq
+        
+        # nonzero обходит матрицу по строкам - порядок как у исходного цикла
+        anchor_idx, shift_idx = np.nonzero(valid)
+        target_idx = targets[anchor_idx, shift_idx]
+        
+        pairs = np.empty(len(anchor_idx), dtype=fingerprint_dtype(self.hash_mode))
+        pairs['hash'] = self.hash_pairs(
+            freq_bins[anchor_idx],
+            freq_bins[target_idx],
+            dt[anchor_idx, shift_idx]
+        )
+        pairs['anchor_time'] = time_bins[anchor_idx]
+        pairs['anchor_freq'] = freq_bins[anchor_idx]
+        
+        return pairs
+    
+    def hash_pairs(self, f1: np.ndarray, f2: np.ndarray, dt: np.ndarray) -> np.ndarray:
+        """
+        Хеширование пар пиков в текущем режиме
+        
+        Args:
+            f1: Частотные бины опорных пиков
+            f2: Частотные бины целевых пиков
+            dt: Разница во времени между пиками
+        
+        Returns:
+            Массив хешей (int64 для 'packed', строки для 'md5')
+        """
+        if self.hash_mode == HASH_MODE_PACKED:
+            return pack_hashes(f1, f2, dt)
+        
+        return np.array([md5_hash(a, b, d) for a, b, d in zip(f1.tolist(), f2.tolist(), dt.tolist())],
+                        dtype='U32')
+    
+    def iter_fingerprint(self, audio: Union[np.ndarray, Iterable[np.ndarray]],
+                         block_size: Optional[int] = None) -> Iterator[np.ndarray]:
+        """
+        Блочное создание отпечатка для длинных записей
+        
+        Сигнал обрабатывается блоками: STFT, поиск пиков и генерация пар
+        переносят состояние через границы блоков, поэтому хеши в сумме
+        совпадают с create_fingerprint_array, а память не зависит от длины записи.
+        
+        Args:
+            audio: Аудио данные или итератор блоков аудио
+            block_size: Размер блока в отсчетах, если audio - массив
+                        (по умолчанию 30 секунд)
+        
+        Yields:
+            Части отпечатка (см. fingerprint_dtype) в порядке времени
+        """
+        chunks = audio
+        if isinstance(audio, np.ndarray):
+            block_size = block_size or 30 * self.audio_processor.sample_rate
+            chunks = (audio[start:start + block_size] for start in range(0, len(audio), block_size))
+        
+        fingerprinter = StreamingFingerprinter(self)
+        for chunk in chunks:
+            pairs = fingerprinter.update(chunk)
+            if len(pairs):
+                yield pairs
+        pairs = fingerprinter.finish()
+        if len(pairs):
+            yield pairs
+    
+    def iter_fingerprint_file(self, file_path: str, block_seconds: float = 30.0) -> Iterator[np.ndarray]:
+        """
+        Блочное создание отпечатка аудио файла без загрузки файла целиком
+        
+        Args:
+            file_path: Путь к аудио файлу
+            block_seconds: Длительность блока чтения в секундах
         
-        return fingerprints
+        Yields:
+            Части отпечатка (см. fingerprint_dtype)
+        """
+        blocks = iter_decode_blocks(file_path, self.audio_processor.sample_rate, block_seconds)
+        yield from self.iter_fingerprint(blocks)
     
-    def create_fingerprint_from_file(self, file_path: str) -> Dict[str, List[Tuple[int, int]]]:
+    def file_peaks(self, file_path: str) -> Tuple[np.ndarray, np.ndarray, int]:
+        """
+        Пики спектрограммы аудио файла
+        
+        Если задан кеш (cache_dir), пики и декодированный сигнал берутся
+        из него, а посчитанные заново - сохраняются.
+        
+        Args:
+            file_path: Путь к аудио файлу
+        
+        Returns:
+            Кортеж (частотные бины, временные бины, число отсчетов сигнала)
+        """
+        processor = self.audio_processor
+        cache = self.file_cache
+        if cache is None:
+            audio_data = processor.load_audio_file(file_path)
+            _, _, spectrogram = processor.create_spectrogram(audio_data)
+            freq_bins, time_bins, _ = processor.find_peaks(spectrogram, self.target_zone_threshold)
+            return freq_bins, time_bins, len(audio_data)
+        
+        digest = cache.file_digest(file_path)
+        audio_params = (processor.sample_rate,)
+        peak_params = (processor.sample_rate, processor.nperseg, processor.noverlap,
+                       processor.precision, self.target_zone_threshold)
+        
+        peaks = cache.load_peaks(digest, peak_params)
+        if peaks is not None:
+            return peaks
+        
+        audio_data = cache.load_audio(digest, audio_params)
+        if audio_data is None:
+            audio_data = processor.load_audio_file(file_path)
+            cache.save_audio(digest, audio_params, audio_data)
+        
+        _, _, spectrogram = processor.create_spectrogram(audio_data)
+        freq_bins, time_bins, _ = processor.find_peaks(spectrogram, self.target_zone_threshold)
+        cache.save_peaks(digest, peak_params, freq_bins, time_bins, len(audio_data))
+        return freq_bins, time_bins, len(audio_data)
+    
+    def create_fingerprint_array_from_file(self, file_path: str) -> np.ndarray:
+        """
+        Создание отпечатка аудио файла в виде структурированного массива
+        
+        С кешем (cache_dir) при повторной обработке файла выполняется
+        только генерация пар.
+        
+        Args:
+            file_path: Путь к аудио файлу
+        
+        Returns:
+            Массив с полями (hash, anchor_time, anchor_freq), см. fingerprint_dtype
+        """
+        freq_bins, time_bins, _ = self.file_peaks(file_path)
+        return self.generate_pairs(freq_bins, time_bins)
+    
+    def create_fingerprint_from_file(self, file_path: str) -> Fingerprint:
         """
         Создание отпечатка из аудио файла
         
         Args:
             file_path: Путь к аудио файлу
-            
+        
         Returns:
             Словарь с хешами и их временными позициями
         """
-        audio_data = self.audio_processor.load_audio_file(file_path)
-        return self.create_fingerprint(audio_data)
+        return fingerprint_to_dict(self.create_fingerprint_array_from_file(file_path))
     
-    def create_fingerprint_from_recording(self, duration: float = 10.0) -> Dict[str, List[Tuple[int, int]]]:
+    def create_fingerprint_from_recording(self, duration: float = 10.0) -> Fingerprint:
         """
         Создание отпечатка из записи с микрофона
         
         Args:
             duration: Длительность записи в секундах
-            
+        
         Returns:
             Словарь с хешами и их временными позициями
         """
         audio_data = self.audio_processor.record_audio(duration)
         return self.create_fingerprint(audio_data)
     
-    def compare_fingerprints(self, fingerprint1: Dict[str, List[Tuple[int, int]]], 
-                           fingerprint2: Dict[str, List[Tuple[int, int]]]) -> float:
+    def compare_fingerprints(self, fingerprint1: Fingerprint, 
+                           fingerprint2: Fingerprint) -> float:
         """
         Сравнение двух отпечатков
         
+        Для общих хешей строится гистограмма сдвигов между временами опорных
+        пиков. Совпавшим считается хеш, у которого есть пара позиций со сдвигом
+        не дальше 2 кадров от самого частого.
+        
         Args:
             fingerprint1: Первый отпечаток
             fingerprint2: Второй отпечаток
-            
+        
         Returns:
-            Коэффициент схожести (0-1)
+            Коэффициент схожести (0-1): доля общих хешей, выровненных по сдвигу
         """
         # Находим общие хеши
         common_hashes = set(fingerprint1.keys()) & set(fingerprint2.keys())
@@ -111,33 +419,28 @@ class AudioFingerprint:
         if not common_hashes:
             return 0.0
         
-        # Подсчитываем совпадения с учетом временных сдвигов
-        matches = 0
-        total_hashes = len(common_hashes)
+        # Сдвиги всех пар позиций каждого общего хеша
+        deltas = {hash_value: {t2 - t1 for t1, _ in fingerprint1[hash_value]
+                               for t2, _ in fingerprint2[hash_value]}
+                  for hash_value in common_hashes}
+        histogram = collections.Counter(delta for hash_deltas in deltas.values() for delta in hash_deltas)
+        best_delta = histogram.most_common(1)[0][0]
         
-        for hash_value in common_hashes:
-            positions1 = fingerprint1[hash_value]
-            positions2 = fingerprint2[hash_value]
-            
-            # Проверяем временные сдвиги
-            for t1, t2 in positions1:
-                for t3, t4 in positions2:
-                    # Если временной сдвиг небольшой, считаем совпадением
-                    if abs((t1 - t3) + (t2 - t4)) <= 2:
-                        matches += 1
-                        break
+        # Хеш совпал, если один из его сдвигов близок к самому частому
+        matches = sum(1 for hash_deltas in deltas.values()
+                      if any(abs(delta - best_delta) <= 2 for delta in hash_deltas))
         
-        return matches / total_hashes if total_hashes > 0 else 0.0
+        return matches / len(common_hashes)
     
-    def find_best_match(self, query_fingerprint: Dict[str, List[Tuple[int, int]]], 
-                       database: Dict[str, Dict[str, List[Tuple[int, int]]]]) -> Tuple[str, float]:
+    def find_best_match(self, query_fingerprint: Fingerprint, 
+                       database: Dict[str, Fingerprint]) -> Tuple[str, float]:
         """
         Поиск лучшего совпадения в базе данных
         
         Args:
             query_fingerprint: Отпечаток запроса
             database: База данных отпечатков {song_name: fingerprint}
-            
+        
         Returns:
             Кортеж (название_песни, коэффициент_схожести)
         """
@@ -153,18 +456,22 @@ class AudioFingerprint:
         
         return best_match, best_score
     
-    def get_fingerprint_stats(self, fingerprint: Dict[str, List[Tuple[int, int]]]) -> Dict[str, int]:
+    def get_fingerprint_stats(self, fingerprint: Union[Fingerprint, np.ndarray]) -> Dict[str, int]:
         """
         Получение статистики отпечатка
         
         Args:
-            fingerprint: Отпечаток для анализа
-            
+            fingerprint: Отпечаток для анализа (словарь или структурированный массив)
+        
         Returns:
             Словарь со статистикой
         """
-        total_hashes = len(fingerprint)
-        total_positions = sum(len(positions) for positions in fingerprint.values())
+        if isinstance(fingerprint, np.ndarray):
+            total_hashes = len(np.unique(fingerprint['hash']))
+            total_positions = len(fingerprint)
+        else:
+            total_hashes = len(fingerprint)
+            total_positions = sum(len(positions) for positions in fingerprint.values())
         
         return {
             'total_hashes': total_hashes,
@@ -172,6 +479,124 @@ class AudioFingerprint:
             'average_positions_per_hash': total_positions / total_hashes if total_hashes > 0 else 0
         }
 
+class StreamingFingerprinter:
+    """
+    Инкрементальное создание отпечатка
+    
+    Хранит только хвост сигнала, последние кадры спектрограммы и пики,
+    которые еще могут стать парами. Хеши совпадают с create_fingerprint_array
+    для всего сигнала целиком. Поиск пиков использует окрестность по умолчанию
+    (один кадр по времени в каждую сторону), как и create_fingerprint_array.
+    """
+    
+    def __init__(self, fingerprint_system: AudioFingerprint):
+        """
+        Args:
+            fingerprint_system: Система отпечатков (параметры STFT, пиков и пар)
+        """
+        self.fingerprint_system = fingerprint_system
+        self.processor = fingerprint_system.audio_processor
+        self._spectrogram = SpectrogramStream(self.processor)
+        
+        self._frames = None           # последние кадры спектрограммы (частота x время)
+        self._frames_start = 0        # номер первого кадра в _frames
+        self._next_peak_frame = 1     # первый кадр, где пики еще не искали (кадр 0 - край)
+        
+        self._peak_freqs = np.array([], dtype=np.int64)
+        self._peak_times = np.array([], dtype=np.int64)
+    
+    @property
+    def samples_seen(self) -> int:
+        """Число обработанных отсчетов"""
+        return self._spectrogram.samples_seen
+    
+    @property
+    def duration(self) -> float:
+        """Длительность обработанного аудио в секундах"""
+        return self.samples_seen / self.processor.sample_rate
+    
+    @property
+    def complete_frames(self) -> int:
+        """Все пары с опорным пиком раньше этого кадра уже выданы"""
+        return max(0, self._next_peak_frame - self.fingerprint_system.target_zone_size)
+    
+    def update(self, chunk: np.ndarray) -> np.ndarray:
+        """
+        Добавление блока аудио
+        
+        Args:
+            chunk: Блок аудио данных (моно)
+        
+        Returns:
+            Новые пары отпечатка, которые больше не изменятся (см. fingerprint_dtype)
+        """
+        _, spectrogram = self._spectrogram.update(chunk)
+        if spectrogram is not None:
+            if self._frames is None:
+                self._frames = spectrogram
+            else:
+                self._frames = np.concatenate([self._frames, spectrogram], axis=1)
+            self._find_new_peaks()
+        return self._emit_pairs(final=False)
+    
+    def finish(self) -> np.ndarray:
+        """
+        Завершение потока
+        
+        Returns:
+            Оставшиеся пары отпечатка
+        """
+        return self._emit_pairs(final=True)
+    
+    def _find_new_peaks(self):
+        """
+        Поиск пиков в кадрах, у которых уже известны оба соседа по времени
+        
+        Окно включает последний уже проверенный кадр как левый контекст,
+        а самый последний кадр остается непроверенным до прихода следующего.
+        """
+        window_frames = self._frames.shape[1]
+        if window_frames < 3:
+            return
+        
+        freq_bins, time_bins, _ = self.processor.find_peaks(
+            self._frames, self.fingerprint_system.target_zone_threshold
+        )
+        time_bins = time_bins.astype(np.int64) + self._frames_start
+        new = time_bins >= self._next_peak_frame
+        
+        self._peak_freqs = np.concatenate([self._peak_freqs, freq_bins[new].astype(np.int64)])
+        self._peak_times = np.concatenate([self._peak_times, time_bins[new]])
+        
+        # Оставляем два последних кадра: проверенный (контекст) и непроверенный
+        last_frame = self._frames_start + window_frames - 1
+        self._next_peak_frame = last_frame
+        self._frames = self._frames[:, -2:]
+        self._frames_start = last_frame - 1
+    
+    def _emit_pairs(self, final: bool) -> np.ndarray:
+        """Пары для опорных пиков, чья целевая зона уже полностью известна"""
+        if len(self._peak_times) == 0:
+            return np.empty(0, dtype=fingerprint_dtype(self.fingerprint_system.hash_mode))
+        
+        if final:
+            n_ready = len(self._peak_times)
+        else:
+            # Пики после next_peak_frame еще могут появиться
+            zone_end = self._peak_times + self.fingerprint_system.target_zone_size
+            n_ready = int(np.searchsorted(zone_end, self._next_peak_frame, side='left'))
+        
+        pairs = self.fingerprint_system.generate_pairs(self._peak_freqs, self._peak_times)
+        
+        # Пары упорядочены по времени опорного пика, готовые - префикс
+        if n_ready < len(self._peak_times):
+            n_pairs = int(np.searchsorted(pairs['anchor_time'], self._peak_times[n_ready], side='left'))
+            pairs = pairs[:n_pairs]
+        
+        self._peak_freqs = self._peak_freqs[n_ready:]
+        self._peak_times = self._peak_times[n_ready:]
+        return pairs
+
 # Пример использования
 if __name__ == "__main__":
     fingerprint_system = AudioFingerprint()
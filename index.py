@@ -0,0 +1,380 @@
+"""
+Инвертированный индекс отпечатков в памяти и его файловый формат
+"""
+import os
+import struct
+import tempfile
+import threading
+import numpy as np
+from typing import Iterable, Optional, Tuple
+
+# Формат файла индекса: заголовок фиксированного размера, затем массивы
+# keys (int64), offsets (int64), song_ids (int32), time_offsets (int32),
+# каждый с начала выровненного блока. Порядок байт - little-endian.
+INDEX_MAGIC = b'MSHZIDX\0'
+INDEX_FORMAT_VERSION = 1
+INDEX_HEADER = struct.Struct('<8sIIQQQ')  # magic, version, reserved, n_keys, n_rows, last_song_id
+INDEX_ALIGNMENT = 64
+INDEX_ARRAYS = (('keys', '<i8'), ('offsets', '<i8'), ('song_ids', '<i4'), ('time_offsets', '<i4'))
+
+# Доля строк удаленных песен, после которой они вырезаются из массивов индекса
+COMPACT_FRACTION = 0.25
+
+class InMemoryIndex:
+    """
+    Инвертированный индекс в формате CSR
+    
+    keys - отсортированные уникальные хеши, offsets[i]:offsets[i + 1] - диапазон
+    строк хеша keys[i] в параллельных массивах song_ids и time_offsets.
+    Поиск - бинарный (np.searchsorted), без обращений к SQLite.
+    
+    Строки удаленных песен не вырезаются сразу: их ID попадают в
+    deleted_songs и отбрасываются при поиске, пока таких строк не станет
+    больше COMPACT_FRACTION (см. compact).
+    """
+    
+    def __init__(self, keys: np.ndarray, offsets: np.ndarray,
+                 song_ids: np.ndarray, time_offsets: np.ndarray, last_song_id: int = 0):
+        """
+        Args:
+            keys: Отсортированные уникальные хеши
+            offsets: Границы диапазонов строк для каждого хеша (длина len(keys) + 1)
+            song_ids: ID песен для всех строк
+            time_offsets: Время опорного пика для всех строк
+            last_song_id: Максимальный ID песни, загруженной в индекс
+        """
+        self.keys = keys
+        self.offsets = offsets
+        self.song_ids = song_ids
+        self.time_offsets = time_offsets
+        self.last_song_id = last_song_id
+        self.deleted_songs = np.array([], dtype=np.int64)
+        self._deleted_rows = 0
+        # Сколько строк каждой песни загружено (считается при первом обновлении)
+        self._loaded_songs: Optional[np.ndarray] = None
+        self._loaded_counts: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+    
+    @classmethod
+    def from_rows(cls, hashes: np.ndarray, song_ids: np.ndarray, time_offsets: np.ndarray,
+                  last_song_id: int = 0) -> 'InMemoryIndex':
+        """
+        Построение индекса из строк (hash, song_id, time_offset)
+        
+        Args:
+            hashes: Хеши строк
+            song_ids: ID песен строк
+            time_offsets: Время опорных пиков строк
+            last_song_id: Максимальный ID песни в этих строках
+        
+        Returns:
+            Индекс
+        """
+        return cls(*cls._build(hashes, song_ids, time_offsets), last_song_id=last_song_id)
+    
+    @staticmethod
+    def _build(hashes: np.ndarray, song_ids: np.ndarray,
+               time_offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Сортировка строк и построение массивов CSR"""
+        order = np.lexsort((time_offsets, song_ids, hashes))
+        hashes = hashes[order]
+        keys, starts = np.unique(hashes, return_index=True)
+        offsets = np.append(starts, len(hashes)).astype(np.int64)
+        return keys, offsets, song_ids[order].astype(np.int32), time_offsets[order].astype(np.int32)
+    
+    @classmethod
+    def load(cls, database) -> 'InMemoryIndex':
+        """
+        Загрузка всей таблицы отпечатков из SQLite
+        
+        Args:
+            database: FingerprintDatabase
+        
+        Returns:
+            Индекс
+        """
+        hashes, song_ids, time_offsets = database.fetch_fingerprint_rows()
+        last_song_id = int(song_ids.max()) if len(song_ids) else 0
+        return cls.from_rows(hashes, song_ids, time_offsets, last_song_id)
+    
+    def refresh(self, database, blocking: bool = True) -> int:
+        """
+        Инкрементальное обновление из SQLite
+        
+        Число загруженных строк каждой песни сравнивается с songs.fingerprint_count,
+        который меняется в одной транзакции со строками отпечатков. Поэтому песня,
+        чьи отпечатки еще не зафиксированы (add_song, затем add_fingerprint),
+        догрузится при следующем обновлении, а не потеряется. Строки новых песен
+        сортируются отдельно и вливаются в массивы индекса (np.insert), без
+        пересортировки всего каталога. Удаленные песни помечаются в deleted_songs.
+        
+        Args:
+            database: FingerprintDatabase
+            blocking: Ждать обновления, начатого другим потоком (False - вернуть 0)
+        
+        Returns:
+            Число добавленных строк
+        """
+        if not self._refresh_lock.acquire(blocking):
+            return 0
+        try:
+            if self._loaded_songs is None:
+                self._loaded_songs, self._loaded_counts = self._song_counts(self.song_ids)
+            loaded, loaded_counts = self._loaded_songs, self._loaded_counts
+            
+            song_ids, counts = database.get_fingerprint_counts()
+            # Сколько строк каждой песни из базы уже есть в индексе
+            positions = np.searchsorted(loaded, song_ids)
+            found = positions < len(loaded)
+            found[found] = loaded[positions[found]] == song_ids[found]
+            have = np.zeros(len(song_ids), dtype=np.int64)
+            have[found] = loaded_counts[positions[found]]
+            
+            stale = counts != have
+            changed = song_ids[stale]
+            # Песни, у которых поменялось число строк, загружаются заново целиком
+            reloaded = changed[have[stale] > 0]
+            removed = loaded[~np.isin(loaded, song_ids, assume_unique=True)]
+            
+            if len(changed) == 0 and len(removed) == 0:
+                return 0
+            
+            new_hashes, new_song_ids, new_offsets = database.fetch_fingerprint_rows(song_ids=changed.tolist())
+            
+            arrays = (self.keys, self.offsets, self.song_ids, self.time_offsets)
+            deleted = np.union1d(self.deleted_songs, removed)
+            deleted_rows = self._deleted_rows + int(loaded_counts[np.isin(loaded, removed)].sum())
+            if len(reloaded) or deleted_rows > COMPACT_FRACTION * len(self.song_ids):
+                arrays = self._compact(*arrays, np.union1d(deleted, reloaded))
+                deleted, deleted_rows = np.array([], dtype=np.int64), 0
+            if len(new_hashes):
+                arrays = self._merge(*arrays, *self._build(new_hashes, new_song_ids, new_offsets))
+            
+            # Учет загруженных строк: по факту выгруженного, а не по прочитанным счетчикам
+            fetched, fetched_counts = self._song_counts(new_song_ids)
+            kept = ~np.isin(loaded, np.concatenate([removed, changed]))
+            loaded = np.concatenate([loaded[kept], fetched])
+            order = np.argsort(loaded, kind='stable')
+            self._loaded_songs = loaded[order]
+            self._loaded_counts = np.concatenate([loaded_counts[kept], fetched_counts])[order]
+            
+            # Подменяем массивы разом, чтобы параллельный поиск видел согласованный индекс
+            with self._lock:
+                self.keys, self.offsets, self.song_ids, self.time_offsets = arrays
+                self.deleted_songs, self._deleted_rows = deleted, deleted_rows
+                if len(self._loaded_songs):
+                    self.last_song_id = max(self.last_song_id, int(self._loaded_songs[-1]))
+            
+            return len(new_hashes)
+        finally:
+            self._refresh_lock.release()
+    
+    def compact(self):
+        """Вырезание строк удаленных песен из массивов индекса"""
+        with self._refresh_lock:
+            if len(self.deleted_songs) == 0:
+                return
+            arrays = self._compact(self.keys, self.offsets, self.song_ids, self.time_offsets,
+                                   self.deleted_songs)
+            with self._lock:
+                self.keys, self.offsets, self.song_ids, self.time_offsets = arrays
+                self.deleted_songs, self._deleted_rows = np.array([], dtype=np.int64), 0
+    
+    @staticmethod
+    def _song_counts(song_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ID песен по возрастанию и число их строк"""
+        if len(song_ids) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        counts = np.bincount(song_ids)
+        present = np.flatnonzero(counts)
+        return present.astype(np.int64), counts[present].astype(np.int64)
+    
+    @staticmethod
+    def _compact(keys: np.ndarray, offsets: np.ndarray, song_ids: np.ndarray, time_offsets: np.ndarray,
+                 dropped_songs: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Массивы CSR без строк указанных песен (и без опустевших хешей)"""
+        alive = ~np.isin(song_ids, dropped_songs)
+        alive_before = np.concatenate([[0], np.cumsum(alive)])
+        counts = alive_before[offsets[1:]] - alive_before[offsets[:-1]]
+        non_empty = counts > 0
+        offsets = np.concatenate([[0], np.cumsum(counts[non_empty])]).astype(np.int64)
+        return keys[non_empty], offsets, song_ids[alive], time_offsets[alive]
+    
+    @staticmethod
+    def _merge(keys: np.ndarray, offsets: np.ndarray, song_ids: np.ndarray, time_offsets: np.ndarray,
+               new_keys: np.ndarray, new_offsets: np.ndarray, new_song_ids: np.ndarray,
+               new_time_offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Слияние двух CSR: строки нового хеша встают в конец его диапазона
+        (или туда, где был бы диапазон отсутствующего хеша)
+        """
+        if len(keys) == 0:
+            return new_keys, new_offsets, new_song_ids, new_time_offsets
+        new_keys = new_keys.astype(keys.dtype)
+        new_counts = np.diff(new_offsets)
+        
+        row_positions = offsets[np.searchsorted(keys, np.repeat(new_keys, new_counts), side='right')]
+        song_ids = np.insert(song_ids, row_positions, new_song_ids)
+        time_offsets = np.insert(time_offsets, row_positions, new_time_offsets)
+        
+        key_positions = np.searchsorted(keys, new_keys)
+        missing = key_positions == len(keys)
+        missing[~missing] = keys[key_positions[~missing]] != new_keys[~missing]
+        merged_keys = np.insert(keys, key_positions[missing], new_keys[missing])
+        counts = np.insert(np.diff(offsets), key_positions[missing], 0)
+        counts[np.searchsorted(merged_keys, new_keys)] += new_counts
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return merged_keys, offsets, song_ids, time_offsets
+    
+    def lookup(self, hashes: Iterable) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Поиск строк по набору хешей
+        
+        Args:
+            hashes: Уникальные хеши запроса
+        
+        Returns:
+            Кортеж массивов (hash_values, song_ids, time_offsets) найденных строк,
+            как у FingerprintDatabase.lookup_hashes
+        """
+        with self._lock:
+            keys, offsets = self.keys, self.offsets
+            song_ids, time_offsets = self.song_ids, self.time_offsets
+            deleted_songs = self.deleted_songs
+        
+        query = np.asarray(list(hashes) if not isinstance(hashes, np.ndarray) else hashes)
+        if len(query) == 0 or len(keys) == 0:
+            return (np.array([], dtype=keys.dtype), np.array([], dtype=np.int64),
+                    np.array([], dtype=np.int64))
+        query = query.astype(keys.dtype)
+        
+        positions = np.searchsorted(keys, query)
+        found = positions < len(keys)
+        found[found] = keys[positions[found]] == query[found]
+        positions = positions[found]
+        
+        # Собираем индексы строк всех найденных диапазонов
+        starts = offsets[positions]
+        counts = offsets[positions + 1] - starts
+        rows = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        row_hashes = np.repeat(keys[positions], counts)
+        
+        if len(deleted_songs):
+            alive = ~np.isin(song_ids[rows], deleted_songs)
+            rows, row_hashes = rows[alive], row_hashes[alive]
+        
+        return (row_hashes,
+                song_ids[rows].astype(np.int64),
+                time_offsets[rows].astype(np.int64))
+    
+    def __len__(self) -> int:
+        """Число строк в индексе (без строк удаленных песен)"""
+        return len(self.song_ids) - self._deleted_rows
+    
+    @property
+    def nbytes(self) -> int:
+        """Объем памяти, занимаемой массивами индекса"""
+        return self.keys.nbytes + self.offsets.nbytes + self.song_ids.nbytes + self.time_offsets.nbytes
+
+
+def _array_layout(n_keys: int, n_rows: int):
+    """Смещения и размеры массивов в файле индекса"""
+    lengths = {'keys': n_keys, 'offsets': n_keys + 1, 'song_ids': n_rows, 'time_offsets': n_rows}
+    position = INDEX_HEADER.size
+    for name, dtype in INDEX_ARRAYS:
+        position = -(-position // INDEX_ALIGNMENT) * INDEX_ALIGNMENT
+        yield name, np.dtype(dtype), position, lengths[name]
+        position += np.dtype(dtype).itemsize * lengths[name]
+
+def write_index_file(index: InMemoryIndex, path: str):
+    """
+    Сохранение индекса в файл для последующего открытия через np.memmap
+    
+    Файл сначала пишется во временный и затем атомарно подменяет старый,
+    поэтому воркеры, которые держат старый файл открытым, не пострадают.
+    
+    Args:
+        index: Индекс с целочисленными хешами
+        path: Путь к файлу индекса
+    """
+    if index.keys.dtype.kind not in 'iu':
+        raise ValueError("Файл индекса поддерживает только целочисленные хеши (hash_mode='packed')")
+    
+    n_keys, n_rows = len(index.keys), len(index.song_ids)
+    # Уникальное имя временного файла: параллельные экспорты в один путь не мешают друг другу
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                     dir=os.path.dirname(path) or '.')
+    try:
+        os.chmod(temp_path, 0o644)  # mkstemp создает файл только для владельца
+        with os.fdopen(fd, 'wb') as index_file:
+            index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_FORMAT_VERSION, 0,
+                                               n_keys, n_rows, index.last_song_id))
+            for name, dtype, position, length in _array_layout(n_keys, n_rows):
+                index_file.write(b'\0' * (position - index_file.tell()))
+                index_file.write(np.ascontiguousarray(getattr(index, name), dtype=dtype).tobytes())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+class MemmapIndex(InMemoryIndex):
+    """
+    Индекс только для чтения, отображенный из файла в память
+    
+    Массивы не копируются в память процесса: страницы файла берутся из
+    кеша ОС и разделяются всеми воркерами, открывшими тот же файл.
+    """
+    
+    def __init__(self, path: str):
+        """
+        Args:
+            path: Путь к файлу индекса (см. write_index_file)
+        """
+        self.path = path
+        super().__init__(*self._map(path))
+    
+    @staticmethod
+    def _map(path: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, int]:
+        """Чтение заголовка и отображение массивов файла"""
+        with open(path, 'rb') as index_file:
+            header = index_file.read(INDEX_HEADER.size)
+        if len(header) < INDEX_HEADER.size:
+            raise ValueError(f"Поврежденный файл индекса: {path}")
+        
+        magic, version, _, n_keys, n_rows, last_song_id = INDEX_HEADER.unpack(header)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"Файл не является индексом отпечатков: {path}")
+        if version != INDEX_FORMAT_VERSION:
+            raise ValueError(f"Неподдерживаемая версия индекса {version} (ожидается {INDEX_FORMAT_VERSION})")
+        
+        arrays = {}
+        for name, dtype, position, length in _array_layout(n_keys, n_rows):
+            if length == 0:
+                arrays[name] = np.empty(0, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=position, shape=(length,))
+        
+        return (arrays['keys'], arrays['offsets'], arrays['song_ids'], arrays['time_offsets'],
+                last_song_id)
+    
+    def refresh(self, database=None, blocking: bool = True) -> int:
+        """
+        Переоткрытие файла, если его перезаписали (например, новым экспортом)
+        
+        Returns:
+            Изменение числа строк индекса
+        """
+        if not self._refresh_lock.acquire(blocking):
+            return 0
+        try:
+            keys, offsets, song_ids, time_offsets, last_song_id = self._map(self.path)
+            added = len(song_ids) - len(self.song_ids)
+            with self._lock:
+                self.keys, self.offsets = keys, offsets
+                self.song_ids, self.time_offsets = song_ids, time_offsets
+                self.last_song_id = last_song_id
+            return added
+        finally:
+            self._refresh_lock.release()
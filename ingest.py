@@ -0,0 +1,259 @@
+"""
+Массовое добавление песен в базу данных
+"""
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+import numpy as np
+from fingerprint import AudioFingerprint, fingerprint_dtype
+from decoder import iter_decode_blocks
+from database import FingerprintDatabase
+
+# Расширения файлов, которые считаются аудио при обходе директории
+AUDIO_EXTENSIONS = ('.mp3', '.wav', '.flac', '.ogg', '.m4a', '.aac', '.aiff', '.au')
+
+# Отпечатки, создаваемые в процессе-воркере (по одному на процесс)
+_worker_fingerprint_system = None
+
+def iter_audio_files(source: str) -> Iterator[Tuple[str, Optional[str], Optional[str]]]:
+    """
+    Перебор аудио файлов из директории или манифеста
+    
+    Манифест - текстовый файл, в каждой строке путь к файлу и, через табуляцию,
+    необязательные название и исполнитель. Пустые строки и строки с # пропускаются.
+    
+    Args:
+        source: Путь к директории или файлу манифеста
+    
+    Yields:
+        Кортежи (путь_к_файлу, название, исполнитель)
+    """
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for file_name in sorted(files):
+                if file_name.lower().endswith(AUDIO_EXTENSIONS):
+                    yield os.path.join(root, file_name), None, None
+        return
+    
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source, encoding='utf-8') as manifest:
+        for line in manifest:
+            line = line.rstrip('\n')
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            
+            fields = line.split('\t')
+            file_path = fields[0].strip()
+            if not os.path.isabs(file_path):
+                file_path = os.path.join(base_dir, file_path)
+            name = fields[1].strip() or None if len(fields) > 1 else None
+            artist = fields[2].strip() or None if len(fields) > 2 else None
+            yield file_path, name, artist
+
+def _init_worker(params: Dict[str, Any]):
+    """Инициализация процесса-воркера: создаем систему отпечатков один раз"""
+    global _worker_fingerprint_system
+    _worker_fingerprint_system = AudioFingerprint(**params)
+
+def _worker_args(fingerprint_system: AudioFingerprint, cache_dir: Optional[str] = None) -> tuple:
+    """
+    Аргументы _init_worker: все параметры системы отпечатков (см. AudioFingerprint.params),
+    чтобы хеши воркеров совпадали с хешами текущего процесса
+    """
+    params = fingerprint_system.params()
+    if cache_dir is not None:
+        params['cache_dir'] = cache_dir
+    return (params,)
+
+def _fingerprint_file(file_path: str) -> Tuple[str, Optional[float], Optional[np.ndarray], Optional[str]]:
+    """
+    Декодирование и создание отпечатка файла в процессе-воркере
+    
+    Returns:
+        Кортеж (путь_к_файлу, длительность, отпечаток, ошибка)
+    """
+    try:
+        processor = _worker_fingerprint_system.audio_processor
+        if _worker_fingerprint_system.file_cache is not None:
+            # С кешем повторная обработка файла сводится к генерации пар
+            freq_bins, time_bins, samples = _worker_fingerprint_system.file_peaks(file_path)
+            fingerprint = _worker_fingerprint_system.generate_pairs(freq_bins, time_bins)
+            return file_path, samples / processor.sample_rate, fingerprint, None
+        
+        samples = 0
+        
+        def blocks():
+            nonlocal samples
+            for block in iter_decode_blocks(file_path, processor.sample_rate):
+                samples += len(block)
+                yield block
+        
+        # Блочная обработка: память воркера не зависит от длины записи (часовые миксы)
+        parts = list(_worker_fingerprint_system.iter_fingerprint(blocks()))
+        fingerprint = (np.concatenate(parts) if parts else
+                       np.empty(0, dtype=fingerprint_dtype(_worker_fingerprint_system.hash_mode)))
+        return file_path, samples / processor.sample_rate, fingerprint, None
+    except Exception as e:
+        return file_path, None, None, str(e) or type(e).__name__
+
+def _fingerprint_query(item: Union[str, np.ndarray],
+                       fingerprint_system: Optional[AudioFingerprint] = None) -> Tuple[Optional[np.ndarray], Dict[str, float], Optional[str]]:
+    """
+    Отпечаток запроса на распознавание (в процессе-воркере или в текущем процессе)
+    
+    Args:
+        item: Путь к аудио файлу или аудио данные
+        fingerprint_system: Система отпечатков (по умолчанию - система воркера)
+    
+    Returns:
+        Кортеж (отпечаток, время_этапов_в_секундах, ошибка)
+    """
+    fingerprint_system = fingerprint_system or _worker_fingerprint_system
+    timings = {'decode': 0.0, 'fingerprint': 0.0}
+    try:
+        start_time = time.perf_counter()
+        if isinstance(item, str):
+            item = fingerprint_system.audio_processor.load_audio_file(item)
+            timings['decode'] = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+        fingerprint = fingerprint_system.create_fingerprint_array(item)
+        timings['fingerprint'] = time.perf_counter() - start_time
+        return fingerprint, timings, None
+    except Exception as e:
+        return None, timings, str(e) or type(e).__name__
+
+def fingerprint_queries(fingerprint_system: AudioFingerprint, items: List[Union[str, np.ndarray]],
+                        workers: Optional[int] = None,
+                        executor: Optional[Executor] = None) -> List[Tuple[Optional[np.ndarray], Dict[str, float], Optional[str]]]:
+    """
+    Параллельное создание отпечатков для набора запросов
+    
+    Args:
+        fingerprint_system: Система отпечатков (параметры берутся из нее)
+        items: Пути к аудио файлам или аудио данные
+        workers: Число процессов (по умолчанию - число ядер, 1 - без пула процессов)
+        executor: Готовый пул, запущенный с _init_worker и параметрами fingerprint_system
+                  (None - пул создается на время вызова)
+    
+    Returns:
+        Список кортежей (отпечаток, время_этапов_в_секундах, ошибка) в порядке items
+    """
+    workers = min(workers or os.cpu_count() or 1, len(items)) or 1
+    if workers == 1:
+        return [_fingerprint_query(item, fingerprint_system) for item in items]
+    if executor is not None:
+        return list(executor.map(_fingerprint_query, items))
+    
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=_worker_args(fingerprint_system)) as executor:
+        return list(executor.map(_fingerprint_query, items))
+
+def bulk_ingest(database: FingerprintDatabase, source: str, workers: Optional[int] = None,
+                batch_size: int = 50, resume: bool = True,
+                progress: Optional[Callable[[Dict[str, float]], None]] = None,
+                cache_dir: Optional[str] = None) -> Dict[str, object]:
+    """
+    Параллельное добавление каталога песен в базу данных
+    
+    Файлы декодируются и обрабатываются в пуле процессов, а запись в базу
+    ведет один писатель (текущий процесс) крупными транзакциями по batch_size
+    песен. Если прошлый запуск упал, уже добавленные файлы пропускаются.
+    
+    Args:
+        database: База данных отпечатков
+        source: Директория с аудио файлами или файл манифеста
+        workers: Число процессов (по умолчанию - число ядер)
+        batch_size: Сколько песен записывать одной транзакцией
+        resume: Пропускать файлы, которые уже есть в songs.file_path
+        progress: Функция, которой передается статистика после каждой транзакции
+        cache_dir: Директория кеша сигнала и пиков (см. FingerprintCache): при
+                   пересборке базы с другими параметрами пар файлы не декодируются
+                   заново. Файлы с кешем обрабатываются целиком, а не блоками
+    
+    Returns:
+        Словарь со статистикой: files, skipped, failed, hashes, elapsed,
+        files_per_sec, hashes_per_sec и errors - список (путь_к_файлу, ошибка)
+    """
+    workers = workers or os.cpu_count() or 1
+    items = list(iter_audio_files(source))
+    
+    # Пути храним абсолютными, чтобы повторный запуск из другой директории их узнал
+    done_paths = set()
+    if resume:
+        done_paths = {os.path.abspath(file_path) for file_path in database.get_song_paths()}
+    pending = {}
+    for file_path, name, artist in items:
+        file_path = os.path.abspath(file_path)
+        if file_path not in done_paths and file_path not in pending:
+            pending[file_path] = (name, artist)
+    
+    stats = {'files': 0, 'skipped': len(items) - len(pending), 'failed': 0, 'hashes': 0,
+             'elapsed': 0.0, 'files_per_sec': 0.0, 'hashes_per_sec': 0.0}
+    errors: List[Tuple[str, str]] = []
+    batch = []
+    start_time = time.perf_counter()
+    
+    def flush():
+        if batch:
+            database.add_songs_batch(batch)
+            stats['files'] += len(batch)
+            stats['hashes'] += sum(len(fingerprint) for *_, fingerprint in batch)
+            batch.clear()
+        
+        stats['elapsed'] = time.perf_counter() - start_time
+        if stats['elapsed'] > 0:
+            stats['files_per_sec'] = stats['files'] / stats['elapsed']
+            stats['hashes_per_sec'] = stats['hashes'] / stats['elapsed']
+        if progress is not None:
+            progress(dict(stats))
+    
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=_worker_args(database.fingerprint_system, cache_dir)) as executor:
+        paths = iter(pending)
+        in_flight = set()
+        # Ограничиваем число задач в полете, чтобы не держать в памяти весь каталог
+        max_in_flight = workers * 4
+        
+        while True:
+            for file_path in paths:
+                in_flight.add(executor.submit(_fingerprint_file, file_path))
+                if len(in_flight) >= max_in_flight:
+                    break
+            if not in_flight:
+                break
+            
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                file_path, duration, fingerprint, error = future.result()
+                if error is not None:
+                    stats['failed'] += 1
+                    errors.append((file_path, error))
+                    continue
+                
+                name, artist = pending[file_path]
+                if name is None:
+                    name = os.path.splitext(os.path.basename(file_path))[0]
+                batch.append((name, artist, file_path, duration, fingerprint))
+                
+                if len(batch) >= batch_size:
+                    flush()
+    
+    flush()
+    stats['errors'] = errors
+    return stats
+
+# Пример использования
+if __name__ == "__main__":
+    import sys
+    
+    if len(sys.argv) < 2:
+        print("Использование: python ingest.py <директория_или_манифест> [путь_к_базе]")
+        sys.exit(1)
+    
+    db = FingerprintDatabase(sys.argv[2] if len(sys.argv) > 2 else "data/fingerprints.db")
+    result = bulk_ingest(db, sys.argv[1], progress=lambda s: print(
+        f"  {s['files']} файлов, {s['files_per_sec']:.2f} файл/с, {s['hashes_per_sec']:.0f} хеш/с"
+    ))
+    print(f"Добавлено: {result['files']}, пропущено: {result['skipped']}, ошибок: {result['failed']}")
@@ -4,26 +4,74 @@
 import sys
 import os
 import argparse
+import json
 from music_recognizer import MusicRecognizer
-from gui import MusicRecognizerGUI
+from cache import FingerprintCache
+from database import BACKEND_MEMORY, BACKEND_SQLITE
+from metrics import Metrics
 
 def main():
     """Главная функция"""
     parser = argparse.ArgumentParser(description="MyShazam - Распознавание музыки")
     parser.add_argument("--gui", action="store_true", help="Запустить графический интерфейс")
     parser.add_argument("--add-song", type=str, help="Добавить песню в базу данных")
+    parser.add_argument("--add-dir", type=str,
+                        help="Добавить все песни из директории или файла манифеста (параллельно)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Число процессов для --add-dir и --recognize-dir (по умолчанию - число ядер)")
+    parser.add_argument("--batch-size", type=int, default=50,
+                        help="Сколько песен записывать одной транзакцией в --add-dir "
+                             "или распознавать одним пакетом в --recognize-dir")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Не пропускать файлы, которые уже есть в базе (--add-dir)")
+    parser.add_argument("--fingerprint-cache", type=str,
+                        help="Директория кеша сигнала и пиков для --add-song и --add-dir: "
+                             "пересборка базы не декодирует файлы заново")
     parser.add_argument("--recognize", type=str, help="Распознать песню из файла")
+    parser.add_argument("--recognize-dir", type=str,
+                        help="Распознать все файлы из директории или манифеста (результаты - JSON строки)")
+    parser.add_argument("--monitor", type=str,
+                        help="Журнал песен в длинной записи ('mic' - с микрофона), JSON строки")
+    parser.add_argument("--listen", action="store_true",
+                        help="Распознать с микрофона, остановившись при уверенном совпадении")
     parser.add_argument("--list-songs", action="store_true", help="Показать список песен в базе данных")
+    parser.add_argument("--migrate-hashes", action="store_true",
+                        help="Перевести базу с MD5-хешей на целочисленные (пересчет из файлов)")
+    parser.add_argument("--upgrade-schema", action="store_true",
+                        help="Перевести таблицу отпечатков на компактную схему 2 (WITHOUT ROWID)")
+    parser.add_argument("--export-index", type=str,
+                        help="Выгрузить отпечатки в файл индекса для быстрого поиска (mmap)")
+    parser.add_argument("--build-stop-list", type=float, metavar="FRACTION",
+                        help="Построить стоп-лист хешей, которые есть больше чем в FRACTION песен "
+                             "(например 0.01); при поиске они пропускаются")
+    parser.add_argument("--prune-stop-list", action="store_true",
+                        help="С --build-stop-list: удалить частые хеши из базы")
+    parser.add_argument("--serve", action="store_true",
+                        help="Запустить HTTP сервис распознавания (/recognize, /ingest, /stats, /metrics)")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="С --serve: адрес сервиса")
+    parser.add_argument("--port", type=int, default=8000, help="С --serve: порт сервиса")
+    parser.add_argument("--max-pending", type=int, default=32,
+                        help="С --serve: сколько запросов обрабатывать одновременно (сверх - ответ 429)")
+    parser.add_argument("--backend", choices=[BACKEND_SQLITE, BACKEND_MEMORY], default=None,
+                        help="Поиск по хешам: sqlite или memory (индекс в памяти, по умолчанию для --serve)")
+    parser.add_argument("--profile", action="store_true",
+                        help="С --recognize: показать время этапов и счетчики распознавания")
     parser.add_argument("--db-path", type=str, default="data/fingerprints.db", help="Путь к базе данных")
     
     args = parser.parse_args()
     
     # Инициализируем систему распознавания
-    recognizer = MusicRecognizer(args.db_path)
+    backend = args.backend or (BACKEND_MEMORY if args.serve else BACKEND_SQLITE)
+    # Сервису метрики этапов нужны всегда (/metrics), остальным командам - нет
+    recognizer = MusicRecognizer(args.db_path, backend=backend,
+                                 metrics=Metrics() if args.serve else None)
+    if args.fingerprint_cache:
+        recognizer.database.fingerprint_system.file_cache = FingerprintCache(args.fingerprint_cache)
     
     if args.gui:
         # Запускаем графический интерфейс
         print("Запуск графического интерфейса...")
+        from gui import MusicRecognizerGUI  # tkinter - только для GUI
         app = MusicRecognizerGUI()
         app.run()
     
@@ -41,6 +89,30 @@ def main():
             print(f"Ошибка при добавлении песни: {e}")
             return 1
     
+    elif args.add_dir:
+        # Массово добавляем песни
+        if not os.path.exists(args.add_dir):
+            print(f"Ошибка: {args.add_dir} не найден")
+            return 1
+        
+        print(f"Добавление песен из: {args.add_dir}")
+        try:
+            from ingest import bulk_ingest
+            stats = bulk_ingest(
+                recognizer.database, args.add_dir,
+                workers=args.workers, batch_size=args.batch_size, resume=not args.no_resume,
+                progress=lambda s: print(f"  Добавлено {s['files']} песен: "
+                                         f"{s['files_per_sec']:.2f} файл/с, "
+                                         f"{s['hashes_per_sec']:.0f} хеш/с")
+            )
+            print(f"Готово за {stats['elapsed']:.1f}с: добавлено {stats['files']}, "
+                  f"пропущено {stats['skipped']}, ошибок {stats['failed']}")
+            for file_path, error in stats['errors']:
+                print(f"  Ошибка в {file_path}: {error}")
+        except Exception as e:
+            print(f"Ошибка при добавлении песен: {e}")
+            return 1
+    
     elif args.recognize:
         # Распознаем песню
         if not os.path.exists(args.recognize):
@@ -49,16 +121,91 @@ def main():
         
         print(f"Распознавание песни: {args.recognize}")
         try:
-            result = recognizer.recognize_from_file(args.recognize)
+            if args.profile:
+                result, breakdown = recognizer.recognize_from_file(args.recognize, with_metrics=True)
+            else:
+                result = recognizer.recognize_from_file(args.recognize)
             if result:
                 name, artist, similarity = result
                 print(f"Результат: {name} - {artist} (схожесть: {similarity:.1%})")
             else:
                 print("Песня не распознана")
+            if args.profile:
+                for stage, seconds in breakdown['timings'].items():
+                    print(f"  {stage:<12} {1000 * seconds:8.1f} мс")
+                for name, value in breakdown['counters'].items():
+                    print(f"  {name:<12} {value:8d}")
         except Exception as e: # try to another (reminder)
             print(f"Ошибка при распознавании: {e}")
             return 1
     
+    elif args.recognize_dir:
+        # Распознаем пакетами, результат каждого файла - строка JSON
+        if not os.path.exists(args.recognize_dir):
+            print(f"Ошибка: {args.recognize_dir} не найден", file=sys.stderr)
+            return 1
+        
+        try:
+            from ingest import iter_audio_files
+            paths = [file_path for file_path, _, _ in iter_audio_files(args.recognize_dir)]
+            for start in range(0, len(paths), args.batch_size):
+                batch = paths[start:start + args.batch_size]
+                for file_path, result in zip(batch, recognizer.recognize_batch(batch, workers=args.workers)):
+                    line = {'file': file_path, 'error': result['error']}
+                    match = result['match']
+                    if match:
+                        line.update(name=match[0], artist=match[1], similarity=round(match[2], 4))
+                        if len(match) > 3:
+                            line['offset'] = round(match[3], 3)
+                    line['timings_ms'] = {stage: round(seconds * 1000, 2)
+                                          for stage, seconds in result['timings'].items()}
+                    print(json.dumps(line, ensure_ascii=False), flush=True)
+        except Exception as e:
+            print(f"Ошибка при распознавании: {e}", file=sys.stderr)
+            return 1
+        finally:
+            recognizer.close()
+    
+    elif args.monitor:
+        # Журнал эфира: по строке JSON на найденный фрагмент
+        if args.monitor != "mic" and not os.path.exists(args.monitor):
+            print(f"Ошибка: Файл {args.monitor} не найден", file=sys.stderr)
+            return 1
+        
+        try:
+            segments = recognizer.monitor_file(None if args.monitor == "mic" else args.monitor)
+            info = recognizer.database.get_songs_info([segment.song_id for segment in segments])
+            for segment in segments:
+                name, artist, _ = info.get(segment.song_id, (None, None, 0))
+                print(json.dumps({'start': round(segment.start, 2), 'end': round(segment.end, 2),
+                                  'song_id': segment.song_id, 'name': name, 'artist': artist,
+                                  'confidence': round(segment.confidence, 4)}, ensure_ascii=False))
+        except Exception as e:
+            print(f"Ошибка при мониторинге: {e}", file=sys.stderr)
+            return 1
+    
+    elif args.listen:
+        # Распознаем с микрофона в потоковом режиме
+        print("Слушаем микрофон (до 10 секунд)...")
+        try:
+            result = recognizer.recognize_streaming()
+            if result:
+                name, artist, similarity = result
+                print(f"Результат: {name} - {artist} (схожесть: {similarity:.1%})")
+            else:
+                print("Песня не распознана")
+        except Exception as e:
+            print(f"Ошибка при распознавании: {e}")
+            return 1
+    
+    elif args.serve:
+        # Запускаем HTTP сервис: база и индекс загружаются один раз
+        from server import RecognitionServer
+        server = RecognitionServer(recognizer, args.host, args.port, workers=args.workers,
+                                   max_pending=args.max_pending)
+        print(f"Сервис распознавания: http://{args.host}:{args.port} (Ctrl+C - остановка)")
+        server.run()
+    
     elif args.list_songs:
         # Показываем список песен
         try:
@@ -74,9 +221,61 @@ def main():
             print(f"Ошибка при получении списка песен: {e}")
             return 1
     
+    elif args.migrate_hashes:
+        # Переводим старую базу на целочисленные хеши
+        print(f"Миграция базы {args.db_path} на целочисленные хеши...")
+        try:
+            result = recognizer.database.migrate_to_packed_hashes(skip_missing=True)
+            print(f"Перенесено песен: {result['migrated']}")
+            if result['skipped']:
+                print(f"Пропущены (нет файла): {result['skipped']}")
+        except Exception as e:
+            print(f"Ошибка при миграции: {e}")
+            return 1
+    
+    elif args.upgrade_schema:
+        # Переводим таблицу отпечатков на схему 2
+        print(f"Перевод базы {args.db_path} на схему 2...")
+        try:
+            stats = recognizer.database.upgrade_schema()
+            print(f"Готово: {stats['rows']} строк, "
+                  f"{stats['bytes_before'] / 1024 / 1024:.1f} -> {stats['bytes_after'] / 1024 / 1024:.1f} МБ")
+            if stats['duplicates']:
+                print(f"Удалено повторов: {stats['duplicates']}")
+        except Exception as e:
+            print(f"Ошибка при переводе схемы: {e}")
+            return 1
+    
+    elif args.export_index:
+        # Выгружаем файл индекса
+        print(f"Экспорт индекса в {args.export_index}...")
+        try:
+            stats = recognizer.database.export_index(args.export_index)
+            print(f"Готово: {stats['keys']} хешей, {stats['rows']} строк, "
+                  f"{stats['bytes'] / 1024 / 1024:.1f} МБ")
+        except Exception as e:
+            print(f"Ошибка при экспорте индекса: {e}")
+            return 1
+    
+    elif args.build_stop_list is not None:
+        # Строим стоп-лист частых хешей
+        print(f"Построение стоп-листа (хеши чаще чем в {args.build_stop_list:.1%} песен)...")
+        try:
+            stats = recognizer.database.build_stop_list(args.build_stop_list,
+                                                        prune=args.prune_stop_list)
+            share = stats['stop_rows'] / stats['total_rows'] if stats['total_rows'] else 0.0
+            print(f"Готово: {stats['stop_hashes']} хешей (порог {stats['limit']} песен), "
+                  f"{stats['stop_rows']} строк отпечатков ({share:.1%})")
+            if stats['pruned_rows']:
+                print(f"Удалено строк: {stats['pruned_rows']}")
+        except Exception as e:
+            print(f"Ошибка при построении стоп-листа: {e}")
+            return 1
+    
     else:
         # По умолчанию запускаем GUI
         print("Запуск графического интерфейса...")
+        from gui import MusicRecognizerGUI  # tkinter - только для GUI
         app = MusicRecognizerGUI()
         app.run()
     
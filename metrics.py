@@ -0,0 +1,272 @@
+"""
+Метрики распознавания: время этапов, счетчики, приемники и экспорт в Prometheus
+
+Этапы размечаются через span() и count() прямо в коде обработки (декодер,
+спектрограмма, пики, хеши, поиск в базе). Пока трассировка не включена через
+tracing(), span() возвращает общий пустой контекстный менеджер, а count()
+ничего не делает, поэтому выключенные метрики почти ничего не стоят.
+Активная трассировка хранится в contextvars: у каждого потока (и задачи
+asyncio) своя, параллельные запросы не смешиваются.
+"""
+import time
+import bisect
+import threading
+import contextlib
+import contextvars
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Границы корзин гистограмм задержки в секундах (как у клиентов Prometheus)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Для этапов распознавания нужны корзины мельче: поиск в памяти занимает около 1 мс
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Трассировка текущего запроса (None - метрики выключены)
+_active_trace = contextvars.ContextVar('myshazam_trace', default=None)
+
+class LatencyHistogram:
+    """
+    Гистограмма задержек с фиксированными корзинами
+    
+    Без блокировок: обновлять из одного потока или под блокировкой владельца.
+    """
+    
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # последняя корзина - больше всех границ
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+    
+    def observe(self, seconds: float):
+        """Учет одного измерения"""
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+    
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля сверху: граница корзины, в которую он попал"""
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+    
+    def stats(self) -> Dict[str, float]:
+        """
+        Сводка гистограммы
+        
+        Returns:
+            Словарь: count, mean, p50, p95, p99, max (секунды)
+        """
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'max': self.max,
+        }
+    
+    def prometheus(self, name: str, labels: str) -> List[str]:
+        """Строки гистограммы в текстовом формате Prometheus"""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+class Trace:
+    """Время этапов (секунды) и счетчики одного запроса"""
+    
+    __slots__ = ('timings', 'counters')
+    
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+        self.counters: Dict[str, int] = {}
+    
+    def as_dict(self) -> Dict[str, Dict[str, float]]:
+        """Разбивка запроса: {'timings': {...}, 'counters': {...}}"""
+        return {'timings': dict(self.timings), 'counters': dict(self.counters)}
+
+class _Span:
+    """Замер времени этапа (время повторных входов в этап складывается)"""
+    
+    __slots__ = ('trace', 'stage', 'start')
+    
+    def __init__(self, trace: Trace, stage: str):
+        self.trace = trace
+        self.stage = stage
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        timings = self.trace.timings
+        timings[self.stage] = timings.get(self.stage, 0.0) + time.perf_counter() - self.start
+        return False
+
+class _NullSpan:
+    """Пустой замер для выключенных метрик"""
+    
+    __slots__ = ()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+def enabled() -> bool:
+    """Включена ли трассировка в текущем контексте (для дорогих счетчиков)"""
+    return _active_trace.get() is not None
+
+def span(stage: str):
+    """
+    Контекстный менеджер замера этапа
+    
+    Args:
+        stage: Название этапа ('decode', 'spectrogram', 'peaks', 'hashing', 'lookup', 'score')
+    """
+    trace = _active_trace.get()
+    return _NULL_SPAN if trace is None else _Span(trace, stage)
+
+def count(name: str, value: int = 1):
+    """
+    Увеличение счетчика текущего запроса
+    
+    Args:
+        name: Название счетчика ('peaks', 'hashes', 'rows_fetched', 'candidates'...)
+        value: На сколько увеличить
+    """
+    trace = _active_trace.get()
+    if trace is not None:
+        trace.counters[name] = trace.counters.get(name, 0) + value
+
+@contextlib.contextmanager
+def tracing(trace: Optional[Trace] = None) -> Iterator[Trace]:
+    """
+    Включение трассировки в текущем контексте
+    
+    Args:
+        trace: Куда записывать (по умолчанию - новая трассировка)
+    
+    Yields:
+        Трассировка, в которую пишут span() и count()
+    """
+    trace = trace if trace is not None else Trace()
+    token = _active_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _active_trace.reset(token)
+
+class Metrics:
+    """
+    Накопитель метрик распознавания
+    
+    Собирает трассировки запросов в гистограммы времени этапов и суммы
+    счетчиков и передает каждую трассировку приемникам (например, в журнал
+    медленных запросов). Безопасен для использования из нескольких потоков.
+    """
+    
+    def __init__(self, buckets: Tuple[float, ...] = STAGE_BUCKETS):
+        """
+        Args:
+            buckets: Границы корзин гистограмм времени этапов в секундах
+        """
+        self.buckets = tuple(buckets)
+        self.requests = 0
+        self.sink_errors = 0
+        self.stages: Dict[str, LatencyHistogram] = {}
+        self.counters: Dict[str, int] = {}
+        self._sinks: List[Callable[[Dict[str, Dict[str, float]]], None]] = []
+        self._lock = threading.Lock()
+    
+    def add_sink(self, sink: Callable[[Dict[str, Dict[str, float]]], None]):
+        """
+        Подписка на трассировки запросов
+        
+        Args:
+            sink: Функция, которая получает разбивку запроса (см. Trace.as_dict).
+                  Вызывается в потоке запроса, ее исключения не прерывают
+                  распознавание и считаются в sink_errors
+        """
+        self._sinks.append(sink)
+    
+    def remove_sink(self, sink: Callable[[Dict[str, Dict[str, float]]], None]):
+        """Отписка приемника"""
+        self._sinks.remove(sink)
+    
+    def record(self, trace: Trace):
+        """
+        Учет трассировки одного запроса
+        
+        Args:
+            trace: Трассировка запроса
+        """
+        with self._lock:
+            self.requests += 1
+            for stage, seconds in trace.timings.items():
+                histogram = self.stages.get(stage)
+                if histogram is None:
+                    histogram = self.stages[stage] = LatencyHistogram(self.buckets)
+                histogram.observe(seconds)
+            for name, value in trace.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+        
+        if self._sinks:
+            breakdown = trace.as_dict()
+            for sink in list(self._sinks):
+                try:
+                    sink(breakdown)
+                except Exception:
+                    self.sink_errors += 1
+    
+    def stats(self) -> Dict[str, object]:
+        """
+        Сводка метрик
+        
+        Returns:
+            Словарь: requests, stages - сводка гистограммы каждого этапа
+            (см. LatencyHistogram.stats), counters - суммы счетчиков
+        """
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'stages': {stage: histogram.stats() for stage, histogram in sorted(self.stages.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+    
+    def prometheus(self, prefix: str = 'myshazam') -> str:
+        """
+        Метрики в текстовом формате Prometheus
+        
+        Args:
+            prefix: Префикс имен метрик
+        
+        Returns:
+            Текст для эндпоинта /metrics
+        """
+        with self._lock:
+            lines = [f'# HELP {prefix}_stage_seconds Время этапов распознавания',
+                     f'# TYPE {prefix}_stage_seconds histogram']
+            for stage, histogram in sorted(self.stages.items()):
+                lines.extend(histogram.prometheus(f'{prefix}_stage_seconds', f'stage="{stage}"'))
+            lines += [f'# HELP {prefix}_stage_events_total Счетчики этапов распознавания',
+                      f'# TYPE {prefix}_stage_events_total counter']
+            lines += [f'{prefix}_stage_events_total{{counter="{name}"}} {value}'
+                      for name, value in sorted(self.counters.items())]
+            lines += [f'# TYPE {prefix}_recognitions_total counter',
+                      f'{prefix}_recognitions_total {self.requests}']
+        return '\n'.join(lines) + '\n'
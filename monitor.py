@@ -0,0 +1,215 @@
+"""
+Мониторинг эфира: какие песни каталога и когда звучат в длинном потоке
+"""
+import collections
+import numpy as np
+from typing import Iterable, List, NamedTuple, Optional
+from fingerprint import StreamingFingerprinter
+from database import offset_matches, best_offsets
+from decoder import iter_decode_blocks
+from streaming import microphone_chunks
+
+class Segment(NamedTuple):
+    """Фрагмент эфира, в котором звучит песня"""
+    start: float        # начало в секундах от начала потока
+    end: float          # конец в секундах
+    song_id: int
+    confidence: float   # лучшая доля выровненных хешей среди окон фрагмента
+
+class BroadcastMonitor:
+    """
+    Скользящее окно по длинному потоку с журналом песен
+    
+    Отпечаток всего потока строится один раз (StreamingFingerprinter), поэтому
+    перекрывающиеся окна не пересчитывают спектрограмму и пики. Поток режется
+    на шаги по hop_seconds: хеши шага ищутся в базе один раз, найденные пары
+    (песня, сдвиг) хранятся, пока шаг входит в окно, а окно оценивается
+    гистограммой сдвигов по парам своих шагов. Соседние попадания в ту же
+    песню с тем же сдвигом склеиваются в один фрагмент.
+    """
+    
+    def __init__(self, recognizer, window_seconds: float = 10.0, hop_seconds: float = 2.0,
+                 threshold: float = 0.05, min_aligned: int = 20,
+                 max_gap_seconds: Optional[float] = None, offset_tolerance: float = 0.5):
+        """
+        Args:
+            recognizer: MusicRecognizer (база и параметры отпечатков)
+            window_seconds: Длина окна распознавания
+            hop_seconds: Шаг окна
+            threshold: Минимальная доля выровненных хешей окна
+            min_aligned: Минимальное число выровненных хешей окна
+            max_gap_seconds: Пропуск, после которого фрагмент закрывается
+                             (по умолчанию - длина окна)
+            offset_tolerance: Допустимое расхождение сдвига (в секундах), при котором
+                              попадания считаются продолжением одного фрагмента
+        """
+        self.database = recognizer.database
+        self.fingerprint_system = recognizer.fingerprint_system
+        processor = self.fingerprint_system.audio_processor
+        
+        self.hop_frames = max(1, int(round(hop_seconds * processor.sample_rate / processor.hop_length)))
+        self.window_hops = max(1, int(round(window_seconds / hop_seconds)))
+        self.threshold = threshold
+        self.min_aligned = min_aligned
+        self.max_gap_frames = int((window_seconds if max_gap_seconds is None else max_gap_seconds)
+                                  * processor.sample_rate / processor.hop_length)
+        self.offset_tolerance_frames = int(offset_tolerance * processor.sample_rate / processor.hop_length)
+        self.reset()
+    
+    def reset(self):
+        """Сброс состояния для нового потока"""
+        self.fingerprinter = StreamingFingerprinter(self.fingerprint_system)
+        self._pending = []                # пары отпечатка, еще не разложенные по шагам
+        self._next_hop = 0                # номер следующего шага для оценки
+        self._window = collections.deque(maxlen=self.window_hops)
+        self._open = None                 # [start, end, song_id, confidence, delta] в кадрах
+        self.segments: List[Segment] = []
+    
+    def feed(self, chunk: np.ndarray) -> List[Segment]:
+        """
+        Обработка очередного блока аудио
+        
+        Args:
+            chunk: Блок аудио данных
+        
+        Returns:
+            Фрагменты, закрытые после этого блока
+        """
+        closed = len(self.segments)
+        self._pending.append(self.fingerprinter.update(chunk))
+        self._process_hops(self.fingerprinter.complete_frames)
+        return self.segments[closed:]
+    
+    def finish(self) -> List[Segment]:
+        """
+        Завершение потока
+        
+        Returns:
+            Все фрагменты потока (журнал)
+        """
+        self._pending.append(self.fingerprinter.finish())
+        total_frames = int(self.fingerprinter.samples_seen // self.fingerprint_system.audio_processor.hop_length)
+        self._process_hops(total_frames + self.hop_frames)
+        self._close_segment()
+        return self.segments
+    
+    def process(self, chunks: Iterable[np.ndarray]) -> List[Segment]:
+        """
+        Журнал песен по итератору блоков аудио
+        
+        Args:
+            chunks: Блоки аудио данных
+        
+        Returns:
+            Список фрагментов Segment(start, end, song_id, confidence)
+        """
+        self.reset()
+        for chunk in chunks:
+            self.feed(chunk)
+        return self.finish()
+    
+    def process_file(self, file_path: str, block_seconds: float = 30.0) -> List[Segment]:
+        """
+        Журнал песен для длинного файла (читается блоками)
+        
+        Args:
+            file_path: Путь к аудио файлу
+            block_seconds: Длительность блока чтения в секундах
+        
+        Returns:
+            Список фрагментов Segment(start, end, song_id, confidence)
+        """
+        sample_rate = self.fingerprint_system.audio_processor.sample_rate
+        return self.process(iter_decode_blocks(file_path, sample_rate, block_seconds))
+    
+    def process_microphone(self, duration: Optional[float] = None) -> List[Segment]:
+        """
+        Журнал песен с микрофона
+        
+        Args:
+            duration: Длительность мониторинга в секундах (None - до прерывания)
+        
+        Returns:
+            Список фрагментов Segment(start, end, song_id, confidence)
+        """
+        sample_rate = self.fingerprint_system.audio_processor.sample_rate
+        self.reset()
+        try:
+            for chunk in microphone_chunks(sample_rate, 0.5, duration):
+                self.feed(chunk)
+        except KeyboardInterrupt:
+            pass
+        return self.finish()
+    
+    def _process_hops(self, complete_frames: int):
+        """Оценка окон для всех шагов, пары которых уже известны полностью"""
+        if (self._next_hop + 1) * self.hop_frames > complete_frames:
+            return
+        
+        pairs = np.concatenate(self._pending)
+        self._pending = []
+        while (self._next_hop + 1) * self.hop_frames <= complete_frames:
+            hop_end = (self._next_hop + 1) * self.hop_frames
+            split = int(np.searchsorted(pairs['anchor_time'], hop_end, side='left'))
+            self._add_hop(pairs[:split])
+            pairs = pairs[split:]
+            self._next_hop += 1
+            self._score_window()
+        self._pending.append(pairs)
+    
+    def _add_hop(self, pairs: np.ndarray):
+        """Поиск хешей шага в базе и сохранение пар (песня, сдвиг)"""
+        if len(pairs) == 0:
+            self._window.append((0, None))
+            return
+        
+        query_hashes = pairs['hash']
+        rows = self.database.lookup_hashes(np.unique(query_hashes))
+        matches = offset_matches(query_hashes, pairs['anchor_time'].astype(np.int64), *rows)
+        self._window.append((len(pairs), matches))
+    
+    def _score_window(self):
+        """Лучшая песня текущего окна и обновление журнала"""
+        window_end = self._next_hop * self.hop_frames
+        parts = [matches for _, matches in self._window if matches is not None and len(matches[0])]
+        query_count = sum(count for count, _ in self._window)
+        
+        if parts and query_count:
+            song_ids, deltas, offsets = (np.concatenate(column) for column in zip(*parts))
+            best_songs, scores, best_deltas = best_offsets(song_ids, deltas)
+            best = int(np.argmax(scores))
+            score = int(scores[best])
+            confidence = score / query_count
+            if score >= self.min_aligned and confidence >= self.threshold:
+                song_id, delta = int(best_songs[best]), int(best_deltas[best])
+                # Границы фрагмента - по опорным пикам выровненных пар, а не по окну
+                aligned = offsets[(song_ids == song_id) & (deltas == delta)]
+                self._add_hit(int(aligned.min()), int(aligned.max()) + 1, song_id, confidence, delta)
+                return
+        
+        if self._open is not None and window_end - self._open[1] > self.max_gap_frames:
+            self._close_segment()
+    
+    def _add_hit(self, start: int, end: int, song_id: int, confidence: float, delta: int):
+        """Продление открытого фрагмента или начало нового"""
+        segment = self._open
+        if (segment is not None and segment[2] == song_id
+                and abs(segment[4] - delta) <= self.offset_tolerance_frames
+                and start - segment[1] <= self.max_gap_frames):
+            segment[0] = min(segment[0], start)
+            segment[1] = max(segment[1], end)
+            segment[3] = max(segment[3], confidence)
+            return
+        
+        self._close_segment()
+        self._open = [start, end, song_id, confidence, delta]
+    
+    def _close_segment(self):
+        """Запись открытого фрагмента в журнал"""
+        if self._open is None:
+            return
+        start, end, song_id, confidence, _ = self._open
+        to_seconds = self.fingerprint_system.audio_processor.frames_to_seconds
+        self.segments.append(Segment(float(to_seconds(start)), float(to_seconds(end)),
+                                     song_id, float(confidence)))
+        self._open = None
@@ -1,24 +1,186 @@
 """
 модуль для распознавания музыки
 """
+import os
+import time
+import threading
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from typing import List, Tuple, Optional, Dict
+from typing import Any, Iterable, List, Tuple, Optional, Dict, Union
 from audio_processor import AudioProcessor
 from fingerprint import AudioFingerprint
-from database import FingerprintDatabase
+from database import FingerprintDatabase, SCORING_COUNT, BACKEND_SQLITE
+from streaming import StreamingRecognizer
+from ingest import fingerprint_queries, _init_worker, _worker_args
+from monitor import BroadcastMonitor, Segment
+from cache import LRUCache, audio_digest, query_digest
+from metrics import Metrics, Trace, count, span, tracing
 
 class MusicRecognizer:
-    def __init__(self, db_path: str = "data/fingerprints.db"):
+    def __init__(self, db_path: str = "data/fingerprints.db", scoring: str = SCORING_COUNT,
+                 normalize_scores: bool = False, backend: str = BACKEND_SQLITE,
+                 cache_size: int = 1024, cache_ttl: Optional[float] = 300.0,
+                 fingerprint_system: Optional[AudioFingerprint] = None,
+                 metrics: Optional[Metrics] = None):
         """
         Инициализация системы распознавания
         
         Args:
             db_path: Путь к базе данных отпечатков
+            scoring: Способ оценки совпадений: 'count' или 'offset'
+                     (по гистограмме временных сдвигов, см. FingerprintDatabase.search_song)
+            normalize_scores: Нормализовать оценку с учетом числа отпечатков песни
+            backend: Поиск по хешам: 'sqlite' или 'memory' (индекс в памяти)
+            cache_size: Размер кешей результатов (0 - без кеша)
+            cache_ttl: Время жизни результата в кеше в секундах (None - без ограничения)
+            fingerprint_system: Система отпечатков с нестандартными параметрами
+                                (целевая зона, STFT) для запросов и добавления песен.
+                                По умолчанию - стандартная в режиме хешей базы
+            metrics: Накопитель времени этапов и счетчиков всех запросов
+                     (None - метрики выключены и почти ничего не стоят)
         """
-        self.audio_processor = AudioProcessor()
-        self.fingerprint_system = AudioFingerprint()
-        self.database = FingerprintDatabase(db_path)
+        self.scoring = scoring
+        self.normalize_scores = normalize_scores
+        self.metrics = metrics
+        # База переводит сдвиги в секунды и запускает воркеры с параметрами этой системы
+        self.database = FingerprintDatabase(db_path, backend=backend,
+                                            fingerprint_system=fingerprint_system)
+        
+        # Повторные запросы (популярные песни, повторная отправка того же клипа)
+        # отвечаются из кеша: по дайджесту аудио - без отпечатка и поиска,
+        # по дайджесту хешей - без поиска. Кеши сбрасываются при изменении каталога
+        self.audio_cache = LRUCache(cache_size, cache_ttl)
+        self.query_cache = LRUCache(cache_size, cache_ttl)
+        self._catalog_version = None
+        
+        # Пул процессов для recognize_batch: создается при первом пакете и
+        # переиспользуется следующими (запуск воркеров дороже отпечатка клипа)
+        self._pool = None
+        self._pool_key = None
+        self._pool_lock = threading.Lock()
+    
+    def _query_pool(self, workers: int) -> ProcessPoolExecutor:
+        """Пул воркеров отпечатков на workers процессов с параметрами текущей системы"""
+        key = (workers, tuple(sorted(self.fingerprint_system.params().items())))
+        with self._pool_lock:
+            if self._pool is None or self._pool_key != key:
+                # Число процессов или параметры отпечатков изменились (например,
+                # после migrate_to_packed_hashes) - старый пул больше не годится
+                if self._pool is not None:
+                    self._pool.shutdown()
+                self._pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                 initargs=_worker_args(self.fingerprint_system))
+                self._pool_key = key
+            return self._pool
+    
+    def close(self):
+        """Остановка пула воркеров и закрытие базы"""
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+        self.database.close()
+    
+    def __enter__(self) -> 'MusicRecognizer':
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    @property
+    def audio_processor(self) -> AudioProcessor:
+        """Обработчик аудио (запись, загрузка файлов) с параметрами системы отпечатков"""
+        return self.fingerprint_system.audio_processor
+    
+    @property
+    def fingerprint_system(self) -> AudioFingerprint:
+        """Система отпечатков запросов (та же, что у базы, и в том же режиме хешей)"""
+        return self.database.fingerprint_system
+    
+    def _check_catalog(self):
+        """Сброс кешей, если каталог изменился с прошлой проверки"""
+        version = self.database.catalog_version
+        if version != self._catalog_version:
+            self.audio_cache.clear()
+            self.query_cache.clear()
+            self._catalog_version = version
+    
+    @contextlib.contextmanager
+    def _tracing(self):
+        """Трассировка этапов запроса с учетом в self.metrics"""
+        start_time = time.perf_counter()
+        with tracing() as trace:
+            yield trace
+        trace.timings['total'] = time.perf_counter() - start_time
+        if self.metrics is not None:
+            self.metrics.record(trace)
+    
+    def _trace(self, with_metrics: bool = False):
+        """Трассировка запроса, если метрики включены (иначе - пустой контекст)"""
+        if self.metrics is None and not with_metrics:
+            return contextlib.nullcontext()
+        return self._tracing()
+    
+    def _search_key(self, digest: bytes, threshold: float) -> tuple:
+        """Ключ кеша: дайджест запроса и параметры поиска"""
+        return digest, threshold, self.scoring, self.normalize_scores
+    
+    def _search(self, fingerprint: np.ndarray, threshold: float) -> List[tuple]:
+        """Поиск отпечатка в базе через кеш по дайджесту хешей"""
+        key = self._search_key(query_digest(fingerprint, self.scoring != SCORING_COUNT), threshold)
+        matches = self.query_cache.get(key)
+        if matches is not None:
+            count('query_cache_hits')
+        else:
+            matches = self.database.search_song(fingerprint, threshold, self.scoring,
+                                                self.normalize_scores)
+            self.query_cache.put(key, matches)
+        return matches
+    
+    def _search_audio(self, audio_data: np.ndarray, threshold: float) -> List[tuple]:
+        """Отпечаток и поиск аудио через кеш по дайджесту отсчетов"""
+        self._check_catalog()
+        key = self._search_key(audio_digest(audio_data), threshold)
+        matches = self.audio_cache.get(key)
+        if matches is not None:
+            count('audio_cache_hits')
+        else:
+            fingerprint = self.fingerprint_system.create_fingerprint_array(audio_data)
+            matches = self._search(fingerprint, threshold)
+            self.audio_cache.put(key, matches)
+        return matches
+    
+    def search_fingerprint(self, fingerprint: np.ndarray, threshold: float = 0.1) -> List[tuple]:
+        """
+        Поиск готового отпечатка (например, созданного в другом процессе)
+        
+        Args:
+            fingerprint: Отпечаток запроса (структурированный массив)
+            threshold: Минимальный порог схожести
+        
+        Returns:
+            Список совпадений, как у FingerprintDatabase.search_song
+        """
+        self._check_catalog()
+        with self._trace():
+            return self._search(fingerprint, threshold)
+    
+    def cache_stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Статистика кешей результатов
         
+        Returns:
+            Словарь: audio - кеш по дайджесту аудио, query - по дайджесту хешей
+            (см. LRUCache.stats)
+        """
+        return {'audio': self.audio_cache.stats(), 'query': self.query_cache.stats()}
+    
+    def clear_cache(self):
+        """Очистка кешей результатов"""
+        self.audio_cache.clear()
+        self.query_cache.clear()
+    
     def recognize_from_recording(self, duration: float = 10.0, 
                                 threshold: float = 0.1) -> Optional[Tuple[str, str, float]]:
         """
@@ -27,7 +189,7 @@ class MusicRecognizer:
         Args:
             duration: Длительность записи в секундах
             threshold: Минимальный порог схожести
-            
+        
         Returns:
             Кортеж (название, исполнитель, коэффициент_схожести) или None
         """
@@ -37,68 +199,186 @@ class MusicRecognizer:
         audio_data = self.audio_processor.record_audio(duration)
         
         # Создаем отпечаток
-        fingerprint = self.fingerprint_system.create_fingerprint(audio_data)
+        fingerprint = self.fingerprint_system.create_fingerprint_array(audio_data)
         
-        # Ищем в базе данных
-        matches = self.database.search_song(fingerprint, threshold)
+        # Ищем в базе данных (живая запись не повторяется, кеш - только по хешам)
+        self._check_catalog()
+        matches = self._search(fingerprint, threshold)
         
         if matches:
-            name, artist, similarity = matches[0]
+            name, artist, similarity = matches[0][:3]
             return name, artist, similarity
         
         return None
     
     def recognize_from_file(self, file_path: str, 
-                           threshold: float = 0.1) -> Optional[Tuple[str, str, float]]:
+                           threshold: float = 0.1, offset: float = 0.0,
+                           duration: Optional[float] = None,
+                           with_metrics: bool = False) -> Union[Optional[Tuple[str, str, float]], Tuple[Any, Dict]]:
         """
         Распознавание музыки из файла
         
         Args:
             file_path: Путь к аудио файлу
             threshold: Минимальный порог схожести
-            
+            offset: С какой секунды файла начинать запрос
+            duration: Длительность запроса в секундах (None - весь файл);
+                      декодируется только это окно
+            with_metrics: Вернуть вместе с результатом разбивку запроса по этапам
+        
         Returns:
-            Кортеж (название, исполнитель, коэффициент_схожести) или None
+            Кортеж (название, исполнитель, коэффициент_схожести) или None;
+            с with_metrics - пара (результат, разбивка): timings - время этапов
+            в секундах (decode, spectrogram, peaks, hashing, lookup, score, total),
+            counters - счетчики (peaks, hashes, rows_fetched, candidates, попадания в кеши)
         """
-        # Загружаем аудио
-        audio_data = self.audio_processor.load_audio_file(file_path)
-        
-        # Создаем отпечаток
-        fingerprint = self.fingerprint_system.create_fingerprint(audio_data)
-        
-        # Ищем в базе данных
-        matches = self.database.search_song(fingerprint, threshold)
-        
-        if matches:
-            name, artist, similarity = matches[0]
-            return name, artist, similarity
+        with self._trace(with_metrics) as trace:
+            # Загружаем аудио
+            with span('decode'):
+                audio_data = self.audio_processor.load_audio_file(file_path, offset, duration)
+            
+            # Создаем отпечаток и ищем в базе данных (или берем результат из кеша)
+            matches = self._search_audio(audio_data, threshold)
         
-        return None
+        return self._result(matches, trace if with_metrics else None)
     
     def recognize_from_audio_data(self, audio_data: np.ndarray, 
-                                 threshold: float = 0.1) -> Optional[Tuple[str, str, float]]:
+                                 threshold: float = 0.1,
+                                 with_metrics: bool = False) -> Union[Optional[Tuple[str, str, float]], Tuple[Any, Dict]]:
         """
         Распознавание музыки из аудио данных
         
         Args:
             audio_data: Аудио данные
             threshold: Минимальный порог схожести
-            
+            with_metrics: Вернуть вместе с результатом разбивку запроса по этапам
+        
         Returns:
-            Кортеж (название, исполнитель, коэффициент_схожести) или None
+            Кортеж (название, исполнитель, коэффициент_схожести) или None;
+            с with_metrics - пара (результат, разбивка), см. recognize_from_file
         """
-        # Создаем отпечаток
-        fingerprint = self.fingerprint_system.create_fingerprint(audio_data)
+        with self._trace(with_metrics) as trace:
+            # Создаем отпечаток и ищем в базе данных (или берем результат из кеша)
+            matches = self._search_audio(audio_data, threshold)
         
-        # Ищем в базе данных
-        matches = self.database.search_song(fingerprint, threshold)
+        return self._result(matches, trace if with_metrics else None)
+    
+    @staticmethod
+    def _result(matches: List[tuple], trace: Optional[Trace] = None):
+        """Лучшее совпадение (и разбивка запроса, если она запрошена)"""
+        result = tuple(matches[0][:3]) if matches else None
+        if trace is not None:
+            return result, trace.as_dict()
+        return result
+    
+    def recognize_streaming(self, chunks: Optional[Iterable[np.ndarray]] = None,
+                            threshold: float = 0.1,
+                            max_duration: float = 10.0) -> Optional[Tuple[str, str, float]]:
+        """
+        Распознавание по мере записи: возвращает ответ, как только совпадение
+        становится уверенным, не дожидаясь конца записи
         
-        if matches:
-            name, artist, similarity = matches[0]
+        Args:
+            chunks: Блоки аудио данных (если не заданы - запись с микрофона)
+            threshold: Минимальный порог схожести
+            max_duration: Максимальная длительность записи в секундах
+        
+        Returns:
+            Кортеж (название, исполнитель, коэффициент_схожести) или None
+        """
+        streaming = StreamingRecognizer(self.database, self.fingerprint_system,
+                                        threshold=threshold, max_duration=max_duration)
+        if chunks is None:
+            result = streaming.recognize_microphone()
+        else:
+            result = streaming.recognize(chunks)
+        
+        if result:
+            name, artist, similarity = result[:3]
             return name, artist, similarity
         
         return None
     
+    def recognize_batch(self, items: List[Union[str, np.ndarray]], threshold: float = 0.1,
+                        workers: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Распознавание пакета запросов
+        
+        Отпечатки создаются параллельно в пуле процессов, а хеши всех запросов
+        ищутся в базе одним пакетным запросом (см. search_songs_batch). Пул
+        запускается при первом пакете и живет до close().
+        
+        Args:
+            items: Пути к аудио файлам или аудио данные
+            threshold: Минимальный порог схожести
+            workers: Число процессов (по умолчанию - число ядер, 1 - без пула процессов)
+        
+        Returns:
+            Список словарей в порядке items: match - лучший результат search_song
+            или None, error - текст ошибки или None, timings - время этапов
+            в секундах (decode, fingerprint, lookup - общее для пакета, score, total)
+        """
+        if not items:
+            return []
+        
+        workers = workers or os.cpu_count() or 1
+        pool = self._query_pool(workers) if workers > 1 and len(items) > 1 else None
+        fingerprinted = fingerprint_queries(self.fingerprint_system, items, workers, pool)
+        results = [{'match': None, 'error': error, 'timings': dict(timings, lookup=0.0, score=0.0)}
+                   for _, timings, error in fingerprinted]
+        
+        # Повторные запросы отвечаются из кеша по дайджесту хешей
+        self._check_catalog()
+        with_offsets = self.scoring != SCORING_COUNT
+        keys, ok = {}, []
+        for i, (fingerprint, _, error) in enumerate(fingerprinted):
+            if error is not None:
+                continue
+            keys[i] = self._search_key(query_digest(fingerprint, with_offsets), threshold)
+            clip_matches = self.query_cache.get(keys[i])
+            if clip_matches is None:
+                ok.append(i)
+            else:
+                results[i]['match'] = clip_matches[0] if clip_matches else None
+        
+        # Один поиск на все остальные успешно обработанные запросы
+        search_timings = {'lookup': 0.0, 'score': []}
+        matches = self.database.search_songs_batch(
+            [fingerprinted[i][0] for i in ok], threshold, self.scoring, self.normalize_scores,
+            timings=search_timings
+        ) if ok else []
+        
+        for position, (i, clip_matches) in enumerate(zip(ok, matches)):
+            self.query_cache.put(keys[i], clip_matches)
+            results[i]['match'] = clip_matches[0] if clip_matches else None
+            results[i]['timings']['lookup'] = search_timings['lookup']
+            results[i]['timings']['score'] = search_timings['score'][position]
+        
+        for result in results:
+            timings = result['timings']
+            timings['total'] = sum(timings[stage] for stage in ('decode', 'fingerprint', 'lookup', 'score'))
+        
+        return results
+    
+    def monitor_file(self, file_path: Optional[str] = None, window_seconds: float = 10.0,
+                     hop_seconds: float = 2.0, duration: Optional[float] = None) -> List[Segment]:
+        """
+        Журнал песен, звучащих в длинной записи или в эфире с микрофона
+        
+        Args:
+            file_path: Путь к аудио файлу (None - мониторинг микрофона)
+            window_seconds: Длина окна распознавания
+            hop_seconds: Шаг окна
+            duration: Длительность мониторинга микрофона (None - до Ctrl+C)
+        
+        Returns:
+            Список фрагментов Segment(start, end, song_id, confidence)
+        """
+        monitor = BroadcastMonitor(self, window_seconds=window_seconds, hop_seconds=hop_seconds)
+        if file_path is None:
+            return monitor.process_microphone(duration)
+        return monitor.process_file(file_path)
+    
     def add_song_to_database(self, file_path: str, name: str = None, artist: str = None) -> int:
         """
         Добавление песни в базу данных
@@ -107,7 +387,7 @@ class MusicRecognizer:
             file_path: Путь к аудио файлу
             name: Название песни
             artist: Исполнитель
-            
+        
         Returns:
             ID добавленной песни
         """
@@ -144,15 +424,12 @@ class MusicRecognizer:
             audio_data: Аудио данные
             threshold: Минимальный порог схожести
             max_results: Максимальное количество результатов
-            
+        
         Returns:
             Список кортежей (название, исполнитель, коэффициент_схожести)
         """
-        # Создаем отпечаток
-        fingerprint = self.fingerprint_system.create_fingerprint(audio_data)
-        
-        # Ищем в базе данных
-        matches = self.database.search_song(fingerprint, threshold)
+        # Создаем отпечаток и ищем в базе данных (или берем результат из кеша)
+        matches = self._search_audio(audio_data, threshold)
         
         return matches[:max_results]
     
@@ -162,7 +439,7 @@ class MusicRecognizer:
         
         Args:
             audio_data: Аудио данные
-            
+        
         Returns:
             Словарь с метриками качества
         """
@@ -195,18 +472,19 @@ class MusicRecognizer:
         Args:
             audio_data: Аудио данные
             threshold: Минимальный порог схожести
-            
+        
         Returns:
             Словарь с метриками уверенности
         """
         # Создаем отпечаток
-        fingerprint = self.fingerprint_system.create_fingerprint(audio_data)
+        fingerprint = self.fingerprint_system.create_fingerprint_array(audio_data)
         
         # Получаем статистику отпечатка
         fingerprint_stats = self.fingerprint_system.get_fingerprint_stats(fingerprint)
         
         # Ищем в базе данных
-        matches = self.database.search_song(fingerprint, threshold)
+        matches = self.database.search_song(fingerprint, threshold, self.scoring,
+                                             self.normalize_scores)
         
         # Анализируем качество аудио
         quality_metrics = self.analyze_audio_quality(audio_data)
@@ -0,0 +1,446 @@
+"""
+HTTP сервис распознавания: долгоживущий процесс с прогретой базой и индексом
+
+Только стандартная библиотека (asyncio), без веб-фреймворков. Отпечатки
+создаются в пуле процессов, поиск - в пуле потоков, запись в базу ведет один
+поток-писатель. Число одновременно обрабатываемых запросов ограничено:
+сверх лимита сервер сразу отвечает 429, а не копит очередь.
+
+Эндпоинты:
+    POST /recognize?threshold=0.1&top=5   тело - аудио файл (WAV, FLAC, MP3...)
+    POST /ingest?name=...&artist=...      тело - аудио файл песни
+    GET  /stats                           статистика базы, кешей и задержек (JSON)
+    GET  /metrics                         то же в текстовом формате Prometheus
+    GET  /health                          проверка, что сервер жив
+"""
+import os
+import json
+import time
+import asyncio
+import tempfile
+import contextlib
+import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http import HTTPStatus
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+import ingest
+from ingest import _init_worker, _worker_args
+from metrics import LatencyHistogram
+
+# Расширение временного файла по Content-Type: по нему декодер выбирает способ чтения
+AUDIO_SUFFIXES = {
+    'audio/wav': '.wav', 'audio/x-wav': '.wav', 'audio/wave': '.wav',
+    'audio/flac': '.flac', 'audio/x-flac': '.flac', 'audio/mpeg': '.mp3',
+    'audio/ogg': '.ogg', 'audio/mp4': '.m4a', 'audio/aac': '.aac',
+}
+
+class HTTPError(Exception):
+    """Ошибка запроса, которая отдается клиенту с кодом status"""
+    
+    def __init__(self, status: HTTPStatus, message: str, headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+def _write_upload(data: bytes, suffix: str) -> str:
+    """Сохранение тела запроса во временный файл (декодер читает файлы)"""
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    with os.fdopen(fd, 'wb') as file:
+        file.write(data)
+    return path
+
+def _fingerprint_upload(data: bytes, suffix: str) -> Tuple[Any, Dict[str, float], Optional[str]]:
+    """
+    Отпечаток аудио запроса в процессе-воркере
+    
+    Returns:
+        Кортеж (отпечаток, время_этапов_в_секундах, ошибка), см. ingest._fingerprint_query
+    """
+    path = _write_upload(data, suffix)
+    try:
+        return ingest._fingerprint_query(path)
+    finally:
+        os.unlink(path)
+
+def _fingerprint_song_upload(data: bytes, suffix: str) -> Tuple[Optional[float], Any, Dict[str, float], Optional[str]]:
+    """
+    Отпечаток загруженной песни в процессе-воркере (блочно, как при --add-dir)
+    
+    Returns:
+        Кортеж (длительность, отпечаток, время_этапов_в_секундах, ошибка)
+    """
+    path = _write_upload(data, suffix)
+    try:
+        start_time = time.perf_counter()
+        _, duration, fingerprint, error = ingest._fingerprint_file(path)
+        return duration, fingerprint, {'fingerprint': time.perf_counter() - start_time}, error
+    finally:
+        os.unlink(path)
+
+def _match_json(match: tuple) -> Dict[str, Any]:
+    """Результат search_song в виде словаря для JSON"""
+    result = {'name': match[0], 'artist': match[1], 'similarity': round(float(match[2]), 4)}
+    if len(match) > 3:
+        result['offset'] = round(float(match[3]), 3)
+    return result
+
+class RecognitionServer:
+    """
+    HTTP сервер распознавания поверх одного MusicRecognizer
+    
+    База, индекс в памяти (backend='memory') и кеши результатов живут все время
+    работы сервера, поэтому запрос не платит за импорт библиотек и загрузку базы.
+    """
+    
+    def __init__(self, recognizer, host: str = '127.0.0.1', port: int = 8000,
+                 workers: Optional[int] = None, max_pending: int = 32,
+                 search_threads: int = 4, threshold: float = 0.1,
+                 max_body_mb: float = 50.0):
+        """
+        Args:
+            recognizer: MusicRecognizer (база, параметры отпечатков, кеши)
+            host: Адрес для прослушивания
+            port: Порт (0 - выбрать свободный, см. self.port после start)
+            workers: Число процессов для отпечатков (по умолчанию - число ядер)
+            max_pending: Сколько запросов /recognize и /ingest обрабатывается
+                         одновременно; остальным сразу отвечаем 429
+            search_threads: Число потоков поиска по базе
+            threshold: Порог схожести по умолчанию
+            max_body_mb: Максимальный размер тела запроса в МБ (больше - 413)
+        """
+        self.recognizer = recognizer
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.search_threads = search_threads
+        self.threshold = threshold
+        self.max_body = int(max_body_mb * (1 << 20))
+        
+        self.in_flight = 0
+        self.rejected = 0
+        self.responses = collections.Counter()                  # (путь, статус) -> число
+        self.latency = collections.defaultdict(LatencyHistogram)  # (путь, этап) -> гистограмма
+        
+        self._server = None
+        self._process_pool = None
+        self._search_pool = None
+        self._write_pool = None
+        self._started_at = None
+    
+    async def start(self):
+        """Запуск пулов и прослушивание порта (без ожидания завершения)"""
+        self._process_pool = ProcessPoolExecutor(
+            max_workers=self.workers, initializer=_init_worker,
+            initargs=_worker_args(self.recognizer.fingerprint_system)
+        )
+        self._search_pool = ThreadPoolExecutor(self.search_threads, thread_name_prefix='search')
+        # Запись в SQLite - один писатель, транзакции не конкурируют за блокировку
+        self._write_pool = ThreadPoolExecutor(1, thread_name_prefix='ingest')
+        
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._started_at = time.monotonic()
+    
+    async def stop(self):
+        """Остановка: новые соединения не принимаются, пулы завершаются"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for pool in (self._process_pool, self._search_pool, self._write_pool):
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+    
+    async def serve_forever(self):
+        """Запуск и обслуживание запросов до отмены"""
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+    
+    def run(self):
+        """Блокирующий запуск сервера (до Ctrl+C)"""
+        try:
+            asyncio.run(self.serve_forever())
+        except KeyboardInterrupt:
+            pass
+    
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Обслуживание соединения: запросы читаются по очереди (keep-alive)"""
+        try:
+            while True:
+                start_time = time.perf_counter()
+                path = None
+                keep_alive = False
+                try:
+                    request = await self._read_request(reader)
+                    if request is None:
+                        break
+                    method, path, query, headers, body = request
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+                    status, payload, extra_headers = await self._dispatch(method, path, query, headers, body)
+                except HTTPError as e:
+                    status, payload, extra_headers = e.status, {'error': str(e)}, e.headers
+                except Exception as e:
+                    status, payload, extra_headers = (HTTPStatus.INTERNAL_SERVER_ERROR,
+                                                      {'error': str(e) or type(e).__name__}, {})
+                
+                self._write_response(writer, status, payload, extra_headers, keep_alive)
+                await writer.drain()
+                if path is not None:
+                    self.responses[(path, int(status))] += 1
+                    self.latency[(path, 'total')].observe(time.perf_counter() - start_time)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[tuple]:
+        """
+        Чтение запроса HTTP/1.1
+        
+        Returns:
+            Кортеж (метод, путь, параметры, заголовки, тело) или None,
+            если клиент закрыл соединение
+        """
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError as e:
+            if e.partial.strip():
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "Неполный запрос")
+            return None
+        except asyncio.LimitOverrunError:
+            raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, "Слишком длинные заголовки")
+        
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, _ = lines[0].split(' ', 2)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Неверная строка запроса")
+        
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        
+        if 'transfer-encoding' in headers:
+            raise HTTPError(HTTPStatus.LENGTH_REQUIRED, "Нужен заголовок Content-Length")
+        try:
+            length = int(headers.get('content-length', 0) or 0)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Неверный заголовок Content-Length")
+        if length < 0:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Неверный заголовок Content-Length")
+        if length > self.max_body:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                            f"Тело запроса больше {self.max_body // (1 << 20)} МБ")
+        body = await reader.readexactly(length) if length else b''
+        
+        url = urlsplit(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        return method.upper(), url.path, query, headers, body
+    
+    @staticmethod
+    def _write_response(writer: asyncio.StreamWriter, status: HTTPStatus, payload: Any,
+                        extra_headers: Dict[str, str], keep_alive: bool):
+        """Запись ответа: словарь - как JSON, строка - как текст"""
+        if isinstance(payload, str):
+            body = payload.encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            content_type = 'application/json; charset=utf-8'
+        
+        status = HTTPStatus(status)
+        headers = {'Content-Type': content_type, 'Content-Length': str(len(body)),
+                   'Connection': 'keep-alive' if keep_alive else 'close', **extra_headers}
+        head = f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+        head += ''.join(f"{name}: {value}\r\n" for name, value in headers.items())
+        writer.write(head.encode('latin-1') + b'\r\n' + body)
+    
+    async def _dispatch(self, method: str, path: str, query: Dict[str, str],
+                        headers: Dict[str, str], body: bytes) -> Tuple[HTTPStatus, Any, Dict[str, str]]:
+        """Выбор обработчика по методу и пути"""
+        routes = {
+            '/recognize': ('POST', self._recognize),
+            '/ingest': ('POST', self._ingest),
+            '/stats': ('GET', self._stats),
+            '/metrics': ('GET', self._metrics),
+            '/health': ('GET', self._health),
+        }
+        if path not in routes:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"Неизвестный путь: {path}")
+        route_method, handler = routes[path]
+        if method != route_method:
+            raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, f"{path} принимает только {route_method}",
+                            {'Allow': route_method})
+        
+        status, payload = await handler(query, headers, body)
+        return status, payload, {}
+    
+    @contextlib.contextmanager
+    def _slot(self):
+        """Место для тяжелого запроса; если мест нет - 429"""
+        if self.in_flight >= self.max_pending:
+            self.rejected += 1
+            raise HTTPError(HTTPStatus.TOO_MANY_REQUESTS, "Сервер перегружен, повторите запрос позже",
+                            {'Retry-After': '1'})
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+    
+    @staticmethod
+    def _param(query: Dict[str, str], name: str, convert, default):
+        """Параметр запроса нужного типа"""
+        if name not in query:
+            return default
+        try:
+            return convert(query[name])
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"Неверное значение параметра {name}: {query[name]}")
+    
+    @staticmethod
+    def _audio_body(headers: Dict[str, str], body: bytes) -> str:
+        """Проверка тела запроса, расширение временного файла по Content-Type"""
+        if not body:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Пустое тело запроса: нужен аудио файл")
+        content_type = headers.get('content-type', '').split(';')[0].strip().lower()
+        return AUDIO_SUFFIXES.get(content_type, '.wav')
+    
+    @staticmethod
+    async def _in_pool(pool, function, *args) -> Tuple[Any, float]:
+        """Вызов в пуле: (результат, время вместе с ожиданием в очереди пула)"""
+        start_time = time.perf_counter()
+        result = await asyncio.get_running_loop().run_in_executor(pool, function, *args)
+        return result, time.perf_counter() - start_time
+    
+    def _observe(self, path: str, timings: Dict[str, float]):
+        """Учет времени этапов запроса в гистограммах"""
+        for stage, seconds in timings.items():
+            self.latency[(path, stage)].observe(seconds)
+    
+    async def _recognize(self, query: Dict[str, str], headers: Dict[str, str],
+                         body: bytes) -> Tuple[HTTPStatus, Dict[str, Any]]:
+        """POST /recognize: лучшее совпадение и список кандидатов"""
+        threshold = self._param(query, 'threshold', float, self.threshold)
+        top = self._param(query, 'top', int, 1)
+        suffix = self._audio_body(headers, body)
+        
+        with self._slot():
+            (fingerprint, timings, error), elapsed = await self._in_pool(
+                self._process_pool, _fingerprint_upload, body, suffix)
+            timings['queue'] = max(0.0, elapsed - timings['decode'] - timings['fingerprint'])
+            if error is not None:
+                raise HTTPError(HTTPStatus.UNPROCESSABLE_ENTITY, f"Не удалось обработать аудио: {error}")
+            
+            matches, timings['search'] = await self._in_pool(
+                self._search_pool, self.recognizer.search_fingerprint, fingerprint, threshold)
+        
+        self._observe('/recognize', timings)
+        return HTTPStatus.OK, {
+            'match': _match_json(matches[0]) if matches else None,
+            'matches': [_match_json(match) for match in matches[:max(top, 1)]],
+            'timings': {stage: round(seconds, 4) for stage, seconds in timings.items()},
+        }
+    
+    async def _ingest(self, query: Dict[str, str], headers: Dict[str, str],
+                      body: bytes) -> Tuple[HTTPStatus, Dict[str, Any]]:
+        """POST /ingest: добавление песни в базу"""
+        name = query.get('name')
+        if not name:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Нужен параметр name")
+        artist = query.get('artist')
+        suffix = self._audio_body(headers, body)
+        
+        with self._slot():
+            (duration, fingerprint, timings, error), elapsed = await self._in_pool(
+                self._process_pool, _fingerprint_song_upload, body, suffix)
+            timings['queue'] = max(0.0, elapsed - timings['fingerprint'])
+            if error is not None:
+                raise HTTPError(HTTPStatus.UNPROCESSABLE_ENTITY, f"Не удалось обработать аудио: {error}")
+            
+            song_id, timings['write'] = await self._in_pool(
+                self._write_pool, self._add_song, name, artist, duration, fingerprint)
+        
+        self._observe('/ingest', timings)
+        return HTTPStatus.CREATED, {
+            'song_id': song_id,
+            'name': name,
+            'artist': artist,
+            'duration': round(duration, 3),
+            'hashes': len(fingerprint),
+            'timings': {stage: round(seconds, 4) for stage, seconds in timings.items()},
+        }
+    
+    def _add_song(self, name: str, artist: Optional[str], duration: float, fingerprint) -> int:
+        """Запись песни в базу (поток-писатель) и догрузка индекса в памяти"""
+        database = self.recognizer.database
+        song_id = database.add_songs_batch([(name, artist, None, duration, fingerprint)])[0]
+        database.refresh_index()
+        return song_id
+    
+    def _catalog_stats(self) -> Dict[str, int]:
+        """Число песен и отпечатков (запрос к базе, выполняется в пуле поиска)"""
+        return self.recognizer.get_database_stats()
+    
+    async def _stats(self, query: Dict[str, str], headers: Dict[str, str],
+                     body: bytes) -> Tuple[HTTPStatus, Dict[str, Any]]:
+        """GET /stats: база, нагрузка, кеши и задержки"""
+        catalog, _ = await self._in_pool(self._search_pool, self._catalog_stats)
+        return HTTPStatus.OK, {
+            **catalog,
+            'uptime': round(time.monotonic() - self._started_at, 1),
+            'workers': self.workers,
+            'in_flight': self.in_flight,
+            'max_pending': self.max_pending,
+            'rejected': self.rejected,
+            'responses': {f"{path} {status}": count for (path, status), count in sorted(self.responses.items())},
+            'cache': self.recognizer.cache_stats(),
+            'latency': {f"{path} {stage}": histogram.stats()
+                        for (path, stage), histogram in sorted(self.latency.items())},
+            'recognizer': self.recognizer.metrics.stats() if self.recognizer.metrics else None,
+        }
+    
+    async def _metrics(self, query: Dict[str, str], headers: Dict[str, str],
+                       body: bytes) -> Tuple[HTTPStatus, str]:
+        """GET /metrics: текстовый формат Prometheus"""
+        catalog, _ = await self._in_pool(self._search_pool, self._catalog_stats)
+        lines = [
+            '# HELP myshazam_request_seconds Время обработки запроса по этапам',
+            '# TYPE myshazam_request_seconds histogram',
+        ]
+        for (path, stage), histogram in sorted(self.latency.items()):
+            lines.extend(histogram.prometheus('myshazam_request_seconds', f'path="{path}",stage="{stage}"'))
+        
+        lines += ['# HELP myshazam_responses_total Ответы по путям и кодам',
+                  '# TYPE myshazam_responses_total counter']
+        lines += [f'myshazam_responses_total{{path="{path}",status="{status}"}} {count}'
+                  for (path, status), count in sorted(self.responses.items())]
+        
+        cache = self.recognizer.cache_stats()
+        lines += ['# TYPE myshazam_cache_hits_total counter']
+        lines += [f'myshazam_cache_hits_total{{cache="{name}"}} {stats["hits"]}' for name, stats in cache.items()]
+        lines += ['# TYPE myshazam_cache_misses_total counter']
+        lines += [f'myshazam_cache_misses_total{{cache="{name}"}} {stats["misses"]}' for name, stats in cache.items()]
+        
+        lines += ['# TYPE myshazam_rejected_total counter', f'myshazam_rejected_total {self.rejected}',
+                  '# TYPE myshazam_in_flight gauge', f'myshazam_in_flight {self.in_flight}',
+                  '# TYPE myshazam_songs gauge', f'myshazam_songs {catalog["songs_count"]}',
+                  '# TYPE myshazam_fingerprints gauge', f'myshazam_fingerprints {catalog["fingerprints_count"]}']
+        text = '\n'.join(lines) + '\n'
+        if self.recognizer.metrics is not None:
+            text += self.recognizer.metrics.prometheus()
+        return HTTPStatus.OK, text
+    
+    async def _health(self, query: Dict[str, str], headers: Dict[str, str],
+                      body: bytes) -> Tuple[HTTPStatus, Dict[str, Any]]:
+        """GET /health"""
+        return HTTPStatus.OK, {'status': 'ok'}
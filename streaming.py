@@ -0,0 +1,218 @@
+"""
+Потоковое распознавание: аудио приходит небольшими блоками
+"""
+import queue
+import time
+import numpy as np
+from typing import Iterable, Iterator, Optional, Tuple
+from fingerprint import AudioFingerprint, StreamingFingerprinter
+from database import FingerprintDatabase, score_offset_alignment
+
+class StreamingRecognizer:
+    """
+    Распознавание по мере поступления аудио с ранней остановкой
+    
+    Каждые query_interval секунд новые хеши ищутся в базе, найденные строки
+    копятся, и по всем ним заново строится гистограмма временных сдвигов.
+    Как только лучшая песня набирает достаточно выровненных совпадений,
+    распознавание заканчивается, не дожидаясь конца записи.
+    """
+    
+    def __init__(self, database: FingerprintDatabase,
+                 fingerprint_system: Optional[AudioFingerprint] = None,
+                 query_interval: float = 0.3, threshold: float = 0.1,
+                 min_aligned: int = 20, min_duration: float = 1.0,
+                 max_duration: float = 10.0):
+        """
+        Args:
+            database: База данных отпечатков
+            fingerprint_system: Система отпечатков (по умолчанию - как у базы)
+            query_interval: Как часто (в секундах аудио) обращаться к базе
+            threshold: Минимальная доля выровненных хешей для ответа
+            min_aligned: Минимальное число выровненных хешей для ответа
+            min_duration: Раньше скольких секунд аудио не отвечать
+            max_duration: Максимальная длительность аудио в секундах
+        """
+        self.database = database
+        self.fingerprint_system = fingerprint_system or database.fingerprint_system
+        self.query_interval = query_interval
+        self.threshold = threshold
+        self.min_aligned = min_aligned
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.reset()
+    
+    def reset(self):
+        """Сброс состояния для нового распознавания"""
+        self.fingerprinter = StreamingFingerprinter(self.fingerprint_system)
+        self._pending = []
+        self._query_hashes = []
+        self._query_offsets = []
+        self._matches = []
+        self._fetched = set()
+        self._last_query_at = 0.0
+        self.result = None
+        self.best = None
+    
+    @property
+    def audio_seconds(self) -> float:
+        """Сколько секунд аудио обработано"""
+        return self.fingerprinter.duration
+    
+    def feed(self, chunk: np.ndarray) -> Optional[Tuple[str, str, float, float]]:
+        """
+        Обработка очередного блока аудио
+        
+        Args:
+            chunk: Блок аудио данных
+        
+        Returns:
+            Кортеж (название, исполнитель, коэффициент_схожести, смещение_в_секундах),
+            если уже есть уверенный ответ, иначе None
+        """
+        if self.result is not None:
+            return self.result
+        
+        self._pending.append(self.fingerprinter.update(chunk))
+        if self.audio_seconds - self._last_query_at >= self.query_interval:
+            self._last_query_at = self.audio_seconds
+            self._query()
+        return self.result
+    
+    def finish(self) -> Optional[Tuple[str, str, float, float]]:
+        """
+        Завершение потока: последний запрос к базе по оставшимся хешам
+        
+        Returns:
+            Лучшее совпадение выше порога или None
+        """
+        if self.result is None:
+            self._pending.append(self.fingerprinter.finish())
+            self._query()
+        if self.result is None and self.best is not None and self.best[2] >= self.threshold:
+            return self.best
+        return self.result
+    
+    def _query(self):
+        """Поиск новых хешей в базе и пересчет оценок"""
+        pairs = np.concatenate(self._pending) if self._pending else None
+        self._pending = []
+        if pairs is None or len(pairs) == 0:
+            return
+        
+        # Хеши стоп-листа (режим 'skip') не ищутся и не учитываются в размере
+        # запроса - как в FingerprintDatabase.search_song
+        hashes, offsets = self.database._apply_stop_list(pairs['hash'], pairs['anchor_time'].astype(np.int64))
+        if len(hashes) == 0:
+            return
+        self._query_hashes.append(hashes)
+        self._query_offsets.append(offsets)
+        
+        # Строки базы для каждого хеша достаточно получить один раз
+        new_hashes = [hash_value for hash_value in np.unique(hashes).tolist()
+                      if hash_value not in self._fetched]
+        self._fetched.update(new_hashes)
+        if new_hashes:
+            self._matches.append(self.database.lookup_hashes(new_hashes))
+        if not self._matches:
+            return
+        
+        query_hashes = np.concatenate(self._query_hashes)
+        match_hashes, match_song_ids, match_offsets = (np.concatenate(column)
+                                                       for column in zip(*self._matches))
+        query_count, match_weights = self.database._offset_weights(query_hashes, match_hashes)
+        song_ids, scores, deltas = score_offset_alignment(
+            query_hashes, np.concatenate(self._query_offsets),
+            match_hashes, match_song_ids, match_offsets, match_weights=match_weights
+        )
+        if len(song_ids) == 0:
+            return
+        
+        best = int(np.argmax(scores))
+        song_id, score = int(song_ids[best]), float(scores[best])
+        similarity = score / query_count
+        info = self.database.get_songs_info([song_id])
+        if song_id not in info:
+            return
+        
+        offset = float(self.fingerprint_system.audio_processor.frames_to_seconds(deltas[best]))
+        name, artist, _ = info[song_id]
+        self.best = (name, artist, similarity, offset)
+        if (score >= self.min_aligned and similarity >= self.threshold
+                and self.audio_seconds >= self.min_duration):
+            self.result = self.best
+    
+    def recognize(self, chunks: Iterable[np.ndarray]) -> Optional[Tuple[str, str, float, float]]:
+        """
+        Распознавание по итератору блоков аудио (например, блоки из файла)
+        
+        Args:
+            chunks: Блоки аудио данных
+        
+        Returns:
+            Кортеж (название, исполнитель, коэффициент_схожести, смещение_в_секундах) или None
+        """
+        self.reset()
+        for chunk in chunks:
+            if self.feed(chunk) is not None or self.audio_seconds >= self.max_duration:
+                break
+        return self.finish()
+    
+    def recognize_microphone(self, block_duration: float = 0.1) -> Optional[Tuple[str, str, float, float]]:
+        """
+        Распознавание с микрофона: запись идет, пока нет уверенного ответа
+        или не истекло max_duration секунд
+        
+        Args:
+            block_duration: Длительность одного блока записи в секундах
+        
+        Returns:
+            Кортеж (название, исполнитель, коэффициент_схожести, смещение_в_секундах) или None
+        """
+        sample_rate = self.fingerprint_system.audio_processor.sample_rate
+        return self.recognize(microphone_chunks(sample_rate, block_duration, self.max_duration + 1.0))
+
+def microphone_chunks(sample_rate: int, block_duration: float = 0.1,
+                      max_duration: Optional[float] = None) -> Iterator[np.ndarray]:
+    """
+    Блоки аудио с микрофона по мере записи
+    
+    Запись идет, пока потребитель читает блоки (или не истекло max_duration секунд).
+    
+    Args:
+        sample_rate: Частота дискретизации
+        block_duration: Длительность одного блока в секундах
+        max_duration: Максимальная длительность записи (None - без ограничения)
+    
+    Yields:
+        Блоки аудио данных (float32, моно)
+    """
+    import sounddevice as sd
+    
+    blocks = queue.Queue()
+    
+    def callback(indata, frames, time_info, status):
+        blocks.put(indata[:, 0].copy())
+    
+    deadline = None if max_duration is None else time.monotonic() + max_duration
+    with sd.InputStream(samplerate=sample_rate, channels=1, dtype='float32',
+                        blocksize=int(block_duration * sample_rate), callback=callback):
+        while deadline is None or time.monotonic() < deadline:
+            try:
+                yield blocks.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+def iter_chunks(audio_data: np.ndarray, chunk_size: int) -> Iterable[np.ndarray]:
+    """
+    Разбиение аудио на блоки - для проверки потокового распознавания без микрофона
+    
+    Args:
+        audio_data: Аудио данные
+        chunk_size: Размер блока в отсчетах
+    
+    Yields:
+        Блоки аудио данных
+    """
+    for start in range(0, len(audio_data), chunk_size):
+        yield audio_data[start:start + chunk_size]
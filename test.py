@@ -118,6 +118,996 @@ def test_basic_functionality():
         print(f"❌ Ошибка базовой функциональности: {e}")
         return False
 
+def test_peak_detection():
+    """Тест совпадения векторизованного поиска пиков с эталонным"""
+    print("\nТестирование поиска пиков...")
+    
+    try:
+        import numpy as np
+        from audio_processor import AudioProcessor
+        processor = AudioProcessor()
+        
+        # Шумный синус - как в example.py
+        rng = np.random.default_rng(0)
+        t = np.arange(processor.sample_rate * 3) / processor.sample_rate
+        audio = np.sin(2 * np.pi * 440 * t) + rng.normal(0, 0.1, len(t))
+        _, _, spectrogram = processor.create_spectrogram(audio)
+        
+        reference = processor.find_peaks_reference(spectrogram)
+        freq_bins, time_bins, amplitudes = processor.find_peaks(spectrogram)
+        
+        if [(f, t) for f, t, _ in reference] != list(zip(freq_bins.tolist(), time_bins.tolist())):
+            print("❌ find_peaks не совпадает с find_peaks_reference")
+            return False
+        if not np.array_equal(np.array([a for _, _, a in reference]), amplitudes):
+            print("❌ Амплитуды пиков не совпадают")
+            return False
+        print(f"✅ find_peaks совпадает с эталоном ({len(reference)} пиков)")
+        
+        _, top_times, _ = processor.find_peaks(spectrogram, top_k=2, band_edges=[64, 128])
+        _, counts = np.unique(top_times, return_counts=True)
+        if len(counts) and counts.max() > 6:
+            print("❌ top_k ограничивает количество пиков неверно")
+            return False
+        print("✅ Ограничение top_k по полосам")
+        
+        from scipy import signal
+        _, _, power = signal.spectrogram(audio, fs=processor.sample_rate, nperseg=processor.nperseg,
+                                         noverlap=processor.noverlap, window='hann')
+        if not np.array_equal(spectrogram, 10 * np.log10(power + 1e-10)):
+            print("❌ Перевод в дБ на месте отличается от 10 * log10(S + 1e-10)")
+            return False
+        _, _, spectrogram32 = AudioProcessor(precision='float32').create_spectrogram(audio)
+        if spectrogram32.dtype != np.float32 or not np.allclose(spectrogram32, spectrogram, atol=1e-3):
+            print("❌ Спектрограмма в режиме float32 неверна")
+            return False
+        print("✅ Спектрограмма float32 совпадает с float64")
+        
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка поиска пиков: {e}")
+        return False
+
+def test_streaming():
+    """Тест потокового создания отпечатка и ранней остановки распознавания"""
+    print("\nТестирование потокового распознавания...")
+    
+    try:
+        import os
+        import tempfile
+        import numpy as np
+        from database import FingerprintDatabase
+        from fingerprint import StreamingFingerprinter
+        from streaming import StreamingRecognizer, iter_chunks
+        
+        # Последовательность случайных аккордов по 0.25 с, чтобы сигнал не был периодичным
+        rng = np.random.default_rng(1)
+        sample_rate = 22050
+        notes = []
+        for _ in range(80):
+            t = np.arange(sample_rate // 4) / sample_rate
+            notes.append(sum(np.sin(2 * np.pi * f * t) for f in rng.uniform(200, 4000, 3)))
+        audio = np.concatenate(notes)
+        audio = (audio + rng.normal(0, 0.1, len(audio))).astype(np.float32)
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            database = FingerprintDatabase(os.path.join(temp_dir, "streaming.db"))
+            fingerprint_system = database.fingerprint_system
+            reference = fingerprint_system.create_fingerprint_array(audio)
+            
+            for chunk_size in (500, 4096):
+                fingerprinter = StreamingFingerprinter(fingerprint_system)
+                parts = [fingerprinter.update(chunk) for chunk in iter_chunks(audio, chunk_size)]
+                parts.append(fingerprinter.finish())
+                if not np.array_equal(np.concatenate(parts), reference):
+                    print(f"❌ Потоковый отпечаток (блоки по {chunk_size}) не совпадает с обычным")
+                    return False
+            blocked = np.concatenate(list(fingerprint_system.iter_fingerprint(audio, sample_rate * 3 + 7)))
+            if not np.array_equal(blocked, reference):
+                print("❌ Блочный отпечаток (iter_fingerprint) не совпадает с обычным")
+                return False
+            print(f"✅ Потоковый отпечаток совпадает с обычным ({len(reference)} хешей)")
+            
+            song_id = database.add_song("Поток", "Тест", None, len(audio) / sample_rate)
+            database.add_fingerprint(song_id, reference)
+            
+            streaming = StreamingRecognizer(database)
+            clip = audio[sample_rate * 10:sample_rate * 20]
+            result = streaming.recognize(iter_chunks(clip, sample_rate // 10))
+            if not result or result[0] != "Поток" or abs(result[3] - 10.0) > 0.1:
+                print(f"❌ Потоковое распознавание вернуло {result}")
+                return False
+            if streaming.audio_seconds >= 10.0:
+                print("❌ Потоковое распознавание не остановилось раньше конца записи")
+                return False
+            print(f"✅ Потоковое распознавание: ответ через {streaming.audio_seconds:.1f} с аудио")
+            database.close()
+        
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка потокового распознавания: {e}")
+        return False
+
+def test_batch_search():
+    """Тест пакетного поиска: результаты как у поиска по одному запросу"""
+    print("\nТестирование пакетного поиска...")
+    
+    try:
+        import os
+        import tempfile
+        import numpy as np
+        from database import FingerprintDatabase
+        
+        rng = np.random.default_rng(2)
+        sample_rate = 22050
+        with tempfile.TemporaryDirectory() as temp_dir:
+            database = FingerprintDatabase(os.path.join(temp_dir, "batch.db"))
+            fingerprint_system = database.fingerprint_system
+            
+            songs = []
+            for i in range(3):
+                t = np.arange(sample_rate * 8) / sample_rate
+                audio = sum(np.sin(2 * np.pi * f * t) for f in rng.uniform(200, 4000, 4))
+                audio = audio + rng.normal(0, 0.3, len(t))
+                songs.append(audio)
+                song_id = database.add_song(f"Песня {i}", "Тест", None, 8.0)
+                database.add_fingerprint(song_id, fingerprint_system.create_fingerprint_array(audio))
+            
+            queries = [fingerprint_system.create_fingerprint_array(audio[sample_rate:sample_rate * 4])
+                       for audio in songs]
+            queries.append(queries[0][:0])
+            for scoring in ('count', 'offset'):
+                batch = database.search_songs_batch(queries, 0.05, scoring)
+                single = [database.search_song(query, 0.05, scoring) for query in queries]
+                if batch != single:
+                    print(f"❌ Пакетный поиск ({scoring}) отличается от поиска по одному запросу")
+                    return False
+            print(f"✅ Пакетный поиск совпадает с поиском по одному запросу ({len(queries)} запроса)")
+            database.close()
+        
+        # Воркеры пула строят систему отпечатков с теми же параметрами, что и текущий процесс
+        from fingerprint import AudioFingerprint
+        from ingest import fingerprint_queries
+        system = AudioFingerprint(target_zone_size=15, target_zone_freq=40, nperseg=512, noverlap=256)
+        clips = [audio[:sample_rate * 3] for audio in songs]
+        pooled = fingerprint_queries(system, clips, workers=2)
+        local = [system.create_fingerprint_array(clip) for clip in clips]
+        if any(error is not None or not np.array_equal(fingerprint, expected)
+               for (fingerprint, _, error), expected in zip(pooled, local)):
+            print("❌ Хеши воркеров отличаются от хешей текущего процесса")
+            return False
+        print("✅ Хеши воркеров совпадают с хешами текущего процесса (target_zone_freq=40)")
+        
+        # recognize_batch запускает пул один раз и переиспользует его между пакетами
+        from music_recognizer import MusicRecognizer
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with MusicRecognizer(os.path.join(temp_dir, "pool.db"), cache_size=0) as recognizer:
+                for i, audio in enumerate(songs):
+                    recognizer.database.add_song_with_fingerprint(f"Песня {i}", audio, "Тест")
+                clips = [audio[sample_rate:sample_rate * 4] for audio in songs]
+                first = recognizer.recognize_batch(clips, 0.05, workers=2)
+                pool = recognizer._pool
+                second = recognizer.recognize_batch(clips[::-1], 0.05, workers=2)
+                local = recognizer.recognize_batch(clips, 0.05, workers=1)
+                if pool is None or recognizer._pool is not pool:
+                    print("❌ recognize_batch не переиспользует пул процессов")
+                    return False
+                names = [result['match'] and result['match'][0] for result in first]
+                if (names != [f"Песня {i}" for i in range(len(songs))]
+                        or [result['match'] for result in second] != [result['match'] for result in first[::-1]]
+                        or [result['match'] for result in local] != [result['match'] for result in first]):
+                    print(f"❌ Пакетное распознавание через пул: {names}")
+                    return False
+            if recognizer._pool is not None:
+                print("❌ close() не остановил пул процессов")
+                return False
+        print("✅ recognize_batch переиспользует пул процессов до close()")
+        
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка пакетного поиска: {e}")
+        return False
+
+def test_decoder():
+    """Тест быстрого декодера: результат как у librosa.load"""
+    print("\nТестирование декодирования аудио...")
+    
+    try:
+        import os
+        import tempfile
+        import wave
+        import numpy as np
+        import librosa
+        from decoder import decode_audio, _read_wave, resample_audio
+        
+        rng = np.random.default_rng(3)
+        samples = (rng.normal(0, 0.2, (44100 * 4, 2)) * 32767).astype('<i2')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "stereo.wav")
+            with wave.open(path, 'wb') as wave_file:
+                wave_file.setnchannels(2)
+                wave_file.setsampwidth(2)
+                wave_file.setframerate(44100)
+                wave_file.writeframes(samples.tobytes())
+            
+            for offset, duration in ((0.0, None), (1.5, 2.0)):
+                reference, _ = librosa.load(path, sr=22050, offset=offset, duration=duration)
+                decoded = decode_audio(path, 22050, offset, duration)
+                from_wave = resample_audio(*_read_wave(path, offset, duration), 22050)
+                if decoded.dtype != np.float32 or not np.array_equal(decoded, reference):
+                    print(f"❌ decode_audio отличается от librosa.load (offset={offset})")
+                    return False
+                if not np.array_equal(from_wave, reference):
+                    print(f"❌ Чтение через wave отличается от librosa.load (offset={offset})")
+                    return False
+        print("✅ decode_audio совпадает с librosa.load (весь файл и окно)")
+        
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка декодирования: {e}")
+        return False
+
+def test_monitor():
+    """Тест мониторинга эфира: журнал фрагментов длинного потока"""
+    print("\nТестирование мониторинга эфира...")
+    
+    try:
+        import os
+        import tempfile
+        import numpy as np
+        from benchmark import synthetic_audio
+        from music_recognizer import MusicRecognizer
+        from monitor import BroadcastMonitor
+        from streaming import iter_chunks
+        
+        sample_rate = 22050
+        rng = np.random.default_rng(5)
+        songs = [synthetic_audio(40, seed=20 + i) for i in range(3)]
+        noise = (0.05 * rng.standard_normal(sample_rate * 6)).astype(np.float32)
+        # Шум, песня 2 целиком, песня 3 с 10-й секунды, шум
+        stream = np.concatenate([noise, songs[1], songs[2][sample_rate * 10:], noise])
+        expected = [(6.0, 46.0, 2), (46.0, 76.0, 3)]
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            recognizer = MusicRecognizer(os.path.join(temp_dir, "monitor.db"))
+            for i, audio in enumerate(songs):
+                song_id = recognizer.database.add_song(f"Песня {i}", "Тест", None, 40.0)
+                recognizer.database.add_fingerprint(
+                    song_id, recognizer.fingerprint_system.create_fingerprint_array(audio))
+            
+            segments = BroadcastMonitor(recognizer).process(iter_chunks(stream, sample_rate))
+            recognizer.database.close()
+        
+        found = [(segment.start, segment.end, segment.song_id) for segment in segments]
+        if len(found) != len(expected) or any(
+                song_id != expected_id or abs(start - expected_start) > 1.0 or abs(end - expected_end) > 1.0
+                for (start, end, song_id), (expected_start, expected_end, expected_id) in zip(found, expected)):
+            print(f"❌ Журнал эфира {found} не совпадает с ожидаемым {expected}")
+            return False
+        print(f"✅ Журнал эфира: {len(segments)} фрагмента с точными границами")
+        
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка мониторинга эфира: {e}")
+        return False
+
+def test_result_cache():
+    """Тест кеша результатов: LRU, время жизни и сброс при изменении каталога"""
+    print("\nТестирование кеша результатов...")
+    
+    try:
+        import os
+        import time
+        import tempfile
+        from benchmark import synthetic_audio
+        from cache import LRUCache
+        from database import FingerprintDatabase
+        from music_recognizer import MusicRecognizer
+        
+        cache = LRUCache(max_size=2, ttl=0.05)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        if cache.get('b') is not None or cache.get('a') != 1:
+            print("❌ LRU вытеснил не самую старую запись")
+            return False
+        time.sleep(0.1)
+        if cache.get('c') is not None or cache.stats()['expirations'] != 1:
+            print("❌ Устаревшая запись не удалена")
+            return False
+        print("✅ LRU вытеснение и время жизни записей")
+        
+        songs = [synthetic_audio(15, seed=40 + i) for i in range(2)]
+        query = songs[0][22050 * 3:22050 * 8]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = os.path.join(temp_dir, "cache.db")
+            recognizer = MusicRecognizer(db_path)
+            recognizer.database.add_song_with_fingerprint("Песня 0", songs[0], "Тест")
+            
+            first = recognizer.recognize_from_audio_data(query)
+            second = recognizer.recognize_from_audio_data(query.copy())
+            stats = recognizer.cache_stats()
+            if first is None or first != second or stats['audio']['hits'] != 1:
+                print(f"❌ Повторный запрос не взят из кеша: {stats['audio']}")
+                return False
+            
+            # Новая песня через тот же объект базы сбрасывает кеш
+            recognizer.database.add_song_with_fingerprint("Песня 1", songs[1], "Тест")
+            recognizer.recognize_from_audio_data(query)
+            if recognizer.cache_stats()['audio']['hits'] != 1:
+                print("❌ Кеш не сброшен после добавления песни")
+                return False
+            
+            # Изменение из другого соединения видно через PRAGMA data_version
+            other = FingerprintDatabase(db_path)
+            other.clear_database()
+            other.close()
+            if recognizer.recognize_from_audio_data(query) is not None:
+                print("❌ Кеш не сброшен после очистки базы другим соединением")
+                return False
+            recognizer.database.close()
+        print("✅ Повторный запрос из кеша, сброс при изменении каталога")
+        
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка кеша результатов: {e}")
+        return False
+
+def test_fingerprint_cache():
+    """Тест кеша сигнала и пиков на диске: те же отпечатки без повторного декодирования"""
+    print("\nТестирование кеша отпечатков файлов...")
+    
+    try:
+        import os
+        import tempfile
+        import numpy as np
+        import soundfile as sf
+        from benchmark import synthetic_audio
+        from fingerprint import AudioFingerprint
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "song.wav")
+            sf.write(path, synthetic_audio(20, sample_rate=44100, seed=7), 44100, subtype='PCM_16')
+            cache_dir = os.path.join(temp_dir, "cache")
+            
+            for target_zone_size in (10, 5):
+                reference = AudioFingerprint(target_zone_size=target_zone_size)
+                cached = AudioFingerprint(target_zone_size=target_zone_size, cache_dir=cache_dir)
+                expected = reference.create_fingerprint_array_from_file(path)
+                for _ in range(2):
+                    if not np.array_equal(cached.create_fingerprint_array_from_file(path), expected):
+                        print(f"❌ Отпечаток из кеша отличается (target_zone_size={target_zone_size})")
+                        return False
+                # Первый раз пики считаются (промах), второй - берутся из кеша;
+                # с новыми параметрами пар пики тоже берутся из кеша
+                hits, misses = cached.file_cache.hits, cached.file_cache.misses
+                if (hits, misses) != ((1, 2) if target_zone_size == 10 else (2, 0)):
+                    print(f"❌ Неожиданная статистика кеша: {hits} попаданий, {misses} промахов")
+                    return False
+            
+            # Другой порог пиков: сигнал из кеша, пики считаются заново
+            threshold_system = AudioFingerprint(target_zone_threshold=-30.0, cache_dir=cache_dir)
+            expected = AudioFingerprint(target_zone_threshold=-30.0).create_fingerprint_array_from_file(path)
+            if not np.array_equal(threshold_system.create_fingerprint_array_from_file(path), expected):
+                print("❌ Отпечаток с другим порогом из кешированного сигнала отличается")
+                return False
+            if threshold_system.file_cache.hits != 1:
+                print("❌ Декодированный сигнал не взят из кеша")
+                return False
+        print("✅ Отпечатки из кеша совпадают, пересборка с новыми параметрами пар без декодирования")
+        
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка кеша отпечатков файлов: {e}")
+        return False
+
+def test_stop_list():
+    """Тест стоп-листа частых хешей: меньше строк на запрос, тот же ответ"""
+    print("\nТестирование стоп-листа частых хешей...")
+    
+    try:
+        import os
+        import tempfile
+        import numpy as np
+        from benchmark import synthetic_audio
+        from database import FingerprintDatabase, STOP_OFF, STOP_SKIP, STOP_WEIGHT
+        
+        sample_rate = 22050
+        t = np.arange(sample_rate * 10) / sample_rate
+        drone = (0.1 * sum(np.sin(2 * np.pi * f * t) for f in (110.0, 220.0, 330.0)) / 3).astype(np.float32)
+        songs = [synthetic_audio(10, seed=60 + i) + drone for i in range(7)]
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            database = FingerprintDatabase(os.path.join(temp_dir, "stop.db"), stop_mode=STOP_OFF)
+            fingerprint_system = database.fingerprint_system
+            database.add_songs_batch([(f"Песня {i}", "Тест", None, 10.0,
+                                       fingerprint_system.create_fingerprint_array(audio))
+                                      for i, audio in enumerate(songs[:6])])
+            query = fingerprint_system.create_fingerprint_array(songs[2][sample_rate * 2:sample_rate * 6])
+            rows_before = len(database.lookup_hashes(np.unique(query['hash']))[0])
+            
+            stats = database.build_stop_list(max_song_fraction=0.3)
+            if stats['stop_hashes'] == 0 or stats['limit'] != 2:
+                print(f"❌ Стоп-лист не построен: {stats}")
+                return False
+            
+            for mode in (STOP_SKIP, STOP_WEIGHT):
+                database.stop_mode = mode
+                for scoring in ('count', 'offset'):
+                    matches = database.search_song(query, 0.05, scoring)
+                    if not matches or matches[0][0] != "Песня 2":
+                        print(f"❌ Неверный ответ со стоп-листом ({mode}, {scoring})")
+                        return False
+            
+            # Вес частых хешей учитывается и в оценке по сдвигам
+            similarities = {}
+            for mode in (STOP_OFF, STOP_WEIGHT):
+                database.stop_mode = mode
+                similarities[mode] = database.search_song(query, 0.05, 'offset')[0][2]
+            if abs(similarities[STOP_WEIGHT] - similarities[STOP_OFF]) < 1e-6:
+                print(f"❌ Режим 'weight' не влияет на оценку по сдвигам: {similarities}")
+                return False
+            
+            # Потоковый поиск учитывает стоп-лист так же, как поиск по всему отпечатку
+            from streaming import StreamingRecognizer
+            clip = songs[2][sample_rate * 2:sample_rate * 6]
+            for mode in (STOP_SKIP, STOP_WEIGHT):
+                database.stop_mode = mode
+                streamed = StreamingRecognizer(database, threshold=0.05, min_aligned=10 ** 9).recognize(
+                    clip[start:start + 2205] for start in range(0, len(clip), 2205))
+                expected = database.search_song(query, 0.05, 'offset')[0]
+                if streamed is None or streamed[0] != expected[0] or abs(streamed[2] - expected[2]) > 1e-9:
+                    print(f"❌ Потоковая схожесть со стоп-листом ({mode}) {streamed} отличается от {expected}")
+                    return False
+            database.stop_mode = STOP_SKIP
+            
+            rows_after = len(database.lookup_hashes(np.unique(query['hash']))[0])
+            if rows_after >= rows_before:
+                print(f"❌ Число строк на запрос не уменьшилось: {rows_before} -> {rows_after}")
+                return False
+            print(f"✅ Стоп-лист {stats['stop_hashes']} хешей: строк на запрос {rows_before} -> {rows_after}")
+            
+            total_before = database.get_fingerprint_count()
+            stats = database.build_stop_list(max_song_fraction=0.3, prune=True)
+            song_id = database.add_song("Песня 6", "Тест", None, 10.0)
+            new_song = fingerprint_system.create_fingerprint_array(songs[6])
+            database.add_fingerprint(song_id, new_song)
+            expected = total_before - stats['pruned_rows'] + int(
+                (~np.isin(new_song['hash'], database.stop_hashes)).sum())
+            if stats['pruned_rows'] == 0 or database.get_fingerprint_count() != expected:
+                print("❌ Частые хеши не удалены из базы")
+                return False
+            database.close()
+        print(f"✅ Удаление частых хешей из базы: -{stats['pruned_rows']} строк")
+        
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка стоп-листа: {e}")
+        return False
+
+def test_fingerprint_storage():
+    """Тест хранения отпечатков: в базе время и частота опорного пика"""
+    print("\nТестирование хранения отпечатков...")
+    
+    try:
+        import os
+        import sqlite3
+        import tempfile
+        import numpy as np
+        from benchmark import synthetic_audio
+        from database import FingerprintDatabase, SCHEMA_V1
+        from fingerprint import fingerprint_to_dict, unpack_hashes
+        
+        sample_rate = 22050
+        audio = synthetic_audio(10, seed=90)
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = os.path.join(temp_dir, "storage.db")
+            database = FingerprintDatabase(db_path, schema_version=SCHEMA_V1)
+            fingerprint_system = database.fingerprint_system
+            fingerprint = fingerprint_system.create_fingerprint_array(audio)
+            if not np.array_equal(fingerprint['anchor_freq'], unpack_hashes(fingerprint['hash'])[0]):
+                print("❌ Частота опорного пика не совпадает с хешем")
+                return False
+            
+            song_id = database.add_song("Песня", "Тест", None, 10.0)
+            database.add_fingerprint(song_id, fingerprint)
+            database.close()
+            with sqlite3.connect(db_path) as conn:
+                rows = conn.execute('SELECT hash_value, time_offset, frequency_bin FROM fingerprints').fetchall()
+            hashes, times, freqs = (np.array(column) for column in zip(*rows))
+            if not np.array_equal(freqs, unpack_hashes(hashes)[0]) or not np.array_equal(
+                    np.sort(times), np.sort(fingerprint['anchor_time'])):
+                print("❌ В базе не время и частота опорного пика")
+                return False
+        print("✅ В базе время и частота опорного пика")
+        
+        song = fingerprint_to_dict(fingerprint)
+        query = fingerprint_to_dict(fingerprint_system.create_fingerprint_array(audio[sample_rate * 3:sample_rate * 7]))
+        other = fingerprint_to_dict(fingerprint_system.create_fingerprint_array(synthetic_audio(10, seed=91)))
+        same = fingerprint_system.compare_fingerprints(query, song)
+        different = fingerprint_system.compare_fingerprints(query, other)
+        if same < 0.5 or same <= different:
+            print(f"❌ Сравнение отпечатков по сдвигу: {same:.2f} / {different:.2f}")
+            return False
+        print(f"✅ Сравнение отпечатков по сдвигу: фрагмент {same:.2f}, другая песня {different:.2f}")
+        
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка хранения отпечатков: {e}")
+        return False
+
+def test_schema():
+    """Тест схемы 2 таблицы отпечатков: те же ответы, меньше места, перевод со схемы 1"""
+    print("\nТестирование схемы таблицы отпечатков...")
+    
+    try:
+        import os
+        import tempfile
+        from benchmark import synthetic_audio
+        from database import FingerprintDatabase, SCHEMA_V1, SCHEMA_V2
+        
+        sample_rate = 22050
+        songs = [synthetic_audio(10, seed=80 + i) for i in range(4)]
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            databases = {}
+            for schema_version in (SCHEMA_V1, SCHEMA_V2):
+                database = FingerprintDatabase(os.path.join(temp_dir, f"schema_{schema_version}.db"),
+                                               schema_version=schema_version)
+                fingerprint_system = database.fingerprint_system
+                database.add_songs_batch([(f"Песня {i}", "Тест", None, 10.0,
+                                           fingerprint_system.create_fingerprint_array(audio))
+                                          for i, audio in enumerate(songs)])
+                databases[schema_version] = database
+            
+            query = fingerprint_system.create_fingerprint_array(songs[1][sample_rate * 3:sample_rate * 7])
+            expected = databases[SCHEMA_V1].search_song(query, 0.05, 'offset')
+            if not expected or expected[0][0] != "Песня 1" or databases[SCHEMA_V2].search_song(query, 0.05, 'offset') != expected:
+                print("❌ Ответы схем 1 и 2 различаются")
+                return False
+            rows = databases[SCHEMA_V1].get_fingerprint_count()
+            if databases[SCHEMA_V2].get_fingerprint_count() != rows:
+                print("❌ Разное число строк в схемах 1 и 2")
+                return False
+            print("✅ Схемы 1 и 2 дают одинаковый ответ")
+            
+            stats = databases[SCHEMA_V1].upgrade_schema()
+            if (databases[SCHEMA_V1].schema_version != SCHEMA_V2 or stats['rows'] != rows
+                    or databases[SCHEMA_V1].search_song(query, 0.05, 'offset') != expected):
+                print(f"❌ Перевод на схему 2 изменил данные: {stats}")
+                return False
+            
+            # Удаление песни и догрузка новых не должны читать всю таблицу
+            for database in databases.values():
+                for sql in ('DELETE FROM fingerprints WHERE song_id = ?',
+                            'SELECT hash_value, song_id, time_offset FROM fingerprints WHERE song_id > ?'):
+                    plan = ' '.join(str(row[-1]) for row in
+                                    database._connect().execute('EXPLAIN QUERY PLAN ' + sql, (1,)))
+                    if 'idx_song_id' not in plan:
+                        print(f"❌ Запрос по песне без индекса: {plan}")
+                        return False
+            print("✅ Запросы по песне идут по индексу")
+            
+            for database in databases.values():
+                database.close()
+            reopened = FingerprintDatabase(os.path.join(temp_dir, f"schema_{SCHEMA_V1}.db"),
+                                           schema_version=SCHEMA_V1)
+            if reopened.schema_version != SCHEMA_V2 or reopened.get_fingerprint_count() != rows:
+                print("❌ Схема базы не сохранилась после переоткрытия")
+                return False
+            reopened.close()
+        print(f"✅ Перевод на схему 2: {stats['bytes_before'] // 1024} -> {stats['bytes_after'] // 1024} КБ")
+        
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка схемы таблицы отпечатков: {e}")
+        return False
+
+def test_memory_index():
+    """Тест инкрементального обновления индекса в памяти"""
+    print("\nТестирование обновления индекса в памяти...")
+    
+    try:
+        import os
+        import tempfile
+        import numpy as np
+        from benchmark import synthetic_audio
+        from database import FingerprintDatabase
+        from index import InMemoryIndex
+        
+        def rows(index):
+            hashes = np.repeat(index.keys, np.diff(index.offsets))
+            alive = ~np.isin(index.song_ids, index.deleted_songs)
+            return sorted(zip(hashes[alive].tolist(), index.song_ids[alive].tolist(),
+                              index.time_offsets[alive].tolist()))
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            database = FingerprintDatabase(os.path.join(temp_dir, "index.db"), backend='memory')
+            fingerprint_system = database.fingerprint_system
+            fingerprints = [fingerprint_system.create_fingerprint_array(synthetic_audio(10, seed=140 + i))
+                            for i in range(5)]
+            database.add_songs_batch([(f"Песня {i}", "Тест", None, 10.0, fingerprints[i]) for i in range(2)])
+            database.refresh_index()
+            
+            # Песня добавлена, а ее отпечатки - позже, уже после песни с большим ID
+            late_id = database.add_song("Поздняя", "Тест", None, 10.0)
+            database.add_songs_batch([("Песня 3", "Тест", None, 10.0, fingerprints[3])])
+            database.refresh_index()
+            database.add_fingerprint(late_id, fingerprints[2])
+            database.refresh_index()
+            _, song_ids, _ = database.index.lookup(np.unique(fingerprints[2]['hash']))
+            if late_id not in song_ids:
+                print("❌ Отпечатки песни, зафиксированные позже, не попали в индекс")
+                return False
+            
+            database.delete_song(1)
+            database.add_songs_batch([("Песня 4", "Тест", None, 10.0, fingerprints[4])])
+            added = database.refresh_index()
+            _, song_ids, _ = database.index.lookup(np.unique(fingerprints[0]['hash']))
+            if added != len(np.unique(fingerprints[4][['hash', 'anchor_time']])) or 1 in song_ids:
+                print(f"❌ Обновление индекса: добавлено {added}, песня 1 найдена: {1 in song_ids}")
+                return False
+            
+            expected = rows(InMemoryIndex.load(database))
+            if rows(database.index) != expected or len(database.index) != database.get_fingerprint_count():
+                print("❌ Индекс после обновлений отличается от загруженного заново")
+                return False
+            database.index.compact()
+            if len(database.index.deleted_songs) or rows(database.index) != expected:
+                print("❌ Сжатие индекса изменило строки")
+                return False
+            
+            # Экспорт видит песни, добавленные другим соединением после обновления,
+            # а параллельные экспорты в один файл не портят друг друга
+            import threading
+            from index import MemmapIndex
+            other = FingerprintDatabase(database.db_path)
+            other.add_songs_batch([("Песня 0 снова", "Тест", None, 10.0, fingerprints[0])])
+            other.close()
+            index_path = os.path.join(temp_dir, "index.bin")
+            errors = []
+            def export():
+                try:
+                    database.export_index(index_path)
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=export) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            exported = MemmapIndex(index_path)
+            if errors or rows(exported) != rows(InMemoryIndex.load(database)):
+                print(f"❌ Экспорт индекса не совпадает с базой: {errors}")
+                return False
+            if [name for name in os.listdir(temp_dir) if name.endswith('.tmp')]:
+                print("❌ После экспорта остались временные файлы")
+                return False
+            del exported
+            database.close()
+        print("✅ Индекс в памяти догружает новые и поздние песни и помечает удаленные, экспорт актуален")
+        
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка обновления индекса в памяти: {e}")
+        return False
+
+def test_custom_sample_rate():
+    """Тест распознавания с нестандартной частотой дискретизации и STFT"""
+    print("\nТестирование нестандартной частоты дискретизации...")
+    
+    try:
+        import os
+        import wave
+        import tempfile
+        import numpy as np
+        from benchmark import synthetic_audio
+        from fingerprint import AudioFingerprint
+        from music_recognizer import MusicRecognizer
+        
+        audio = synthetic_audio(15, seed=150)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, "song.wav")
+            with wave.open(file_path, 'wb') as wave_file:
+                wave_file.setnchannels(1)
+                wave_file.setsampwidth(2)
+                wave_file.setframerate(22050)
+                wave_file.writeframes((np.clip(audio, -1, 1) * 32767).astype('<i2').tobytes())
+            
+            system = AudioFingerprint(sample_rate=16000, nperseg=512, noverlap=256)
+            recognizer = MusicRecognizer(os.path.join(temp_dir, "rate.db"), fingerprint_system=system)
+            recognizer.database.add_song_from_file(file_path, "Песня", "Тест")
+            if recognizer.audio_processor.sample_rate != 16000:
+                print(f"❌ Запросы декодируются с частотой {recognizer.audio_processor.sample_rate}")
+                return False
+            result = recognizer.recognize_from_file(file_path, offset=5, duration=5)
+            if result is None or result[0] != "Песня":
+                print(f"❌ Фрагмент файла не распознан при 16 кГц: {result}")
+                return False
+            recognizer.database.close()
+            
+            # База, открытая напрямую с той же системой: сдвиг в секундах и параметры воркеров
+            from database import FingerprintDatabase
+            from ingest import _worker_args
+            database = FingerprintDatabase(os.path.join(temp_dir, "rate.db"), fingerprint_system=system)
+            query = system.create_fingerprint_array(system.audio_processor.load_audio_file(file_path, 5, 5))
+            matches = database.search_song(query, 0.05, 'offset')
+            if not matches or abs(matches[0][3] - 5.0) > 0.1:
+                print(f"❌ Неверный сдвиг запроса при 16 кГц: {matches[:1]}")
+                return False
+            if _worker_args(database.fingerprint_system)[0]['sample_rate'] != 16000:
+                print("❌ Воркеры получают стандартные параметры вместо параметров базы")
+                return False
+            database.close()
+        print("✅ Распознавание файла при 16 кГц и nperseg=512, сдвиг запроса в секундах")
+        
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка нестандартной частоты дискретизации: {e}")
+        return False
+
+def test_server():
+    """Тест HTTP сервиса распознавания обычным HTTP клиентом"""
+    print("\nТестирование HTTP сервиса...")
+    
+    try:
+        import io
+        import os
+        import json
+        import wave
+        import asyncio
+        import tempfile
+        import threading
+        import http.client
+        import numpy as np
+        from urllib.parse import urlencode
+        from benchmark import synthetic_audio
+        from music_recognizer import MusicRecognizer
+        from server import RecognitionServer
+        from metrics import Metrics
+        
+        sample_rate = 22050
+        songs = [synthetic_audio(10, seed=120 + i) for i in range(4)]
+        
+        def wav_bytes(audio):
+            buffer = io.BytesIO()
+            with wave.open(buffer, 'wb') as wave_file:
+                wave_file.setnchannels(1)
+                wave_file.setsampwidth(2)
+                wave_file.setframerate(sample_rate)
+                wave_file.writeframes((np.clip(audio, -1, 1) * 32767).astype('<i2').tobytes())
+            return buffer.getvalue()
+        
+        def request(method, path, body=None):
+            conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=60)
+            conn.request(method, path, body, {'Content-Type': 'audio/wav'} if body else {})
+            response = conn.getresponse()
+            data = response.read().decode('utf-8')
+            conn.close()
+            return response.status, data
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            recognizer = MusicRecognizer(os.path.join(temp_dir, "server.db"), backend='memory',
+                                         metrics=Metrics())
+            fingerprint_system = recognizer.database.fingerprint_system
+            recognizer.database.add_songs_batch([(f"Песня {i}", "Тест", None, 10.0,
+                                                  fingerprint_system.create_fingerprint_array(audio))
+                                                 for i, audio in enumerate(songs[:3])])
+            recognizer.database.refresh_index()
+            
+            server = RecognitionServer(recognizer, port=0, workers=1, max_pending=2)
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, daemon=True)
+            thread.start()
+            asyncio.run_coroutine_threadsafe(server.start(), loop).result(timeout=30)
+            try:
+                status, data = request('POST', '/recognize', wav_bytes(songs[1][sample_rate * 2:sample_rate * 6]))
+                result = json.loads(data)
+                if status != 200 or not result['match'] or result['match']['name'] != "Песня 1":
+                    print(f"❌ /recognize: {status} {data}")
+                    return False
+                print(f"✅ /recognize: {result['match']['name']}, время этапов {result['timings']}")
+                
+                status, data = request('POST', '/ingest?' + urlencode({'name': "Новая", 'artist': "Тест"}),
+                                       wav_bytes(songs[3]))
+                status2, data2 = request('POST', '/recognize', wav_bytes(songs[3][sample_rate:sample_rate * 5]))
+                if status != 201 or status2 != 200 or (json.loads(data2)['match'] or {}).get('name') != "Новая":
+                    print(f"❌ /ingest: {status} {data}, затем /recognize: {status2} {data2}")
+                    return False
+                print("✅ /ingest: новая песня сразу распознается")
+                
+                # Все места заняты - сервер отвечает 429, а не ставит запрос в очередь
+                server.in_flight = server.max_pending
+                status, _ = request('POST', '/recognize', wav_bytes(songs[0][:sample_rate * 4]))
+                server.in_flight = 0
+                if status != 429:
+                    print(f"❌ Перегрузка: ожидался 429, получен {status}")
+                    return False
+                
+                status, data = request('GET', '/stats')
+                stats = json.loads(data)
+                status2, metrics = request('GET', '/metrics')
+                if (status != 200 or stats['songs_count'] != 4 or stats['rejected'] != 1
+                        or status2 != 200 or 'myshazam_request_seconds_bucket' not in metrics
+                        or 'myshazam_stage_seconds_bucket{stage="lookup"' not in metrics):
+                    print(f"❌ /stats или /metrics: {data}")
+                    return False
+                print(f"✅ 429 при перегрузке, /stats и /metrics: p50 /recognize "
+                      f"{stats['latency']['/recognize total']['p50'] * 1000:.0f} мс")
+                
+                for length in ('abc', '-5'):
+                    conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=60)
+                    conn.putrequest('POST', '/recognize')
+                    conn.putheader('Content-Length', length)
+                    conn.endheaders()
+                    status = conn.getresponse().status
+                    conn.close()
+                    if status != 400:
+                        print(f"❌ Content-Length {length}: ожидался 400, получен {status}")
+                        return False
+                print("✅ 400 при неверном Content-Length")
+            finally:
+                asyncio.run_coroutine_threadsafe(server.stop(), loop).result(timeout=30)
+                loop.call_soon_threadsafe(loop.stop)
+                thread.join()
+                recognizer.database.close()
+        
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка HTTP сервиса: {e}")
+        return False
+
+def test_startup():
+    """Тест запуска CLI: тяжелые модули не импортируются заранее"""
+    print("\nТестирование времени запуска...")
+    
+    try:
+        from benchmark import import_profile, heavy_imports
+        
+        profile, top_level = import_profile(['-c', 'import main'])
+        if 'main' not in profile:
+            print("❌ Не удалось импортировать main")
+            return False
+        heavy = heavy_imports(profile)
+        if heavy:
+            print(f"❌ При запуске импортируются тяжелые модули: {', '.join(heavy)}")
+            return False
+        print(f"✅ Импорт main без тяжелых модулей: {sum(top_level.values()):.2f} с")
+        
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка проверки запуска: {e}")
+        return False
+
+def test_benchmark_stages():
+    """Тест замеров этапов: результат в JSON и сравнение прогонов"""
+    print("\nТестирование замеров этапов...")
+    
+    try:
+        import copy
+        import json
+        from benchmark import benchmark_stages, compare_runs
+        
+        run = benchmark_stages(songs=3, song_seconds=5.0, queries=3, clip_seconds=3.0,
+                               repeat=1, min_seconds=0.0)
+        run = json.loads(json.dumps(run))
+        stages = [row['stage'] for row in run['stages']]
+        for stage in ('spectrogram', 'find_peaks', 'create_fingerprint', 'add_fingerprint', 'search_memory'):
+            if stage not in stages:
+                print(f"❌ Нет этапа {stage}")
+                return False
+        print(f"✅ Этапы: {', '.join(stages)}")
+        
+        if any(row['status'] == 'regression' for row in compare_runs(run, run)):
+            print("❌ Прогон отличается сам от себя")
+            return False
+        
+        slower = copy.deepcopy(run)
+        slower['stages'][0]['per_op_ms'] = run['stages'][0]['per_op_ms'] * 2 + 1
+        statuses = {row['stage']: row['status'] for row in compare_runs(run, slower)}
+        if statuses[stages[0]] != 'regression':
+            print("❌ Замедление этапа не отмечено как регрессия")
+            return False
+        print("✅ Сравнение прогонов находит регрессию")
+        
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка замеров этапов: {e}")
+        return False
+
+def test_evaluate():
+    """Тест оценки точности и стоимости для сетки параметров"""
+    print("\nТестирование оценки сетки параметров...")
+    
+    try:
+        import numpy as np
+        from evaluate import evaluate, degrade, Degradation
+        
+        rng = np.random.default_rng(0)
+        clip = np.sin(np.arange(22050) / 10).astype(np.float32)
+        noisy = degrade(clip, 22050, Degradation('snr=10', snr_db=10.0), rng)
+        snr = 10 * np.log10(np.mean(clip ** 2) / np.mean((noisy - clip) ** 2))
+        if abs(snr - 10.0) > 0.5:
+            print(f"❌ Отношение сигнал/шум {snr:.1f} дБ вместо 10")
+            return False
+        print(f"✅ Искажение запроса: шум {snr:.1f} дБ")
+        
+        results = evaluate({'target_zone_size': [10], 'nperseg': [1024, 4096]},
+                           degradation_list=[Degradation('clean'), Degradation('snr=10', snr_db=10.0)],
+                           queries_per_song=1, clip_seconds=3.0, holdout=0.25, workers=2,
+                           songs=4, song_seconds=8.0)
+        rows = {(row['nperseg'], row['condition']): row for row in results}
+        clean = rows[(1024, 'clean')]
+        if clean['recall'] != 1.0 or clean['queries'] != 4:
+            print(f"❌ Неожиданный результат для чистых запросов: {clean}")
+            return False
+        if 'error' not in rows[(4096, 'all')]:
+            print("❌ Недопустимые параметры не отмечены ошибкой")
+            return False
+        total = rows[(1024, 'all')]
+        print(f"✅ Сетка: recall {total['recall']}, {total['ms_to_answer']} мс на ответ, "
+              f"{total['db_bytes_per_song']} байт на песню")
+        
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка оценки сетки параметров: {e}")
+        return False
+
+def test_metrics():
+    """Тест метрик этапов распознавания"""
+    print("\nТестирование метрик этапов...")
+    
+    try:
+        import tempfile
+        from music_recognizer import MusicRecognizer
+        from metrics import Metrics
+        from benchmark import synthetic_catalog
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            metrics = Metrics()
+            breakdowns = []
+            metrics.add_sink(breakdowns.append)
+            recognizer = MusicRecognizer(os.path.join(temp_dir, 'metrics.db'), metrics=metrics)
+            catalog = synthetic_catalog(3, 8.0)
+            recognizer.database.add_songs_batch([
+                (f"Песня {i}", "Тест", None, 8.0, recognizer.fingerprint_system.create_fingerprint_array(audio))
+                for i, audio in enumerate(catalog)])
+            
+            result, breakdown = recognizer.recognize_from_audio_data(catalog[1][22050:22050 * 4],
+                                                                     with_metrics=True)
+            if not result or result[0] != "Песня 1":
+                print(f"❌ Неверный результат: {result}")
+                return False
+            stages = ('spectrogram', 'peaks', 'hashing', 'lookup', 'score', 'total')
+            missing = [stage for stage in stages if stage not in breakdown['timings']]
+            if missing or breakdown['counters'].get('rows_fetched', 0) <= 0:
+                print(f"❌ Неполная разбивка запроса: {breakdown}")
+                return False
+            print(f"✅ Разбивка запроса: {breakdown['counters']['hashes']} хешей, "
+                  f"{breakdown['counters']['rows_fetched']} строк, "
+                  f"{1000 * breakdown['timings']['total']:.1f} мс")
+            
+            # Повтор отвечается из кеша, без этапов отпечатка
+            result = recognizer.recognize_from_audio_data(catalog[1][22050:22050 * 4])
+            if breakdowns[-1]['counters'] != {'audio_cache_hits': 1} or len(breakdowns) != 2:
+                print(f"❌ Неверная трассировка повтора: {breakdowns[-1]}")
+                return False
+            
+            text = metrics.prometheus()
+            if 'myshazam_stage_seconds_count{stage="lookup"} 1' not in text or \
+                    'myshazam_recognitions_total 2' not in text:
+                print("❌ Неверный экспорт в Prometheus")
+                return False
+            print("✅ Приемник и экспорт в Prometheus")
+            recognizer.database.close()
+        
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка метрик этапов: {e}")
+        return False
+
 def main():
     """Основная функция тестирования"""
     print("=== Тест системы MyShazam ===\n")
@@ -133,6 +1123,91 @@ def main():
         print("\n❌ Ошибки в наших модулях. Проверьте код.")
         return 1
     
+    # Тест декодирования
+    if not test_decoder():
+        print("\n❌ Ошибки в декодировании аудио.")
+        return 1
+    
+    # Тест поиска пиков
+    if not test_peak_detection():
+        print("\n❌ Ошибки в поиске пиков.")
+        return 1
+    
+    # Тест потокового распознавания
+    if not test_streaming():
+        print("\n❌ Ошибки в потоковом распознавании.")
+        return 1
+    
+    # Тест пакетного поиска
+    if not test_batch_search():
+        print("\n❌ Ошибки в пакетном поиске.")
+        return 1
+    
+    # Тест мониторинга эфира
+    if not test_monitor():
+        print("\n❌ Ошибки в мониторинге эфира.")
+        return 1
+    
+    # Тест кеша результатов
+    if not test_result_cache():
+        print("\n❌ Ошибки в кеше результатов.")
+        return 1
+    
+    # Тест кеша отпечатков файлов
+    if not test_fingerprint_cache():
+        print("\n❌ Ошибки в кеше отпечатков файлов.")
+        return 1
+    
+    # Тест стоп-листа
+    if not test_stop_list():
+        print("\n❌ Ошибки в стоп-листе частых хешей.")
+        return 1
+    
+    # Тест хранения отпечатков
+    if not test_fingerprint_storage():
+        print("\n❌ Ошибки в хранении отпечатков.")
+        return 1
+    
+    # Тест схемы таблицы отпечатков
+    if not test_schema():
+        print("\n❌ Ошибки в схеме таблицы отпечатков.")
+        return 1
+    
+    # Тест HTTP сервиса
+    if not test_server():
+        print("\n❌ Ошибки в HTTP сервисе.")
+        return 1
+    
+    # Тест времени запуска
+    if not test_startup():
+        print("\n❌ Ошибки во времени запуска.")
+        return 1
+    
+    # Тест замеров этапов
+    if not test_benchmark_stages():
+        print("\n❌ Ошибки в замерах этапов.")
+        return 1
+    
+    # Тест оценки сетки параметров
+    if not test_evaluate():
+        print("\n❌ Ошибки в оценке сетки параметров.")
+        return 1
+    
+    # Тест метрик этапов
+    if not test_metrics():
+        print("\n❌ Ошибки в метриках этапов.")
+        return 1
+    
+    # Тест обновления индекса в памяти
+    if not test_memory_index():
+        print("\n❌ Ошибки в обновлении индекса в памяти.")
+        return 1
+    
+    # Тест нестандартной частоты дискретизации
+    if not test_custom_sample_rate():
+        print("\n❌ Ошибки при нестандартной частоте дискретизации.")
+        return 1
+    
     # Тест базовой функциональности
     if not test_basic_functionality():
         print("\n❌ Ошибки в базовой функциональности.")